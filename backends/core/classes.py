@@ -1,11 +1,11 @@
 from types import NoneType
 from pydantic import BaseModel, field_validator
-from typing import List, Optional, Union
+from typing import Any, List, Optional, Union
 from enum import Enum
 from chromadb import Collection
 from chromadb.api import ClientAPI
 from llama_index.llms.llama_cpp import LlamaCPP
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from inference.classes import RetrievalTypes
 
 DEFAULT_TEMPERATURE = 0.2
@@ -13,15 +13,20 @@ DEFAULT_CONTEXT_WINDOW = 2000
 DEFAULT_SEED = 1337
 DEFAULT_MAX_TOKENS = 0  # 0 means we should calc it
 DEFAULT_CHAT_MODE = "instruct"
+DEFAULT_PROMPT_CACHE_SIZE = 2 << 30  # 2GB
 
 
 class AppState(dict):
     PORT_HOMEBREW_API: int
     db_client: ClientAPI
-    llm: LlamaCPP | str
+    source_manifest: Any  # embeddings.manifest.SourceManifest
+    lexical_index: Any  # embeddings.lexical.LexicalIndex
+    reranker: Any  # embeddings.rerank.Reranker
+    answer_cache: Any  # inference.answer_cache.AnswerCache
+    llm: LlamaCPP | str  # the active model in `model_pool`
     path_to_model: str
     model_id: str
-    embed_model: HuggingFaceEmbedding | str
+    embed_model: BaseEmbedding | str  # shared by ingestion and queries
     loaded_text_model_data: dict
 
 
@@ -84,6 +89,14 @@ class LoadTextInferenceInit(BaseModel):
     n_threads: Optional[int] = None
     offload_kqv: Optional[bool] = False
     verbose: Optional[bool] = False
+    # Reuse llama.cpp state for repeated prompt prefixes (system messages, tools).
+    # Its RAM tier counts towards the model pool's memory budget.
+    cache: Optional[bool] = False
+    cache_type: Optional[str] = "ram"  # "ram" or "disk" (ram backed by disk)
+    cache_size: Optional[int] = DEFAULT_PROMPT_CACHE_SIZE  # bytes per tier
+    logits_all: Optional[bool] = False  # needed for `logprobs` on /v1/completions
+    # Decode up to this many completions together, each gets its own n_ctx
+    n_parallel: Optional[int] = 1
 
 
 class LoadTextInferenceCall(BaseModel):
@@ -133,6 +146,31 @@ class LoadInferenceResponse(BaseModel):
     }
 
 
+# Change settings of a loaded model, only reloads if `init` settings differ
+class UpdateTextSettingsRequest(BaseModel):
+    modelId: Optional[str] = None  # defaults to the currently loaded model
+    init: Optional[LoadTextInferenceInit] = None
+    call: LoadTextInferenceCall
+
+
+class UpdateTextSettingsResponse(BaseModel):
+    message: str
+    success: bool
+    data: dict
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "message": "Updated settings of AI model [llama-2-13b-chat-ggml].",
+                    "success": True,
+                    "data": {"reloaded": False},
+                }
+            ]
+        }
+    }
+
+
 class ServicesApiResponse(BaseModel):
     success: bool
     message: str
@@ -179,6 +217,42 @@ class DownloadTextModelRequest(BaseModel):
     filename: str
 
 
+class DownloadTextModelResponse(BaseModel):
+    success: bool
+    message: str
+    data: dict  # the queued download
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "success": True,
+                    "message": "Queued download of llama-2-13b-chat.Q4_K_M.gguf.",
+                    "data": {
+                        "id": "V1StGXR8_Z5jdHi6B-myT",
+                        "repoId": "TheBloke/Llama-2-13B-chat-GGUF",
+                        "filename": "llama-2-13b-chat.Q4_K_M.gguf",
+                        "status": "queued",
+                        "totalBytes": 0,
+                        "downloadedBytes": 0,
+                        "progress": 0.0,
+                        "bytesPerSecond": 0,
+                        "error": None,
+                        "filePath": None,
+                        "createdAt": 1718000000.0,
+                    },
+                }
+            ]
+        }
+    }
+
+
+class DownloadTextModelsResponse(BaseModel):
+    success: bool
+    message: str
+    data: List[dict]  # newest first
+
+
 class DeleteTextModelRequest(BaseModel):
     filename: str
     repoId: str
@@ -230,6 +304,21 @@ class InferenceRequest(BaseModel):
     )
     similarity_top_k: Optional[int] = None
     response_mode: Optional[str] = None
+    # "vector" (default) or "lexical" use one search, "hybrid" fuses keyword and vector
+    # search. "lexical" needs no embedding model.
+    search_mode: Optional[str] = None
+    # How results from several collections are merged, "rrf" (default) or "score"
+    fusion_mode: Optional[str] = None
+    retrieval_timeout: Optional[float] = None  # seconds to wait for each collection
+    # Rerank over-fetched chunks with a local cross-encoder before answering
+    rerank: Optional[bool] = False
+    rerank_budget_ms: Optional[float] = None  # time allowed for scoring candidates
+    # Reuse the answer to an identical prompt, needs temperature 0 or a fixed seed
+    cache_response: Optional[bool] = False
+    # Also reuse answers to inputs at least this similar (0-1) within the same prompt
+    cache_similarity: Optional[float] = None
+    priority: Optional[int] = 0  # Higher values are taken from the queue first
+    requestId: Optional[str] = None  # Used to cancel the generation, generated if empty
 
     model_config = {
         "json_schema_extra": {
@@ -270,6 +359,7 @@ class InferenceRequest(BaseModel):
                     "frequency_penalty": 0.0,
                     "similarity_top_k": 1,
                     "response_mode": "compact",
+                    "priority": 0,
                 }
             ]
         }
@@ -294,6 +384,85 @@ class InferenceResponse(BaseModel):
     }
 
 
+# OpenAI API compatible requests, https://platform.openai.com/docs/api-reference
+class OpenAIStreamOptions(BaseModel):
+    include_usage: Optional[bool] = False
+
+
+class OpenAICompletionRequest(BaseModel):
+    model: Optional[str] = None  # a resident modelId, defaults to the loaded model
+    prompt: Union[str, List[str]]
+    suffix: Optional[str] = None
+    max_tokens: Optional[int] = 16
+    temperature: Optional[float] = 1.0
+    top_p: Optional[float] = 1.0
+    n: Optional[int] = 1
+    stream: Optional[bool] = False
+    stream_options: Optional[OpenAIStreamOptions] = None
+    logprobs: Optional[int] = None
+    echo: Optional[bool] = False
+    stop: Optional[Union[str, List[str]]] = None
+    presence_penalty: Optional[float] = 0.0
+    frequency_penalty: Optional[float] = 0.0
+    seed: Optional[int] = None
+    user: Optional[str] = None
+    # llama.cpp extensions
+    top_k: Optional[int] = 40
+    min_p: Optional[float] = 0.05
+    repeat_penalty: Optional[float] = 1.1
+    priority: Optional[int] = 0
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "model": "llama2",
+                    "prompt": "Say this is a test",
+                    "max_tokens": 7,
+                    "temperature": 0,
+                }
+            ]
+        }
+    }
+
+
+class OpenAIChatCompletionRequest(BaseModel):
+    model: Optional[str] = None  # a resident modelId, defaults to the loaded model
+    messages: List[dict]
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = 1.0
+    top_p: Optional[float] = 1.0
+    n: Optional[int] = 1
+    stream: Optional[bool] = False
+    stream_options: Optional[OpenAIStreamOptions] = None
+    stop: Optional[Union[str, List[str]]] = None
+    presence_penalty: Optional[float] = 0.0
+    frequency_penalty: Optional[float] = 0.0
+    seed: Optional[int] = None
+    response_format: Optional[dict] = None
+    user: Optional[str] = None
+    # llama.cpp extensions
+    top_k: Optional[int] = 40
+    min_p: Optional[float] = 0.05
+    repeat_penalty: Optional[float] = 1.1
+    priority: Optional[int] = 0
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "model": "llama2",
+                    "messages": [
+                        {"role": "system", "content": "You are a helpful assistant."},
+                        {"role": "user", "content": "Hello!"},
+                    ],
+                    "stream": True,
+                }
+            ]
+        }
+    }
+
+
 class PreProcessRequest(BaseModel):
     document_id: Optional[str] = ""
     document_name: str
@@ -373,6 +542,7 @@ class EmbedDocumentRequest(BaseModel):
 class AddDocumentResponse(BaseModel):
     success: bool
     message: str
+    data: Optional[dict] = None  # the ingestion job
 
     model_config = {
         "json_schema_extra": {
@@ -380,12 +550,94 @@ class AddDocumentResponse(BaseModel):
                 {
                     "message": "A new memory has been added",
                     "success": True,
+                    "data": {"id": "V1StGXR8_Z5jdHi6B-myT", "status": "queued"},
+                }
+            ]
+        }
+    }
+
+
+class EmbedDocumentsRequest(BaseModel):
+    collectionName: str
+    description: Optional[str] = ""
+    tags: Optional[str] = ""
+    # need oneof file uploads/directoryPath/globPattern/urlPaths
+    directoryPath: Optional[str] = ""  # folder on server disk
+    globPattern: Optional[str] = ""  # pattern on server disk, ie /docs/**/*.md
+    urlPaths: Optional[str] = ""  # web files or pages, separated by spaces or new lines
+    recursive: Optional[bool] = True  # include sub-folders of directoryPath
+    # Chunking settings
+    chunkSize: Optional[int] = None
+    chunkOverlap: Optional[int] = None
+    chunkStrategy: Optional[str] = None
+    # Parsing method
+    parsingMethod: Optional[str] = None
+
+
+class AddDocumentsResponse(BaseModel):
+    success: bool
+    message: str
+    data: List[dict]  # one ingestion job per file
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "message": "Added 2 memories to the queue.",
+                    "success": True,
+                    "data": [
+                        {"id": "V1StGXR8_Z5jdHi6B-myT", "status": "queued"},
+                        {"id": "Uakgb_J5m9g-0JDMbcJqL", "status": "queued"},
+                    ],
                 }
             ]
         }
     }
 
 
+class GetIngestionJobsRequest(BaseModel):
+    collectionName: Optional[str] = None
+    status: Optional[str] = None  # queued, running, done, failed, cancelled
+
+
+class IngestionJobResponse(BaseModel):
+    success: bool
+    message: str
+    data: Optional[dict] = None
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "success": True,
+                    "message": "Job [V1StGXR8_Z5jdHi6B-myT] is running.",
+                    "data": {
+                        "id": "V1StGXR8_Z5jdHi6B-myT",
+                        "collectionName": "science",
+                        "documentId": "Uakgb_J5m9g-0JDMbcJqL",
+                        "documentName": "physics-notes",
+                        "status": "running",
+                        "stage": "embedding",
+                        "progress": 42.5,
+                        "totalChunks": 400,
+                        "embeddedChunks": 170,
+                        "attempts": 1,
+                        "error": None,
+                        "createdAt": 1718000000.0,
+                        "updatedAt": 1718000042.0,
+                    },
+                }
+            ]
+        }
+    }
+
+
+class IngestionJobsResponse(BaseModel):
+    success: bool
+    message: str
+    data: List[dict]
+
+
 class GetAllCollectionsResponse(BaseModel):
     success: bool
     message: str
@@ -455,6 +707,41 @@ class GetCollectionResponse(BaseModel):
     }
 
 
+class GetSourcesRequest(BaseModel):
+    collectionName: str
+    offset: Optional[int] = 0
+    limit: Optional[int] = 50
+    includeChunks: Optional[bool] = False  # add each source's `chunkIds`
+
+
+class GetSourcesResponse(BaseModel):
+    success: bool
+    message: str
+    data: dict
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "message": "Returned 1 of 120 source(s)",
+                    "success": True,
+                    "data": {
+                        "total": 120,
+                        "offset": 0,
+                        "sources": [
+                            {
+                                "id": "document-id",
+                                "name": "document-name",
+                                "description": "Some description.",
+                            }
+                        ],
+                    },
+                }
+            ]
+        }
+    }
+
+
 class GetDocumentChunksRequest(BaseModel):
     collectionId: str
     documentId: str
@@ -550,11 +837,14 @@ class FileExploreResponse(BaseModel):
 class DeleteDocumentsRequest(BaseModel):
     collection_id: str
     document_ids: List[str]
+    # Run as a background job. By default only large deletions do.
+    background: Optional[bool] = None
 
 
 class DeleteDocumentsResponse(BaseModel):
     success: bool
     message: str
+    data: Optional[dict] = None  # the deletion job, when run in the background
 
     model_config = {
         "json_schema_extra": {
@@ -901,6 +1191,7 @@ class LoadedTextModelResData(BaseModel):
     mode: str = None
     modelSettings: LoadTextInferenceInit
     generateSettings: LoadTextInferenceCall
+    pool: Optional[dict] = None  # all resident models and the memory budget
 
 
 class LoadedTextModelResponse(BaseModel):
@@ -912,3 +1203,7 @@ class LoadedTextModelResponse(BaseModel):
 class ContextRetrievalOptions(BaseModel):
     response_mode: Optional[str] = None
     similarity_top_k: Optional[int] = None
+    search_mode: Optional[str] = None
+    fusion_mode: Optional[str] = None
+    retrieval_timeout: Optional[float] = None
+    rerank_budget_ms: Optional[float] = None
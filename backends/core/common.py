@@ -3,24 +3,15 @@ import sys
 import os
 import json
 import glob
-import httpx
+import asyncio
 import subprocess
 from typing import Any, List, Optional, Tuple
 from core.classes import (
     CHAT_MODES,
-    InstalledTextModelMetadata,
-    InstalledTextModel,
     ModelConfig,
     DEFAULT_CHAT_MODE,
     DEFAULT_CONTEXT_WINDOW,
 )
-from huggingface_hub import (
-    scan_cache_dir,
-    try_to_load_from_cache,
-    _CACHED_NO_EXIST,
-    HFCacheInfo,
-    CachedFileInfo,
-)
 
 
 # Pass relative string to get absolute path
@@ -53,7 +44,6 @@ TOOL_FUNCS_PATH = os.path.join(TOOL_PATH, TOOL_FUNCS_FOLDER)
 MODEL_METADATAS_FILEPATH = os.path.join(APP_SETTINGS_PATH, MODEL_METADATAS_FILENAME)
 TEXT_MODELS_CACHE_DIR = "text_models"
 INSTALLED_TEXT_MODELS = "installed_text_models"  # key in json file
-DEFAULT_SETTINGS_DICT = {"current_download_path": "", INSTALLED_TEXT_MODELS: []}
 DEFAULT_MAX_TOKENS = 128
 
 
@@ -138,72 +128,34 @@ def file_explore(path: str):
 
 async def get_file_from_url(url: str, pathname: str, app):
     # example url: https://raw.githubusercontent.com/dieharders/ai-text-server/master/README.md
-    client: httpx.Client = app.requests_client
+    client = app.requests_client  # core.http_client.HttpClient
     CHUNK_SIZE = 1024 * 1024  # 1mb
     TOO_LONG = 751619276  # about 700mb limit in "bytes"
     headers = {
         "Content-Type": "application/octet-stream",
     }
-    head_res = client.head(url)
-    total_file_size = head_res.headers.get("content-length")
-    if int(total_file_size) > TOO_LONG:
-        raise Exception("File is too large")
     # Stream binary content
-    with client.stream("GET", url, headers=headers) as res:
-        res.raise_for_status()
-        if res.status_code != httpx.codes.OK:
-            raise Exception("Something went wrong fetching file")
-        if int(res.headers["Content-Length"]) > TOO_LONG:
+    async with client.stream("GET", url, headers=headers) as res:
+        if int(res.headers.get("Content-Length") or 0) > TOO_LONG:
             raise Exception("File is too large")
-        with open(pathname, "wb") as file:
-            # Write data to disk
-            for block in res.iter_bytes(chunk_size=CHUNK_SIZE):
-                file.write(block)
+        # Disk writes run off the event loop
+        file = await asyncio.to_thread(open, pathname, "wb")
+        try:
+            size = 0
+            async for block in res.aiter_bytes(chunk_size=CHUNK_SIZE):
+                size += len(block)
+                # Servers may not send a length up front
+                if size > TOO_LONG:
+                    raise Exception("File is too large")
+                await asyncio.to_thread(file.write, block)
+        except BaseException:
+            await asyncio.to_thread(file.close)
+            os.remove(pathname)
+            raise
+        await asyncio.to_thread(file.close)
     return True
 
 
-def check_cached_file_exists(cache_dir: str, repo_id: str, filename: str):
-    filepath = try_to_load_from_cache(
-        cache_dir=cache_dir, repo_id=repo_id, filename=filename
-    )
-    if isinstance(filepath, str):
-        # file exists and is cached
-        print(f"{PRNT_API} File exists: {filepath}", flush=True)
-    elif filepath is _CACHED_NO_EXIST:
-        # non-existence of file is cached
-        err = "File non-existence has been recorded."
-        print(f"{PRNT_API} {err}", flush=True)
-        raise Exception(err)
-    else:
-        # file is not cached
-        err = "File not cached."
-        print(f"{PRNT_API} {err}", flush=True)
-        raise Exception(err)
-
-
-# Find the specified model repo and return all revisions
-def scan_cached_repo(cache_dir: str, repo_id: str) -> Tuple[HFCacheInfo, list]:
-    # Pass nothing to scan the default dir
-    model_cache_info = scan_cache_dir(cache_dir)
-    repos = model_cache_info.repos
-    repoIndex = next(
-        (x for x, info in enumerate(repos) if info.repo_id == repo_id), None
-    )
-    target_repo = list(repos)[repoIndex]
-    repo_revisions = list(target_repo.revisions)
-    return [model_cache_info, repo_revisions]
-
-
-def get_cached_blob_path(repo_revisions: list, filename: str):
-    for r in repo_revisions:
-        files: List[CachedFileInfo] = list(r.files)
-        for file in files:
-            if file.file_name == filename:
-                # CachedFileInfo: file.blob_path same as -> file.file_path.resolve()
-                actual_path = str(file.blob_path)
-                return actual_path
-
-
 # Determine if the input string is acceptable as an id
 def check_valid_id(input: str):
     l = len(input)
@@ -275,111 +227,6 @@ def parse_valid_tags(tags: str):
         return None
 
 
-class SaveTextModelRequestArgs(dict):
-    repoId: str
-    savePath: Optional[dict] = {}
-    isFavorited: Optional[bool] = False
-    numTimesRun: Optional[int] = 0
-
-
-# Index the path of the downloaded model in a file
-def save_text_model(data: SaveTextModelRequestArgs):
-    repo_id = data["repoId"]
-    folderpath = APP_SETTINGS_PATH
-    filepath = MODEL_METADATAS_FILEPATH
-    existing_data = DEFAULT_SETTINGS_DICT
-
-    try:
-        # Create folder
-        if not os.path.exists(folderpath):
-            os.makedirs(folderpath)
-        # Try to open the file (if it exists)
-        with open(filepath, "r") as file:
-            existing_data = json.load(file)
-    except (Exception, FileNotFoundError):
-        # If the file doesn't exist yet, create an empty dictionary
-        existing_data = DEFAULT_SETTINGS_DICT
-
-    # Update the existing data with the new variables
-    models_list: List = existing_data[INSTALLED_TEXT_MODELS]
-    modelIndex = next(
-        (x for x, item in enumerate(models_list) if item["repoId"] == repo_id), None
-    )
-    if modelIndex is None:
-        # Assign new data
-        new_data = data
-        new_data["savePath"] = {}
-        new_data["numTimesRun"] = 0
-        new_data["isFavorited"] = False
-        models_list.append(data)
-    else:
-        model = models_list[modelIndex]
-        # Assign updated data
-        for key, val in data.items():
-            if key == "savePath":
-                new_save_paths: dict = data[key]
-                prev_save_paths: dict = model[key]
-                model[key] = {
-                    **prev_save_paths,
-                    **new_save_paths,
-                }
-            else:
-                model[key] = val
-        models_list[modelIndex] = model
-
-    # Save the updated data to the file, this will overwrite all values in the key's dict.
-    with open(filepath, "w") as file:
-        json.dump(existing_data, file, indent=2)
-    return existing_data
-
-
-# Deletes all files associated with a revision (model)
-def delete_text_model_revisions(repo_id: str):
-    filepath = MODEL_METADATAS_FILEPATH
-
-    try:
-        # Try to open the file (if it exists)
-        with open(filepath, "r") as file:
-            metadata = json.load(file)
-        # Remove model entry from metadata
-        models_list: List = metadata[INSTALLED_TEXT_MODELS]
-        modelIndex = next(
-            (x for x, item in enumerate(models_list) if item["repoId"] == repo_id), None
-        )
-        del models_list[modelIndex]
-        # Save updated metadata
-        with open(filepath, "w") as file:
-            json.dump(metadata, file, indent=2)
-    except FileNotFoundError:
-        print(f"{PRNT_API} File not found.", flush=True)
-    except json.JSONDecodeError:
-        print(f"{PRNT_API} JSON parsing error.", flush=True)
-
-
-# Delete a single (quant) file for the model
-def delete_text_model(filename: str, repo_id: str):
-    filepath = MODEL_METADATAS_FILEPATH
-
-    try:
-        # Try to open the file (if it exists)
-        with open(filepath, "r") as file:
-            metadata = json.load(file)
-        # Remove model entry from metadata
-        models_list: List = metadata[INSTALLED_TEXT_MODELS]
-        modelIndex = next(
-            (x for x, item in enumerate(models_list) if item["repoId"] == repo_id), None
-        )
-        model = models_list[modelIndex]
-        del model["savePath"][filename]
-        # Save updated metadata
-        with open(filepath, "w") as file:
-            json.dump(metadata, file, indent=2)
-    except FileNotFoundError:
-        print(f"{PRNT_API} File not found.", flush=True)
-    except json.JSONDecodeError:
-        print(f"{PRNT_API} JSON parsing error.", flush=True)
-
-
 def delete_vector_store(target_file_path: str, folder_path):
     path_to_delete = os.path.join(folder_path, target_file_path)
     if os.path.exists(path_to_delete):
@@ -531,21 +378,6 @@ def save_settings_file(folderpath: str, filepath: str, data: dict):
     return existing_data
 
 
-# Return metadata for the currently loaded model
-def get_model_metadata(
-    id: str, folderpath: str, filepath: str
-) -> InstalledTextModelMetadata:
-    metadata = {}
-    # Gets all installation metadata
-    settings: InstalledTextModel = get_settings_file(folderpath, filepath)
-    models = settings[INSTALLED_TEXT_MODELS]
-    for item in models:
-        if item["repoId"] == id:
-            metadata = item
-            break
-    return metadata
-
-
 # Gets the llm model configuration data
 def get_model_config(id: str, folderpath, filepath) -> ModelConfig:
     configs = get_settings_file(folderpath, filepath)
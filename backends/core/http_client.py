@@ -0,0 +1,73 @@
+###
+# The app's shared async http client. Connections are pooled and kept alive across
+# requests, each host gets a bounded number of concurrent requests so fetching many
+# urls from one site does not overwhelm it, and failed connections or busy servers
+# are retried with backoff.
+###
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+import httpx
+
+DEFAULT_MAX_CONNECTIONS = 32
+DEFAULT_MAX_PER_HOST = 4  # concurrent requests to one host
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF = 0.5  # seconds, doubled after each attempt
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+DEFAULT_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+
+
+class HttpClient:
+    def __init__(
+        self,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        max_per_host: int = DEFAULT_MAX_PER_HOST,
+        retries: int = DEFAULT_RETRIES,
+    ):
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=DEFAULT_TIMEOUT,
+            follow_redirects=True,
+        )
+        self._hosts: Dict[str, asyncio.Semaphore] = {}
+
+    # Send a request and stream its response, retrying until the body starts arriving
+    @asynccontextmanager
+    async def stream(
+        self, method: str, url: str, **kwargs
+    ) -> AsyncIterator[httpx.Response]:
+        host = httpx.URL(url).host
+        limit = self._hosts.setdefault(host, asyncio.Semaphore(self.max_per_host))
+        async with limit:
+            for attempt in range(self.retries + 1):
+                delay = RETRY_BACKOFF * 2**attempt
+                request = self.client.build_request(method, url, **kwargs)
+                try:
+                    res = await self.client.send(request, stream=True)
+                except httpx.TransportError:
+                    if attempt == self.retries:
+                        raise
+                    await asyncio.sleep(delay)
+                    continue
+                if res.status_code in RETRY_STATUS_CODES and attempt < self.retries:
+                    await res.aclose()
+                    # Honor the server's wait when it gives one in seconds
+                    retry_after = res.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = int(retry_after)
+                    await asyncio.sleep(delay)
+                    continue
+                break
+            try:
+                res.raise_for_status()
+                yield res
+            finally:
+                await res.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
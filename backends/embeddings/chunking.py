@@ -1,10 +1,23 @@
 import os
+import hashlib
 from nanoid import generate as generate_uuid
 from datetime import datetime, timezone
 from typing import List, Tuple
 from llama_index.core import Document
-from llama_index.core.schema import IndexNode, TextNode
+from llama_index.core.schema import BaseNode, IndexNode, MetadataMode, TextNode
 from core import common
+from .text_splitters import markdown_heading_split, markdown_document_split
+
+CHUNKING_STRATEGIES = {
+    "MARKDOWN_HEADING_SPLIT": markdown_heading_split,
+    "MARKDOWN_DOCUMENT_SPLIT": markdown_document_split,
+}
+
+
+# Hash of the text a chunk is embedded with. Chunks with equal hashes share an embedding.
+def chunk_hash(node: BaseNode) -> str:
+    content = node.get_content(metadata_mode=MetadataMode.EMBED)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
 
 
 # Chunks are created from each document and will inherit their metadata
@@ -16,6 +29,15 @@ def chunks_from_documents(
 
     for doc in documents:
         source_id = source_record.get("id")
+        # Keys hidden from the LLM and the embedding, built once per document
+        page = doc.metadata.get("page")
+        excluded_llm_keys = [*doc.excluded_llm_metadata_keys, "order"]
+        excluded_embed_keys = [*doc.excluded_embed_metadata_keys, "order"]
+        if page:
+            excluded_embed_keys.append("page")
+        # Without duplicates, in their original order
+        excluded_llm_metadata_keys = list(dict.fromkeys(excluded_llm_keys))
+        excluded_embed_metadata_keys = list(dict.fromkeys(excluded_embed_keys))
         # Set metadata on each chunk node
         for chunk_ind, parsed_node in enumerate(parsed_nodes):
             # Create metadata for chunk
@@ -26,11 +48,9 @@ def chunks_from_documents(
                 # tags="", # @TODO Ai generate based on chunk's description
                 # name="", # @TODO Ai generate based on chunk's text description above
             )
-            # Set metadatas
-            excluded_llm_metadata_keys = doc.excluded_llm_metadata_keys
-            excluded_llm_metadata_keys.append("order")
-            excluded_embed_metadata_keys = doc.excluded_embed_metadata_keys
-            excluded_embed_metadata_keys.append("order")
+            # Documents loaded page by page tell the LLM where a chunk came from
+            if page:
+                chunk_metadata["page"] = page
             # Create chunk
             chunk_node = IndexNode(
                 id_=generate_uuid(),
@@ -38,9 +58,9 @@ def chunks_from_documents(
                 index_id=str(source_id),
                 metadata=chunk_metadata,
             )
-            # Tell query engine to ignore these metadata keys
-            chunk_node.excluded_llm_metadata_keys = excluded_llm_metadata_keys
-            chunk_node.excluded_embed_metadata_keys = excluded_embed_metadata_keys
+            # Tell query engine to ignore these metadata keys, each node owns its lists
+            chunk_node.excluded_llm_metadata_keys = list(excluded_llm_metadata_keys)
+            chunk_node.excluded_embed_metadata_keys = list(excluded_embed_metadata_keys)
             # Once your metadata is converted into a string using metadata_seperator
             # and metadata_template, the metadata_templates controls what that metadata
             # looks like when joined with the text content
@@ -96,3 +116,66 @@ def create_source_record(document: Document) -> dict:
     # Return result
     print(f"{common.PRNT_EMBED} Created document record:\n{source_record}", flush=True)
     return source_record
+
+
+# Split each source document into chunks. Returns a (source record, chunks) pair per document.
+def chunk_documents(
+    documents: List[Document],
+    chunk_size: int = None,
+    chunk_overlap: int = None,
+    chunk_strategy: str = None,
+) -> List[Tuple[dict, List[IndexNode]]]:
+    chunk_size = chunk_size or 300
+    chunk_overlap = chunk_overlap or 0
+    chunk_strategy = chunk_strategy or list(CHUNKING_STRATEGIES.keys())[0]
+    text_splitter = CHUNKING_STRATEGIES[chunk_strategy]
+    results = []
+    for document in documents:
+        # Create source document records for Collection metadata
+        source_record = create_source_record(document=document)
+        # Split document texts
+        splitter = text_splitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+        )
+        # Build chunks
+        print(f"{common.PRNT_EMBED} Chunking text...", flush=True)
+        parsed_nodes = splitter.get_nodes_from_documents(
+            documents=[document],  # pass list of files (in Document format)
+            show_progress=True,
+        )
+        [chunks_ids, chunk_nodes] = chunks_from_documents(
+            source_record=source_record,
+            parsed_nodes=parsed_nodes,  # pass in text nodes to return as chunks
+            documents=[document],
+        )
+        # Record the ids of each chunk
+        source_record["chunkIds"] = chunks_ids
+        results.append((source_record, chunk_nodes))
+    return results
+
+
+# Split a window of page documents from one source into chunks, each tagged with its page.
+# Chunks are numbered from 0, the caller renumbers `order` across windows.
+def chunk_pages(
+    documents: List[Document],
+    source_id: str,
+    chunk_size: int = None,
+    chunk_overlap: int = None,
+    chunk_strategy: str = None,
+) -> List[IndexNode]:
+    chunk_strategy = chunk_strategy or list(CHUNKING_STRATEGIES.keys())[0]
+    splitter = CHUNKING_STRATEGIES[chunk_strategy](
+        chunk_size=chunk_size or 300,
+        chunk_overlap=chunk_overlap or 0,
+    )
+    chunk_nodes = []
+    for document in documents:
+        parsed_nodes = splitter.get_nodes_from_documents(documents=[document])
+        [_, page_chunks] = chunks_from_documents(
+            documents=[document],
+            parsed_nodes=parsed_nodes,
+            source_record={"id": source_id},
+        )
+        chunk_nodes.extend(page_chunks)
+    return chunk_nodes
@@ -0,0 +1,127 @@
+###
+# Content-addressed cache of embeddings on local disk. Vectors are keyed by a hash
+# of the embedded text, the embed model and the prompt type, so re-ingesting a
+# document only embeds the chunks whose text actually changed.
+# Stored as float16 in SQLite with least-recently-used eviction past a size cap.
+###
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from typing import Dict, List
+import numpy as np
+from core import common
+
+EMBED_CACHE_PATH = common.app_path("embed_cache")
+EMBED_CACHE_FILE = "embeddings.sqlite3"
+DEFAULT_EMBED_CACHE_MAX_MB = 512
+EVICT_TO_RATIO = 0.9  # evict down to this fraction of the cap to avoid churn
+
+
+# Key for a piece of text embedded by a given model
+def make_key(text: str, model_name: str, prompt_name: str) -> str:
+    normalized = unicodedata.normalize("NFC", text).strip()
+    content = "\x00".join([model_name, prompt_name, normalized])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str = EMBED_CACHE_PATH, max_bytes: int = 0):
+        self.max_bytes = max_bytes or DEFAULT_EMBED_CACHE_MAX_MB * 1024**2
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(path, EMBED_CACHE_FILE), check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)"
+        )
+        self._db.commit()
+        row = self._db.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        self.used_bytes = row[0]
+
+    # Return the cached vectors for whichever keys exist
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        if not keys:
+            return found
+        with self._lock:
+            # Stay under SQLite's bound parameter limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                marks = ",".join("?" * len(batch))
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({marks})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float16)
+                    found[key] = vector.astype(np.float32).tolist()
+            if found:
+                now = time.time()
+                self._db.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._db.commit()
+        return found
+
+    def put_many(self, vectors: Dict[str, List[float]]):
+        if not vectors:
+            return
+        now = time.time()
+        with self._lock:
+            existing = set()
+            keys = list(vectors.keys())
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                marks = ",".join("?" * len(batch))
+                rows = self._db.execute(
+                    f"SELECT key FROM embeddings WHERE key IN ({marks})", batch
+                ).fetchall()
+                existing.update(row[0] for row in rows)
+            rows = [
+                (key, np.asarray(vector, dtype=np.float16).tobytes(), now)
+                for key, vector in vectors.items()
+                if key not in existing
+            ]
+            self._db.executemany(
+                "INSERT INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+            self.used_bytes += sum(len(row[1]) for row in rows)
+            if self.used_bytes > self.max_bytes:
+                self._evict()
+
+    # Drop least recently used vectors until under the size cap
+    def _evict(self):
+        target = int(self.max_bytes * EVICT_TO_RATIO)
+        rows = self._db.execute(
+            "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used ASC"
+        )
+        evict = []
+        used = self.used_bytes
+        for key, size in rows:
+            if used <= target:
+                break
+            evict.append((key,))
+            used -= size
+        self._db.executemany("DELETE FROM embeddings WHERE key = ?", evict)
+        self._db.commit()
+        self.used_bytes = used
+        print(
+            f"{common.PRNT_EMBED} Evicted {len(evict)} cached embeddings.", flush=True
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,223 @@
+###
+# One shared embedding model for the whole app. Embedding calls from concurrent
+# ingestions and RAG queries are coalesced into micro-batches on a worker thread.
+# Large requests are split into batches and queries jump ahead of them, so bulk
+# ingestion keeps the model busy while query latency stays bounded.
+###
+import queue
+import asyncio
+import threading
+import time
+from itertools import count
+from concurrent.futures import Future
+from typing import List, Optional
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from core import common
+from .embed_cache import EmbeddingCache, make_key
+
+DEFAULT_MAX_BATCH_SIZE = 64  # texts per forward pass
+DEFAULT_MAX_WAIT_MS = 5  # how long a batch stays open for more texts
+QUERY = "query"  # sentence-transformers prompt names used by HuggingFaceEmbedding
+TEXT = "text"
+QUERY_PRIORITY = 0  # lower is served first
+TEXT_PRIORITY = 1
+STOP_PRIORITY = 2  # finish queued work before stopping
+
+
+class EmbedJob:
+    def __init__(self, texts: List[str], prompt_name: str):
+        self.texts = texts
+        self.prompt_name = prompt_name
+        self.future: Future = Future()
+
+
+class EmbeddingService:
+    def __init__(
+        self,
+        model_name: str,
+        cache_folder: str,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait_ms: int = DEFAULT_MAX_WAIT_MS,
+    ):
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.model = HuggingFaceEmbedding(
+            model_name=model_name,
+            cache_folder=cache_folder,
+            embed_batch_size=max_batch_size,
+        )
+        self._jobs: queue.PriorityQueue = queue.PriorityQueue()
+        self._seq = count()
+        self._thread = threading.Thread(
+            target=self._run, name="embedding-service", daemon=True
+        )
+        self._thread.start()
+        print(f"{common.PRNT_EMBED} Embedding service using {model_name}", flush=True)
+
+    # Queue texts for embedding, safe to call from any thread
+    def submit(self, texts: List[str], prompt_name: str = TEXT) -> Future:
+        result: Future = Future()
+        if not texts:
+            result.set_result([])
+            return result
+        priority = QUERY_PRIORITY if prompt_name == QUERY else TEXT_PRIORITY
+        # Split large requests so queries can be served between their batches
+        jobs = [
+            EmbedJob(texts[i : i + self.max_batch_size], prompt_name)
+            for i in range(0, len(texts), self.max_batch_size)
+        ]
+
+        # Called on the worker thread as each piece completes
+        def on_done(_):
+            if result.done() or not all(job.future.done() for job in jobs):
+                return
+            for job in jobs:
+                if job.future.exception():
+                    result.set_exception(job.future.exception())
+                    return
+            result.set_result([e for job in jobs for e in job.future.result()])
+
+        for job in jobs:
+            job.future.add_done_callback(on_done)
+            self._jobs.put((priority, next(self._seq), job))
+        return result
+
+    def embed(self, texts: List[str], prompt_name: str = TEXT) -> List[Embedding]:
+        return self.submit(texts, prompt_name).result()
+
+    def shutdown(self):
+        self._jobs.put((STOP_PRIORITY, next(self._seq), None))
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            _, _, job = self._jobs.get()
+            if job is None:
+                return
+            jobs = [job]
+            size = len(job.texts)
+            # Keep the batch open briefly so concurrent callers can join it
+            deadline = time.monotonic() + self.max_wait
+            stop = False
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    _, _, next_job = self._jobs.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if next_job is None:
+                    stop = True
+                    break
+                jobs.append(next_job)
+                size += len(next_job.texts)
+            for prompt_name in (QUERY, TEXT):
+                self._embed_jobs([j for j in jobs if j.prompt_name == prompt_name])
+            if stop:
+                return
+
+    # Embed several callers' texts in one pass and hand each its slice back
+    def _embed_jobs(self, jobs: List[EmbedJob]):
+        if not jobs:
+            return
+        texts = [text for job in jobs for text in job.texts]
+        try:
+            embeddings = self.model._embed(texts, prompt_name=jobs[0].prompt_name)
+        except Exception as err:
+            for job in jobs:
+                job.future.set_exception(err)
+            return
+        start = 0
+        for job in jobs:
+            end = start + len(job.texts)
+            job.future.set_result(embeddings[start:end])
+            start = end
+
+
+# LlamaIndex embedding that forwards every call to the shared service,
+# answering from the (optional) embedding cache first
+class ServiceEmbedding(BaseEmbedding):
+    _service: EmbeddingService = PrivateAttr()
+    _cache: Optional[EmbeddingCache] = PrivateAttr()
+
+    def __init__(
+        self,
+        service: EmbeddingService,
+        cache: Optional[EmbeddingCache] = None,
+        **kwargs,
+    ):
+        super().__init__(
+            model_name=service.model_name,
+            # Hand whole documents to the service, it decides the batch size
+            embed_batch_size=2048,
+            **kwargs,
+        )
+        self._service = service
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ServiceEmbedding"
+
+    @property
+    def service(self) -> EmbeddingService:
+        return self._service
+
+    @property
+    def cache(self) -> Optional[EmbeddingCache]:
+        return self._cache
+
+    # Look up cached vectors and submit only the misses
+    def _submit(self, texts: List[str], prompt_name: str) -> Future:
+        if not self._cache:
+            return self._service.submit(texts, prompt_name=prompt_name)
+        keys = [make_key(t, self.model_name, prompt_name) for t in texts]
+        cached = self._cache.get_many(keys)
+        misses = [i for i, key in enumerate(keys) if key not in cached]
+        result: Future = Future()
+
+        def on_done(future: Future):
+            if future.exception():
+                result.set_exception(future.exception())
+                return
+            computed = dict(zip([keys[i] for i in misses], future.result()))
+            self._cache.put_many(computed)
+            result.set_result([cached.get(key) or computed[key] for key in keys])
+
+        self._service.submit([texts[i] for i in misses], prompt_name).add_done_callback(
+            on_done
+        )
+        return result
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._submit([query], prompt_name=QUERY).result()[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._submit([text], prompt_name=TEXT).result()[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._submit(texts, prompt_name=TEXT).result()
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        future = self._submit([query], prompt_name=QUERY)
+        return (await asyncio.wrap_future(future))[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        future = self._submit([text], prompt_name=TEXT)
+        return (await asyncio.wrap_future(future))[0]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        future = self._submit(texts, prompt_name=TEXT)
+        return await asyncio.wrap_future(future)
+
+
+# Stop the embedding worker, if one was started
+def shutdown_embedding_service(embed_model: Optional[BaseEmbedding]):
+    if isinstance(embed_model, ServiceEmbedding):
+        embed_model.service.shutdown()
+        if embed_model.cache:
+            embed_model.cache.close()
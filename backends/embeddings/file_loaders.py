@@ -1,5 +1,4 @@
 import os
-import httpx
 from typing import List, Optional
 from pathlib import Path
 from dotenv import load_dotenv
@@ -17,6 +16,7 @@ from llama_index.readers.file import (
 )
 from llama_parse import LlamaParse
 from core import classes, common
+from .file_parsers import process_documents
 
 ###########
 # METHODS #
@@ -124,6 +124,46 @@ def simple_pdf_loader(
     return document_results
 
 
+def pdf_page_count(path: str) -> int:
+    import fitz  # PyMuPDF, same dependency as PyMuPDFReader
+
+    with fitz.open(path) as pdf:
+        return pdf.page_count
+
+
+# Yield (page number, text) for pages [start, end) without loading the rest of the file
+def iter_pdf_pages(path: str, start: int = 0, end: Optional[int] = None):
+    import fitz
+
+    with fitz.open(path) as pdf:
+        end = pdf.page_count if end is None else min(end, pdf.page_count)
+        for index in range(start, end):
+            yield index + 1, pdf.load_page(index).get_text()
+
+
+# One Document per page in the window [start, end) so chunks keep their page number
+def pdf_window_loader(
+    path: str,
+    start: int,
+    end: int,
+    source_id: str,
+    source_metadata: dict,
+) -> List[Document]:
+    document_results: List[Document] = []
+    for page, text in iter_pdf_pages(path, start, end):
+        source_doc = create_source_document(
+            text=text,
+            source_id=source_id,
+            metadata={"page": page, **source_metadata},
+        )
+        source_doc = set_ignored_metadata(
+            source_document=source_doc,
+            ignore_metadata=source_metadata,
+        )
+        document_results.append(source_doc)
+    return document_results
+
+
 # https://github.com/run-llama/llama_index/tree/40913847ba47d435b40b7fac3ae83eba89b56bb9/llama-index-integrations/readers/llama-index-readers-file/llama_index/readers/file/docs
 def ms_doc_loader(
     sources: str,
@@ -406,7 +446,7 @@ async def llama_parse_loader(
 
 # Free, no api key required
 # https://jina.ai/reader/#apiform
-def jina_reader_loader(
+async def jina_reader_loader(
     app: dict,
     sources: List[str],
     source_id: str,
@@ -421,13 +461,12 @@ def jina_reader_loader(
             "Accept": "text/event-stream",
             "Content-Type": "application/octet-stream",
         }
-        client: httpx.Client = app.requests_client
+        client = app.requests_client  # core.http_client.HttpClient
         text = ""
-        with client.stream(method="GET", url=req_url, headers=headers) as res:
-            res.raise_for_status()
+        async with client.stream(method="GET", url=req_url, headers=headers) as res:
             if res.status_code == 200:
                 # Write data
-                res.read()
+                await res.aread()
                 text = res.text
             else:
                 raise Exception("Something went wrong reading data.")
@@ -476,29 +515,29 @@ async def documents_from_sources(
         match file_extension:
             case "mdx" | "md" | "json" | "txt":
                 # Regular text file
-                documents = simple_file_loader(**payload)
+                loaded = simple_file_loader(**payload)
             case "doc" | "docx":
-                documents = ms_doc_loader(**payload)
+                loaded = ms_doc_loader(**payload)
             case "rtf":
-                documents = rtf_loader(**payload)
+                loaded = rtf_loader(**payload)
             case "csv":
-                documents = csv_loader(**payload)
+                loaded = csv_loader(**payload)
             case "xml":
-                documents = xml_loader(**payload)
+                loaded = xml_loader(**payload)
             case "pptx":
-                documents = pptx_slides_loader(**payload)
+                loaded = pptx_slides_loader(**payload)
             case "png" | "jpg" | "jpeg" | "gif":
-                documents = simple_image_loader(**payload)
+                loaded = simple_image_loader(**payload)
             case "mp4" | "mp3":
-                documents = simple_audio_video_loader(**payload)
+                loaded = simple_audio_video_loader(**payload)
             case "pdf":
                 # PDF file
                 match (parsing_method):
                     case classes.FILE_LOADER_SOLUTIONS.LLAMA_PARSE.value:
-                        documents = await llama_parse_loader(**payload)
+                        loaded = await llama_parse_loader(**payload)
                     case _:
                         # default
-                        documents = simple_pdf_loader(**payload)
+                        loaded = simple_pdf_loader(**payload)
             case _:
                 is_url = source[:4] == "http"
                 # Read from website using service
@@ -506,7 +545,7 @@ async def documents_from_sources(
                     is_url
                     and parsing_method == classes.FILE_LOADER_SOLUTIONS.READER.value
                 ):
-                    documents = jina_reader_loader(
+                    loaded = await jina_reader_loader(
                         app=app,
                         **payload,
                     )
@@ -515,5 +554,50 @@ async def documents_from_sources(
                     raise Exception(
                         f"The supplied file/url is not currently supported: {source}"
                     )
+        documents.extend(loaded)
     # Return list of Documents
     return documents
+
+
+# Metadata every document (and its chunks) inherits from the source file
+def create_source_metadata(input_file: dict, form: dict) -> dict:
+    source_file_path: str = input_file.get("path_to_file")
+    file_size = 0
+    if os.path.isfile(source_file_path):
+        file_size = os.path.getsize(source_file_path)
+    return dict(
+        name=form["document_name"],
+        description=form["description"],
+        checksum=input_file.get("checksum"),
+        fileName=input_file.get("file_name"),
+        filePath=source_file_path,
+        fileSize=file_size,
+        tags=form["tags"],
+    )
+
+
+# Create nodes from a single source Document
+async def create_index_nodes(
+    app: dict,
+    input_file: dict,
+    form: dict,
+) -> List[Document]:
+    print(f"{common.PRNT_EMBED} Creating nodes...", flush=True)
+    source_file_path: str = input_file.get("path_to_file")
+    document_id: str = form["document_id"]
+    parsing_method: str = form["parsing_method"]
+    # Read in source files and build documents
+    source_paths = [source_file_path]
+    source_metadata = create_source_metadata(input_file=input_file, form=form)
+    file_nodes = await documents_from_sources(
+        app=app,
+        sources=source_paths,
+        source_id=document_id,
+        source_metadata=source_metadata,
+        parsing_method=parsing_method,
+    )
+    # Optional step, Post-Process source text for optimal embedding/retrieval for LLM
+    is_dirty = False  # @TODO Have `documents_from_sources` determine when docs are already processed
+    if is_dirty:
+        file_nodes = process_documents(nodes=file_nodes)
+    return file_nodes
@@ -0,0 +1,594 @@
+###
+# Durable background ingestion. Each uploaded document becomes a job row in SQLite
+# so it survives restarts and the client can poll its progress. Parsing and
+# chunking run in a process pool to keep the API process responsive, embedding
+# goes through the shared embedding service and chunks are written to Chroma in
+# batches from the API process. Large deletions run through the same queue.
+###
+import os
+import json
+import time
+import sqlite3
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional, Tuple
+from nanoid import generate as generate_uuid
+from core import common
+from .main import define_embedding_model, invalidate_index
+from .storage import (
+    get_vector_db_client,
+    get_sources_from_ids,
+    get_chunk_hashes,
+    add_chunks_to_collection,
+    update_chunks_metadata,
+    update_collection_sources,
+    delete_sources,
+    delete_source_files,
+    get_lexical_index,
+    to_lexical_rows,
+)
+from .chunking import chunk_hash
+from .ingest_worker import (
+    PDF_PAGE_WINDOW,
+    parse_and_chunk,
+    is_paged_pdf,
+    create_pdf_source_record,
+    chunk_pdf_window,
+)
+
+JOBS_PATH = common.app_path("ingest_jobs")
+JOBS_FILE = "jobs.sqlite3"
+DEFAULT_INGEST_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+EMBED_BATCH_SIZE = 256  # chunks written to the collection per progress update
+DELETE_BATCH_SIZE = 100  # sources removed per progress update
+DEFAULT_JOB_RETENTION_DAYS = 7  # finished jobs are forgotten after this long
+
+# Kinds of job
+INGEST = "ingest"
+DELETE = "delete"
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Stages of a running job
+PARSING = "parsing"
+EMBEDDING = "embedding"
+DELETING = "deleting"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobStore:
+    def __init__(self, path: str = JOBS_PATH):
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(path, JOBS_FILE), check_same_thread=False
+        )
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                collection_name TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                document_name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                progress REAL NOT NULL DEFAULT 0,
+                total_chunks INTEGER NOT NULL DEFAULT 0,
+                embedded_chunks INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                kind TEXT NOT NULL DEFAULT 'ingest'
+            )""")
+        # Job tables created before deletion jobs existed
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(jobs)")]
+        if "kind" not in columns:
+            self._db.execute(
+                "ALTER TABLE jobs ADD COLUMN kind TEXT NOT NULL DEFAULT 'ingest'"
+            )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created_at)"
+        )
+        self._db.commit()
+
+    def create(self, input_file: dict, form: dict) -> dict:
+        return self.create_many([(input_file, form)])[0]
+
+    # Insert several jobs in one transaction
+    def create_many(self, items: List[Tuple[dict, dict]]) -> List[dict]:
+        now = time.time()
+        rows = []
+        for input_file, form in items:
+            payload = json.dumps({"input_file": input_file, "form": form})
+            rows.append(
+                (
+                    generate_uuid(),
+                    form["collection_name"],
+                    form["document_id"],
+                    form["document_name"],
+                    QUEUED,
+                    payload,
+                    now,
+                    now,
+                )
+            )
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO jobs (id, collection_name, document_id, document_name, status, payload, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+        return [self.get(row[0]) for row in rows]
+
+    # A job that removes the given sources and their chunks from a collection
+    def create_deletion(
+        self, collection_name: str, source_ids: List[str], total_chunks: int
+    ) -> dict:
+        now = time.time()
+        job_id = generate_uuid()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, kind, collection_name, document_id, document_name, status, total_chunks, payload, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    DELETE,
+                    collection_name,
+                    ",".join(source_ids),
+                    f"{len(source_ids)} document(s)",
+                    QUEUED,
+                    total_chunks,
+                    json.dumps({"source_ids": source_ids}),
+                    now,
+                    now,
+                ),
+            )
+            self._db.commit()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def list(self, collection_name: str = None, status: str = None) -> List[dict]:
+        query = "SELECT * FROM jobs WHERE 1 = 1"
+        args = []
+        if collection_name:
+            query += " AND collection_name = ?"
+            args.append(collection_name)
+        if status:
+            query += " AND status = ?"
+            args.append(status)
+        query += " ORDER BY created_at DESC"
+        with self._lock:
+            rows = self._db.execute(query, args).fetchall()
+        return [dict(row) for row in rows]
+
+    def update(self, job_id: str, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        with self._lock:
+            self._db.execute(
+                f"UPDATE jobs SET {columns} WHERE id = ?",
+                [*fields.values(), job_id],
+            )
+            self._db.commit()
+
+    # Atomically move the oldest queued job to running
+    def claim_next(self) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created_at ASC LIMIT 1",
+                (QUEUED,),
+            ).fetchone()
+            if not row:
+                return None
+            self._db.execute(
+                "UPDATE jobs SET status = ?, stage = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (RUNNING, PARSING, time.time(), row["id"]),
+            )
+            self._db.commit()
+        return dict(row)
+
+    # Delete finished jobs last updated before `before`, returning them
+    def prune(self, before: float) -> List[dict]:
+        finished = (DONE, FAILED, CANCELLED)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?, ?) AND updated_at < ?",
+                (*finished, before),
+            ).fetchall()
+            self._db.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?, ?) AND updated_at < ?",
+                (*finished, before),
+            )
+            self._db.commit()
+        return [dict(row) for row in rows]
+
+    # Jobs left running by a previous process are queued again
+    def requeue_interrupted(self) -> int:
+        with self._lock:
+            count = self._db.execute(
+                "UPDATE jobs SET status = ?, stage = NULL, progress = 0, embedded_chunks = 0 WHERE status = ?",
+                (QUEUED, RUNNING),
+            ).rowcount
+            self._db.commit()
+        return count
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Shape a job row for the client
+def job_to_response(job: dict) -> dict:
+    return {
+        "id": job["id"],
+        "kind": job["kind"],
+        "collectionName": job["collection_name"],
+        "documentId": job["document_id"],
+        "documentName": job["document_name"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": job["progress"],
+        "totalChunks": job["total_chunks"],
+        "embeddedChunks": job["embedded_chunks"],
+        "attempts": job["attempts"],
+        "error": job["error"],
+        "createdAt": job["created_at"],
+        "updatedAt": job["updated_at"],
+    }
+
+
+# Delete the copy of the source file made for an ingestion job. Failed and cancelled
+# jobs keep theirs for a retry until they are pruned.
+def remove_source_copy(input_file: dict):
+    path = input_file.get("path_to_file") or ""
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class IngestionQueue:
+    def __init__(
+        self,
+        app: Any,
+        max_workers: int = DEFAULT_INGEST_WORKERS,
+        path: str = JOBS_PATH,
+    ):
+        self.app = app
+        self.store = JobStore(path)
+        # Spawned (not forked) so workers do not inherit model threads and locks
+        self._pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self._cancelled = set()
+        self._wake = threading.Condition()
+        self._stopped = False
+        requeued = self.store.requeue_interrupted()
+        if requeued:
+            print(
+                f"{common.PRNT_EMBED} Resuming {requeued} interrupted ingestion job(s).",
+                flush=True,
+            )
+        self.prune()
+        # One runner per worker process, each takes a job from parse to write
+        self._runners = [
+            threading.Thread(target=self._run, name=f"ingest-{i}", daemon=True)
+            for i in range(max_workers)
+        ]
+        for runner in self._runners:
+            runner.start()
+
+    def submit(self, input_file: dict, form: dict) -> dict:
+        return self.submit_many([(input_file, form)])[0]
+
+    # Queue many (input file, form) pairs, idle runners pick them up in parallel
+    def submit_many(self, items: List[Tuple[dict, dict]]) -> List[dict]:
+        jobs = self.store.create_many(items)
+        with self._wake:
+            self._wake.notify_all()
+        return jobs
+
+    # Stop a queued or running job. Running jobs stop at the next batch boundary.
+    def cancel(self, job_id: str) -> bool:
+        job = self.store.get(job_id)
+        if not job or job["status"] not in (QUEUED, RUNNING):
+            return False
+        self._cancelled.add(job_id)
+        if job["status"] == QUEUED:
+            self.store.update(job_id, status=CANCELLED)
+        return True
+
+    # Queue a failed or cancelled job again
+    def retry(self, job_id: str) -> bool:
+        job = self.store.get(job_id)
+        if not job or job["status"] not in (FAILED, CANCELLED):
+            return False
+        if job["kind"] == INGEST:
+            input_file = json.loads(job["payload"])["input_file"]
+            if not os.path.exists(input_file.get("path_to_file") or ""):
+                raise Exception("The source file for this job no longer exists.")
+        self._cancelled.discard(job_id)
+        self.store.update(
+            job_id,
+            status=QUEUED,
+            stage=None,
+            progress=0,
+            total_chunks=job["total_chunks"] if job["kind"] == DELETE else 0,
+            embedded_chunks=0,
+            error=None,
+        )
+        self._notify()
+        return True
+
+    # Remove sources in the background, for deletions too large to wait on
+    def submit_deletion(
+        self, collection_name: str, source_ids: List[str], total_chunks: int = 0
+    ) -> dict:
+        job = self.store.create_deletion(collection_name, source_ids, total_chunks)
+        self._notify()
+        return job
+
+    # Forget old finished jobs, with the source copies failed and cancelled ones kept
+    def prune(self, max_age_days: float = None) -> int:
+        max_age_days = max_age_days or float(
+            os.getenv("INGEST_JOB_RETENTION_DAYS") or DEFAULT_JOB_RETENTION_DAYS
+        )
+        pruned = self.store.prune(before=time.time() - max_age_days * 86400)
+        for job in pruned:
+            if job["kind"] == INGEST and job["status"] != DONE:
+                remove_source_copy(json.loads(job["payload"])["input_file"])
+        if pruned:
+            print(
+                f"{common.PRNT_EMBED} Removed {len(pruned)} old ingestion job(s).",
+                flush=True,
+            )
+        return len(pruned)
+
+    def shutdown(self):
+        with self._wake:
+            self._stopped = True
+            self._wake.notify_all()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.store.close()
+
+    def _notify(self):
+        with self._wake:
+            self._wake.notify()
+
+    def _run(self):
+        while True:
+            with self._wake:
+                job = None
+                while not self._stopped:
+                    job = self.store.claim_next()
+                    if job:
+                        break
+                    self._wake.wait()
+                if self._stopped:
+                    return
+            if job["kind"] == DELETE:
+                self._run_deletion(job)
+            else:
+                self._run_job(job)
+
+    def _check_cancelled(self, job_id: str):
+        if job_id in self._cancelled:
+            raise JobCancelled()
+
+    # Parse and chunk the whole file in a worker process, then hand it out in batches
+    def _document_parts(self, job_id: str, input_file: dict, form: dict):
+        chunked_sources = self._pool.submit(parse_and_chunk, input_file, form).result()
+        total = sum(len(chunks) for _, chunks in chunked_sources)
+        self.store.update(job_id, stage=EMBEDDING, total_chunks=total)
+        done = 0
+        for source_record, chunk_nodes in chunked_sources:
+            if not chunk_nodes:
+                yield source_record, [], done / max(total, 1)
+            for i in range(0, len(chunk_nodes), EMBED_BATCH_SIZE):
+                batch = chunk_nodes[i : i + EMBED_BATCH_SIZE]
+                done += len(batch)
+                yield source_record, batch, done / max(total, 1)
+
+    # Parse a PDF a window of pages at a time so memory stays bounded by the window,
+    # not the file. The next window is parsed while the current one is embedded.
+    def _pdf_parts(self, job_id: str, input_file: dict, form: dict):
+        source_record = self._pool.submit(
+            create_pdf_source_record, input_file, form
+        ).result()
+        total_pages = source_record.get("totalPages") or 0
+        windows = [
+            (start, min(start + PDF_PAGE_WINDOW, total_pages))
+            for start in range(0, total_pages, PDF_PAGE_WINDOW)
+        ]
+        if not windows:
+            yield source_record, [], 1
+            return
+        order = 0
+        pending = self._pool.submit(chunk_pdf_window, input_file, form, *windows[0])
+        try:
+            for index, (_, end) in enumerate(windows):
+                chunk_nodes = pending.result()
+                if index + 1 < len(windows):
+                    pending = self._pool.submit(
+                        chunk_pdf_window, input_file, form, *windows[index + 1]
+                    )
+                # Number chunks across the whole document
+                for node in chunk_nodes:
+                    node.metadata["order"] = order
+                    order += 1
+                source_record["chunkIds"].extend(node.node_id for node in chunk_nodes)
+                self.store.update(job_id, stage=EMBEDDING, total_chunks=order)
+                yield source_record, chunk_nodes, end / total_pages
+        finally:
+            pending.cancel()
+
+    def _run_job(self, job: dict):
+        job_id = job["id"]
+        payload = json.loads(job["payload"])
+        input_file = payload["input_file"]
+        form = payload["form"]
+        added_ids: List[str] = []
+        collection = None
+        print(f"{common.PRNT_EMBED} Started ingestion job {job_id}", flush=True)
+        try:
+            embed_model = define_embedding_model(self.app)
+            db = get_vector_db_client(self.app)
+            collection = db.get_collection(name=form["collection_name"])
+            # When updating, chunks whose content is unchanged keep their embedding
+            previous = None
+            if form.get("is_update"):
+                found = get_sources_from_ids(
+                    self.app, form["collection_name"], [form["document_id"]]
+                )
+                previous = found[0] if found else None
+            reusable = {}
+            if previous:
+                reusable = get_chunk_hashes(collection, previous.get("chunkIds") or [])
+            reused_nodes = []
+            if is_paged_pdf(input_file, form):
+                parts = self._pdf_parts(job_id, input_file, form)
+            else:
+                parts = self._document_parts(job_id, input_file, form)
+            # Embed and write in batches so progress is visible
+            source_records = {}
+            chunk_ids = {}
+            processed = 0
+            for source_record, chunk_nodes, done in parts:
+                self._check_cancelled(job_id)
+                source_records[source_record["id"]] = source_record
+                new_nodes = []
+                for node in chunk_nodes:
+                    matches = reusable.get(chunk_hash(node))
+                    if matches:
+                        node.id_ = matches.pop()
+                        reused_nodes.append(node)
+                    else:
+                        new_nodes.append(node)
+                chunk_ids.setdefault(source_record["id"], []).extend(
+                    node.node_id for node in chunk_nodes
+                )
+                processed += len(chunk_nodes)
+                if new_nodes:
+                    add_chunks_to_collection(
+                        collection=collection,
+                        nodes=new_nodes,
+                        callback_manager=None,
+                        embed_model=embed_model,
+                    )
+                    added_ids.extend(node.node_id for node in new_nodes)
+                    get_lexical_index(self.app).add(
+                        form["collection_name"], to_lexical_rows(new_nodes)
+                    )
+                self.store.update(
+                    job_id,
+                    embedded_chunks=processed,
+                    progress=round(100 * done, 1),
+                )
+            for source_id, source_record in source_records.items():
+                source_record["chunkIds"] = chunk_ids.get(source_id, [])
+            # Only now touch the previous chunks, so a failed update leaves them intact
+            if reused_nodes:
+                update_chunks_metadata(collection, reused_nodes)
+            removed_ids = [id for ids in reusable.values() for id in ids]
+            if removed_ids:
+                collection.delete(ids=removed_ids)
+                get_lexical_index(self.app).delete_chunks(
+                    form["collection_name"], removed_ids
+                )
+            if previous:
+                print(
+                    f"{common.PRNT_EMBED} Updated document {form['document_id']}: "
+                    f"{len(added_ids)} added, {len(reused_nodes)} unchanged, "
+                    f"{len(removed_ids)} removed chunks.",
+                    flush=True,
+                )
+            # Add the source(s) to the manifest, replacing the previous record
+            update_collection_sources(
+                app=self.app,
+                collection_name=form["collection_name"],
+                sources=list(source_records.values()),
+                mode="add",
+            )
+            if previous and previous.get("filePath") != input_file.get("path_to_file"):
+                delete_source_files(previous)
+            self.store.update(job_id, status=DONE, stage=None, progress=100)
+            remove_source_copy(input_file)
+            print(f"{common.PRNT_EMBED} Ingestion job {job_id} done.", flush=True)
+        except JobCancelled:
+            self._remove_partial(collection, added_ids)
+            self.store.update(job_id, status=CANCELLED, stage=None)
+            print(f"{common.PRNT_EMBED} Ingestion job {job_id} cancelled.", flush=True)
+        except Exception as err:
+            self._remove_partial(collection, added_ids)
+            self.store.update(job_id, status=FAILED, stage=None, error=str(err))
+            print(
+                f"{common.PRNT_EMBED} Ingestion job {job_id} failed: {err}", flush=True
+            )
+        finally:
+            self._cancelled.discard(job_id)
+            invalidate_index(self.app, form["collection_name"])
+
+    # Delete sources a batch at a time. Cancelling keeps the batches already removed.
+    def _run_deletion(self, job: dict):
+        job_id = job["id"]
+        collection_name = job["collection_name"]
+        source_ids = json.loads(job["payload"])["source_ids"]
+        deleted_chunks = 0
+        print(f"{common.PRNT_EMBED} Started deletion job {job_id}", flush=True)
+        try:
+            self.store.update(job_id, stage=DELETING)
+            for i in range(0, len(source_ids), DELETE_BATCH_SIZE):
+                self._check_cancelled(job_id)
+                sources = get_sources_from_ids(
+                    self.app, collection_name, source_ids[i : i + DELETE_BATCH_SIZE]
+                )
+                delete_sources(
+                    app=self.app, collection_name=collection_name, sources=sources
+                )
+                deleted_chunks += sum(len(s.get("chunkIds") or []) for s in sources)
+                done = min(i + DELETE_BATCH_SIZE, len(source_ids))
+                self.store.update(
+                    job_id,
+                    embedded_chunks=deleted_chunks,
+                    progress=round(100 * done / len(source_ids), 1),
+                )
+            self.store.update(job_id, status=DONE, stage=None, progress=100)
+            print(f"{common.PRNT_EMBED} Deletion job {job_id} done.", flush=True)
+        except JobCancelled:
+            self.store.update(job_id, status=CANCELLED, stage=None)
+            print(f"{common.PRNT_EMBED} Deletion job {job_id} cancelled.", flush=True)
+        except Exception as err:
+            self.store.update(job_id, status=FAILED, stage=None, error=str(err))
+            print(
+                f"{common.PRNT_EMBED} Deletion job {job_id} failed: {err}", flush=True
+            )
+        finally:
+            self._cancelled.discard(job_id)
+            invalidate_index(self.app, collection_name)
+
+    # Remove chunks written by a job that did not finish
+    def _remove_partial(self, collection, chunk_ids: List[str]):
+        if collection and chunk_ids:
+            collection.delete(ids=chunk_ids)
+            get_lexical_index(self.app).delete_chunks(collection.name, chunk_ids)
+
+
+# Return the app's ingestion queue
+def get_ingestion_queue(app) -> IngestionQueue:
+    return app.state.ingestion_queue
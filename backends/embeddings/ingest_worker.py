@@ -0,0 +1,85 @@
+###
+# Runs inside the ingestion process pool. Workers are spawned, so each one also
+# re-imports the app's entry module with its web framework, llama_index and chromadb.
+# Nothing here loads the embedding model or opens the vector db though.
+###
+import asyncio
+from types import SimpleNamespace
+from typing import List, Tuple
+from llama_index.core import Document
+from llama_index.core.schema import IndexNode
+from core import classes, common
+from core.http_client import HttpClient
+from .file_loaders import (
+    create_index_nodes,
+    create_source_metadata,
+    pdf_page_count,
+    pdf_window_loader,
+)
+from .chunking import chunk_documents, chunk_pages, create_source_record
+
+PDF_PAGE_WINDOW = 16  # pages parsed, chunked and embedded together
+
+
+# Loaders that call web services expect the app's http client
+async def load_documents(input_file: dict, form: dict):
+    app = SimpleNamespace(requests_client=HttpClient())
+    try:
+        return await create_index_nodes(app=app, input_file=input_file, form=form)
+    finally:
+        await app.requests_client.aclose()
+
+
+# Read a source file and split it into chunks. Returns a (source record, chunks) pair per document.
+def parse_and_chunk(input_file: dict, form: dict) -> List[Tuple[dict, List[IndexNode]]]:
+    documents = asyncio.run(load_documents(input_file=input_file, form=form))
+    return chunk_documents(
+        documents=documents,
+        chunk_size=form.get("chunk_size"),
+        chunk_overlap=form.get("chunk_overlap"),
+        chunk_strategy=form.get("chunk_strategy"),
+    )
+
+
+# Local PDFs are read a window of pages at a time instead of as one document
+def is_paged_pdf(input_file: dict, form: dict) -> bool:
+    path = input_file.get("path_to_file") or ""
+    return (
+        common.get_file_extension_from_path(path).lower() == "pdf"
+        and form.get("parsing_method")
+        != classes.FILE_LOADER_SOLUTIONS.LLAMA_PARSE.value
+    )
+
+
+# The source record for a paged PDF, its chunk ids are filled in window by window
+def create_pdf_source_record(input_file: dict, form: dict) -> dict:
+    total_pages = pdf_page_count(input_file["path_to_file"])
+    document = Document(
+        id_=form["document_id"],
+        text="",
+        metadata={
+            "total_pages": total_pages,
+            **create_source_metadata(input_file=input_file, form=form),
+        },
+    )
+    return create_source_record(document=document)
+
+
+# Parse and chunk pages [start, end) of a PDF
+def chunk_pdf_window(
+    input_file: dict, form: dict, start: int, end: int
+) -> List[IndexNode]:
+    documents = pdf_window_loader(
+        path=input_file["path_to_file"],
+        start=start,
+        end=end,
+        source_id=form["document_id"],
+        source_metadata=create_source_metadata(input_file=input_file, form=form),
+    )
+    return chunk_pages(
+        documents=documents,
+        source_id=form["document_id"],
+        chunk_size=form.get("chunk_size"),
+        chunk_overlap=form.get("chunk_overlap"),
+        chunk_strategy=form.get("chunk_strategy"),
+    )
@@ -0,0 +1,182 @@
+###
+# Keyword (BM25) index of every collection's chunks, kept next to the vector store.
+# Finds exact identifiers, error codes and part numbers that dense similarity misses,
+# and answers keyword-only searches without loading the embedding model.
+# Each collection has its own SQLite FTS5 table over an external content table, so
+# a search only ranks that collection's chunks and chunks can be removed by id or
+# source without scanning the index. Deleting a collection drops its tables.
+###
+import os
+import sqlite3
+import hashlib
+import threading
+from typing import Iterable, List, Tuple
+from core import common
+
+LEXICAL_PATH = common.app_path("lexical")
+LEXICAL_FILE = "collections.sqlite3"
+
+
+# Turn free text into an FTS5 query that matches any of its terms
+def to_match_query(query: str) -> str:
+    terms = []
+    for term in query.split():
+        term = term.strip(".,;:!?()[]{}'\"`")
+        if term:
+            # Quoted so punctuation is not read as query syntax. Terms like "ERR-404"
+            # become a phrase of their tokens.
+            terms.append('"' + term.replace('"', '""') + '"')
+    return " OR ".join(terms)
+
+
+# Name of the tables holding a collection's chunks, safe to use in SQL
+def table_name(collection_name: str) -> str:
+    return "chunks_" + hashlib.sha1(collection_name.encode("utf-8")).hexdigest()[:16]
+
+
+class LexicalIndex:
+    def __init__(self, path: str = LEXICAL_PATH):
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(path, LEXICAL_FILE), check_same_thread=False
+        )
+        # Collections with tables, `is_complete` once all their chunks are in
+        self._db.execute("""CREATE TABLE IF NOT EXISTS collections (
+                name TEXT PRIMARY KEY,
+                is_complete INTEGER NOT NULL DEFAULT 0
+            )""")
+        self._db.commit()
+
+    # Add (chunk id, source id, text) rows
+    def add(self, collection_name: str, rows: Iterable[Tuple[str, str, str]]):
+        with self._lock:
+            table = self._create_tables(collection_name)
+            self._db.executemany(
+                f"INSERT INTO {table} (chunk_id, source_id, text) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+
+    def delete_chunks(self, collection_name: str, chunk_ids: List[str]):
+        with self._lock:
+            if not self._has_tables(collection_name):
+                return
+            self._db.executemany(
+                f"DELETE FROM {table_name(collection_name)} WHERE chunk_id = ?",
+                [(chunk_id,) for chunk_id in chunk_ids],
+            )
+            self._db.commit()
+
+    def delete_sources(self, collection_name: str, source_ids: List[str]):
+        with self._lock:
+            if not self._has_tables(collection_name):
+                return
+            self._db.executemany(
+                f"DELETE FROM {table_name(collection_name)} WHERE source_id = ?",
+                [(source_id,) for source_id in source_ids],
+            )
+            self._db.commit()
+
+    def delete_collection(self, collection_name: str):
+        with self._lock:
+            self._drop_tables(collection_name)
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            names = self._db.execute("SELECT name FROM collections").fetchall()
+            for (name,) in names:
+                self._drop_tables(name)
+            self._db.commit()
+
+    def is_indexed(self, collection_name: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT is_complete FROM collections WHERE name = ?",
+                (collection_name,),
+            ).fetchone()
+            return bool(row and row[0])
+
+    # Replace a collection's rows with the given ones and mark it complete
+    def rebuild(self, collection_name: str, rows: Iterable[Tuple[str, str, str]]):
+        with self._lock:
+            self._drop_tables(collection_name)
+            table = self._create_tables(collection_name)
+            self._db.executemany(
+                f"INSERT INTO {table} (chunk_id, source_id, text) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._db.execute(
+                "UPDATE collections SET is_complete = 1 WHERE name = ?",
+                (collection_name,),
+            )
+            self._db.commit()
+
+    # Best matching (chunk id, score) pairs, higher scores are better
+    def search(
+        self, collection_name: str, query: str, top_k: int
+    ) -> List[Tuple[str, float]]:
+        match = to_match_query(query)
+        if not match:
+            return []
+        table = table_name(collection_name)
+        with self._lock:
+            if not self._has_tables(collection_name):
+                return []
+            rows = self._db.execute(
+                f"SELECT {table}.chunk_id, bm25({table}_fts) AS rank FROM {table}_fts "
+                f"JOIN {table} ON {table}.rowid = {table}_fts.rowid "
+                f"WHERE {table}_fts MATCH ? ORDER BY rank LIMIT ?",
+                (match, top_k),
+            ).fetchall()
+        # bm25() is negative, lower is a better match
+        return [(chunk_id, -rank) for chunk_id, rank in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # Called with the lock held
+    def _has_tables(self, collection_name: str) -> bool:
+        row = self._db.execute(
+            "SELECT 1 FROM collections WHERE name = ?", (collection_name,)
+        ).fetchone()
+        return bool(row)
+
+    # Create a collection's tables unless they exist. Called with the lock held.
+    def _create_tables(self, collection_name: str) -> str:
+        table = table_name(collection_name)
+        if self._has_tables(collection_name):
+            return table
+        self._db.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                rowid INTEGER PRIMARY KEY,
+                source_id TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS {table}_chunk ON {table}(chunk_id);
+            CREATE INDEX IF NOT EXISTS {table}_source ON {table}(source_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+                text, content='{table}', content_rowid='rowid'
+            );
+            CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON {table} BEGIN
+                INSERT INTO {table}_fts(rowid, text) VALUES (new.rowid, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON {table} BEGIN
+                INSERT INTO {table}_fts({table}_fts, rowid, text)
+                VALUES ('delete', old.rowid, old.text);
+            END;
+            """)
+        self._db.execute(
+            "INSERT INTO collections (name) VALUES (?)", (collection_name,)
+        )
+        return table
+
+    # Called with the lock held
+    def _drop_tables(self, collection_name: str):
+        table = table_name(collection_name)
+        self._db.execute(f"DROP TABLE IF EXISTS {table}_fts")
+        self._db.execute(f"DROP TABLE IF EXISTS {table}")
+        self._db.execute("DELETE FROM collections WHERE name = ?", (collection_name,))
@@ -1,5 +1,7 @@
 import os
-from typing import List, Any
+import threading
+from collections import OrderedDict
+from typing import List, Any, Optional
 from llama_index.core import (
     VectorStoreIndex,
     Document,
@@ -10,17 +12,11 @@ from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.core import StorageContext
 from llama_index.core.ingestion import IngestionPipeline
 from llama_index.core.storage.docstore import SimpleDocumentStore
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from core import common
-from .storage import (
-    get_vector_db_client,
-    add_chunks_to_collection,
-    update_collection_sources,
-)
-from .file_parsers import process_documents
-from .text_splitters import markdown_heading_split, markdown_document_split
-from .chunking import chunks_from_documents, create_source_record
-from .file_loaders import documents_from_sources
+from .embed_service import EmbeddingService, ServiceEmbedding
+from .embed_cache import EmbeddingCache, DEFAULT_EMBED_CACHE_MAX_MB
+from .storage import get_vector_db_client
 
 # from chromadb.utils import embedding_functions
 # from llama_index.core.response_synthesizers import ResponseMode
@@ -35,10 +31,8 @@ embedding_model_names = dict(
 # Constants
 
 EMBEDDING_MODEL_CACHE_PATH = common.app_path("embed_models")
-CHUNKING_STRATEGIES = {
-    "MARKDOWN_HEADING_SPLIT": markdown_heading_split,
-    "MARKDOWN_DOCUMENT_SPLIT": markdown_document_split,
-}
+DEFAULT_INDEX_CACHE_SIZE = 8  # collections whose vector index is kept loaded
+embed_model_lock = threading.Lock()
 
 # Helpers
 
@@ -54,28 +48,73 @@ def embed_pipeline(parser, vector_store, documents: List[Document]):
     pipeline.run(documents=documents)
 
 
-# Define a specific embedding method globally
+# Return the app's shared embedding model, starting its batching service on first use
 # @TODO Allow user to determine which model to use.
 # @TODO Use the embedder recorded in the metadata (when retrieving)
-def define_embedding_model(app: Any):
-    # from transformers import AutoModel, AutoTokenizer
-    print(f"{common.PRNT_EMBED} Initializing embed model...", flush=True)
-    embed_model = "local"
-
-    if app.state.embed_model:
-        embed_model = app.state.embed_model
-    else:
+def define_embedding_model(app: Any) -> BaseEmbedding:
+    # Ingestion jobs and queries may ask for it at the same time
+    with embed_model_lock:
+        if app.state.embed_model:
+            return app.state.embed_model
+
+        print(f"{common.PRNT_EMBED} Initializing embed model...", flush=True)
         embed_model_name = embedding_model_names["GTE"]  # name on Huggingface
-        embed_model = HuggingFaceEmbedding(
+        service = EmbeddingService(
             model_name=embed_model_name,
-            # model=AutoModel.from_pretrained(embed_model_name),
             cache_folder=EMBEDDING_MODEL_CACHE_PATH,
-            # tokenizer=AutoTokenizer.from_pretrained(embed_model_name),
         )
+        # Unchanged chunks are not re-embedded when a document is updated
+        cache_max_mb = float(
+            os.getenv("EMBED_CACHE_MAX_MB", DEFAULT_EMBED_CACHE_MAX_MB)
+        )
+        cache = EmbeddingCache(max_bytes=int(cache_max_mb * 1024**2))
+        embed_model = ServiceEmbedding(service, cache=cache)
         app.state.embed_model = embed_model
+        # Default for any llama-index component not handed an embed model explicitly
+        Settings.embed_model = embed_model
+        return embed_model
+
+
+# Recently queried collections' vector indexes, so repeat queries skip rebuilding them
+class IndexCache:
+    def __init__(self, max_size: int = DEFAULT_INDEX_CACHE_SIZE):
+        self.max_size = max_size
+        self._indexes: OrderedDict[str, VectorStoreIndex] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, collection_name: str) -> Optional[VectorStoreIndex]:
+        with self._lock:
+            index = self._indexes.get(collection_name)
+            if index:
+                self._indexes.move_to_end(collection_name)
+            return index
+
+    def put(self, collection_name: str, index: VectorStoreIndex):
+        with self._lock:
+            self._indexes[collection_name] = index
+            self._indexes.move_to_end(collection_name)
+            # Evict least recently used
+            while len(self._indexes) > self.max_size:
+                self._indexes.popitem(last=False)
+
+    # Drop one collection's index, or all of them
+    def invalidate(self, collection_name: str = None):
+        with self._lock:
+            if collection_name:
+                self._indexes.pop(collection_name, None)
+            else:
+                self._indexes.clear()
+
 
-    Settings.embed_model = embed_model
-    return embed_model
+def get_index_cache(app: Any) -> IndexCache:
+    return app.state.index_cache
+
+
+# Call after ingestion or deletion changes a collection
+def invalidate_index(app: Any, collection_name: str = None):
+    get_index_cache(app).invalidate(collection_name)
+    # Cached search results of the collection are stale too
+    app.state.retrieval_cache.invalidate(collection_name)
 
 
 # Methods
@@ -92,10 +131,13 @@ def create_index_callback_manager() -> CallbackManager:
 # Load collection of document embeddings from disk
 # @TODO Cleanup args, some (context_window, num_output, chunk_size, prompts) should be updated before a query is called
 def load_embedding(app: dict, collection_name: str) -> VectorStoreIndex:
-    vector_index = None
+    index_cache = get_index_cache(app)
+    vector_index = index_cache.get(collection_name)
+    if vector_index:
+        return vector_index
     try:
         # Initialize embedding func
-        define_embedding_model(app)
+        embed_model = define_embedding_model(app)
         # Initialize client
         db = get_vector_db_client(app)
         # Get collection
@@ -109,116 +151,10 @@ def load_embedding(app: dict, collection_name: str) -> VectorStoreIndex:
             storage_context=storage_context,
             show_progress=True,
             callback_manager=create_index_callback_manager(),
+            embed_model=embed_model,
             # store_nodes_override=True,  # this populates docstore.json with chunk nodes
         )
+        index_cache.put(collection_name, vector_index)
     except Exception as e:
         print(f"{common.PRNT_EMBED} Failed to load vector index: {e}", flush=True)
     return vector_index
-
-
-# Create nodes from a single source Document
-async def create_index_nodes(
-    app: dict,
-    input_file: dict,
-    form: dict,
-) -> List[Document]:
-    print(f"{common.PRNT_EMBED} Creating nodes...", flush=True)
-    # File attributes
-    checksum: str = input_file.get("checksum")
-    file_name = input_file.get("file_name")
-    source_file_path: str = input_file.get("path_to_file")
-    document_id: str = form["document_id"]
-    document_name: str = form["document_name"]
-    description: str = form["description"]
-    tags: str = form["tags"]
-    parsing_method: str = form["parsing_method"]
-    is_file = os.path.isfile(source_file_path)
-    file_size = 0
-    if is_file:
-        file_size = os.path.getsize(source_file_path)
-    # Read in source files and build documents
-    source_paths = [source_file_path]
-    source_metadata = dict(
-        name=document_name,
-        description=description,
-        checksum=checksum,
-        fileName=file_name,
-        filePath=source_file_path,
-        fileSize=file_size,
-        tags=tags,
-    )
-    file_nodes = await documents_from_sources(
-        app=app,
-        sources=source_paths,
-        source_id=document_id,
-        source_metadata=source_metadata,
-        parsing_method=parsing_method,
-    )
-    # Optional step, Post-Process source text for optimal embedding/retrieval for LLM
-    is_dirty = False  # @TODO Have `documents_from_sources` determine when docs are already processed
-    if is_dirty:
-        file_nodes = process_documents(nodes=file_nodes)
-    return file_nodes
-
-
-# Create embeddings for one file (input) at a time
-# We create one source per upload
-def create_new_embedding(
-    nodes: List[Document],
-    form: dict,
-    app: Any,
-):
-    try:
-        print(f"{common.PRNT_EMBED} Creating embeddings...", flush=True)
-        # File attributes
-        chunk_size: int = form["chunk_size"] or 300
-        chunk_overlap: int = form["chunk_overlap"] or 0
-        chunk_strategy: str = (
-            form["chunk_strategy"] or list(CHUNKING_STRATEGIES.keys())[0]
-        )
-        text_splitter = CHUNKING_STRATEGIES[chunk_strategy]
-        collection_name: str = form["collection_name"]
-        # Loop through each file
-        for node in nodes:
-            # Create source document records for Collection metadata
-            source_record = create_source_record(document=node)
-            # Split document texts
-            splitter = text_splitter(
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap,
-            )
-            # Build chunks
-            print(f"{common.PRNT_EMBED} Chunking text...", flush=True)
-            parsed_nodes = splitter.get_nodes_from_documents(
-                documents=[node],  # pass list of files (in Document format)
-                show_progress=True,
-            )
-            [chunks_ids, chunk_nodes] = chunks_from_documents(
-                source_record=source_record,
-                parsed_nodes=parsed_nodes,  # pass in text nodes to return as chunks
-                documents=[node],
-            )
-            # Record the ids of each chunk
-            source_record["chunkIds"] = chunks_ids
-            # Setup embedding model
-            define_embedding_model(app)
-            # Create/load a vector index, add chunks and persist to storage
-            print(f"{common.PRNT_EMBED} Adding chunks to collection...", flush=True)
-            db = get_vector_db_client(app)
-            collection = db.get_collection(name=collection_name)
-            vector_index = add_chunks_to_collection(
-                collection=collection,
-                nodes=chunk_nodes,
-                callback_manager=create_index_callback_manager(),
-            )
-            # Add/update `collection.metadata.sources` list
-            print(f"{common.PRNT_EMBED} Updating collection metadata...", flush=True)
-            update_collection_sources(
-                collection=collection,
-                sources=[source_record],
-                mode="add",
-            )
-        print(f"{common.PRNT_EMBED} Embedding succeeded!", flush=True)
-    except (Exception, KeyError) as e:
-        msg = f"Embedding failed: {e}"
-        print(f"{common.PRNT_EMBED} {msg}", flush=True)
@@ -0,0 +1,188 @@
+###
+# Manifest of the source documents in each collection and the ids of their chunks.
+# Kept in SQLite, indexed by collection and source id, so looking up or changing one
+# source does not read or rewrite the records of every other source in the collection.
+###
+import os
+import json
+import sqlite3
+import threading
+from typing import List, Optional
+from core import classes, common
+
+MANIFEST_PATH = common.app_path("manifest")
+MANIFEST_FILE = "sources.sqlite3"
+
+
+class SourceManifest:
+    def __init__(self, path: str = MANIFEST_PATH):
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(path, MANIFEST_FILE), check_same_thread=False
+        )
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS sources (
+                collection_name TEXT NOT NULL,
+                id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                record TEXT NOT NULL,
+                PRIMARY KEY (collection_name, id)
+            )""")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS sources_position ON sources(collection_name, position)"
+        )
+        self._db.execute("""CREATE TABLE IF NOT EXISTS chunks (
+                collection_name TEXT NOT NULL,
+                source_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                chunk_id TEXT NOT NULL,
+                PRIMARY KEY (collection_name, source_id, position),
+                FOREIGN KEY (collection_name, source_id)
+                    REFERENCES sources(collection_name, id) ON DELETE CASCADE
+            )""")
+        self._db.commit()
+
+    # Source records for the given ids, in the order they were added
+    def get(
+        self, collection_name: str, source_ids: List[str], include_chunks=True
+    ) -> List[classes.SourceMetadata]:
+        if not source_ids:
+            return []
+        with self._lock:
+            rows = []
+            # Stay under SQLite's bound parameter limit
+            for i in range(0, len(source_ids), 500):
+                batch = source_ids[i : i + 500]
+                marks = ",".join("?" * len(batch))
+                rows.extend(
+                    self._db.execute(
+                        f"SELECT id, position, record FROM sources WHERE collection_name = ? AND id IN ({marks})",
+                        [collection_name, *batch],
+                    ).fetchall()
+                )
+            rows.sort(key=lambda row: row[1])
+            return [
+                self._to_record(collection_name, row[0], row[2], include_chunks)
+                for row in rows
+            ]
+
+    # A page of a collection's sources, in the order they were added
+    def list(
+        self,
+        collection_name: str,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        include_chunks=True,
+    ) -> List[classes.SourceMetadata]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, record FROM sources WHERE collection_name = ? "
+                "ORDER BY position LIMIT ? OFFSET ?",
+                (collection_name, -1 if limit is None else limit, offset),
+            ).fetchall()
+            return [
+                self._to_record(collection_name, row[0], row[1], include_chunks)
+                for row in rows
+            ]
+
+    def count(self, collection_name: str) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM sources WHERE collection_name = ?",
+                (collection_name,),
+            ).fetchone()[0]
+
+    # Add sources, or replace the record and chunk ids of sources that already exist
+    def put(self, collection_name: str, sources: List[classes.SourceMetadata]):
+        with self._lock:
+            for source in sources:
+                record = {k: v for k, v in source.items() if k != "chunkIds"}
+                exists = self._db.execute(
+                    "SELECT 1 FROM sources WHERE collection_name = ? AND id = ?",
+                    (collection_name, source["id"]),
+                ).fetchone()
+                if exists:
+                    self._db.execute(
+                        "UPDATE sources SET record = ? WHERE collection_name = ? AND id = ?",
+                        (json.dumps(record), collection_name, source["id"]),
+                    )
+                    self._db.execute(
+                        "DELETE FROM chunks WHERE collection_name = ? AND source_id = ?",
+                        (collection_name, source["id"]),
+                    )
+                else:
+                    self._db.execute(
+                        "INSERT INTO sources (collection_name, id, position, record) VALUES "
+                        "(?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM sources WHERE collection_name = ?), ?)",
+                        (
+                            collection_name,
+                            source["id"],
+                            collection_name,
+                            json.dumps(record),
+                        ),
+                    )
+                self._db.executemany(
+                    "INSERT INTO chunks (collection_name, source_id, position, chunk_id) VALUES (?, ?, ?, ?)",
+                    [
+                        (collection_name, source["id"], position, chunk_id)
+                        for position, chunk_id in enumerate(
+                            source.get("chunkIds") or []
+                        )
+                    ],
+                )
+            self._db.commit()
+
+    def delete(self, collection_name: str, source_ids: List[str]):
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM sources WHERE collection_name = ? AND id = ?",
+                [(collection_name, source_id) for source_id in source_ids],
+            )
+            self._db.commit()
+
+    def delete_collection(self, collection_name: str):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM sources WHERE collection_name = ?", (collection_name,)
+            )
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM sources")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _to_record(
+        self, collection_name: str, source_id: str, record: str, include_chunks: bool
+    ) -> classes.SourceMetadata:
+        source = json.loads(record)
+        if include_chunks:
+            rows = self._db.execute(
+                "SELECT chunk_id FROM chunks WHERE collection_name = ? AND source_id = ? ORDER BY position",
+                (collection_name, source_id),
+            ).fetchall()
+            source["chunkIds"] = [row[0] for row in rows]
+        return source
+
+
+# Move sources kept in a collection's metadata by older versions into the manifest
+def migrate_collection_metadata(manifest: SourceManifest, collection):
+    sources_json = (collection.metadata or {}).get("sources")
+    if not sources_json or not isinstance(sources_json, str):
+        return
+    sources = json.loads(sources_json)
+    if not sources:
+        return
+    if not manifest.count(collection.name):
+        manifest.put(collection.name, sources)
+        print(
+            f"{common.PRNT_EMBED} Moved {len(sources)} source(s) of [{collection.name}] into the manifest.",
+            flush=True,
+        )
+    collection.metadata["sources"] = json.dumps([])
+    collection.modify(metadata=collection.metadata)
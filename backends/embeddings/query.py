@@ -1,7 +1,9 @@
-from typing import Any
+from typing import Any, List, Optional
 from core import common, classes
-from llama_index.core import VectorStoreIndex, PromptTemplate
+from llama_index.core import PromptTemplate, get_response_synthesizer
 from llama_index.core.response_synthesizers import ResponseMode
+from llama_index.core.schema import NodeWithScore
+from .rerank import Reranker
 
 
 # Build prompts
@@ -36,14 +38,15 @@ def build_qa_prompt(template, prompt_type):
         return PromptTemplate(template=SIMPLE_RAG_PROMPT_TEMPLATE, prompt_type=p_type)
 
 
-# Query Private Data (RAG)
+# Query Private Data (RAG), answering from chunks already retrieved from the collection(s)
 def query_embedding(
     llm: Any,
     query: str,
     prompt_template: classes.RagTemplateData,
-    index: VectorStoreIndex,
+    nodes: List[NodeWithScore],
     options: classes.ContextRetrievalOptions,
     streaming: bool,
+    reranker: Optional[Reranker] = None,
 ):
     print(
         f"{common.PRNT_EMBED} Query Data:\n{prompt_template.text}\n{prompt_template.type}",
@@ -55,23 +58,31 @@ def query_embedding(
         template=prompt_template.text, prompt_type=prompt_template.type
     )
 
+    # Keep only the most relevant of the over-fetched chunks
+    if reranker:
+        nodes = reranker.rerank(
+            query=query,
+            nodes=nodes,
+            top_n=options["similarity_top_k"] or 1,
+            budget_ms=options.get("rerank_budget_ms"),
+        )
+
     # Call query() in query mode
     print(f"{common.PRNT_EMBED} Query prompt:\n{custom_qa_prompt}", flush=True)
     try:
-        query_engine = index.as_query_engine(
+        synthesizer = get_response_synthesizer(
             llm=llm,
             streaming=streaming,
             # summary_template=summary_template,
             # simple_template=simple_template,
             text_qa_template=custom_qa_prompt,
             refine_template=build_refine_prompt(),
-            similarity_top_k=options["similarity_top_k"] or 1,
             response_mode=options["response_mode"] or ResponseMode.COMPACT,
         )
         # @TODO in chat mode
         # chat_engine = index.as_chat_engine(...)
 
-        streaming_response = query_engine.query(query)
+        streaming_response = synthesizer.synthesize(query, nodes=nodes)
     except Exception as err:
         raise Exception(f"Query engine failed to return result. {err}")
     # Log probability scores (logits) for each chunk
@@ -0,0 +1,142 @@
+###
+# Reranks retrieved chunks with a small cross-encoder on the CPU so only the best few
+# reach the LLM. Retrieval over-fetches candidates, they are scored against the query
+# in batches until a latency budget runs out, and the scores are cached per
+# query-chunk pair so repeated questions skip the model.
+###
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional
+from llama_index.core.schema import MetadataMode, NodeWithScore
+from core import common
+
+RERANK_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"  # name on Huggingface
+RERANK_MODEL_CACHE_PATH = common.app_path("rerank_models")
+RERANK_BATCH_SIZE = 16  # query-chunk pairs per forward pass
+RERANK_CANDIDATES = 4  # candidates retrieved per chunk kept after reranking
+MIN_RERANK_CANDIDATES = 20
+DEFAULT_RERANK_BUDGET_MS = 500
+DEFAULT_SCORE_CACHE_SIZE = 10000  # cached query-chunk scores
+MAX_RERANK_LENGTH = 512  # tokens per query-chunk pair
+
+reranker_lock = threading.Lock()
+
+
+# Number of chunks to retrieve when reranking down to top_k
+def rerank_candidates(top_k: int) -> int:
+    return max(top_k * RERANK_CANDIDATES, MIN_RERANK_CANDIDATES)
+
+
+# Key for a chunk's score against a query
+def make_score_key(model_name: str, query: str, text: str) -> str:
+    content = "\x00".join([model_name, query.strip(), text])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class Reranker:
+    def __init__(
+        self,
+        model_name: str = RERANK_MODEL_NAME,
+        cache_folder: str = RERANK_MODEL_CACHE_PATH,
+        batch_size: int = RERANK_BATCH_SIZE,
+        cache_size: int = DEFAULT_SCORE_CACHE_SIZE,
+        budget_ms: float = DEFAULT_RERANK_BUDGET_MS,
+    ):
+        # Loads torch, so wait until reranking is actually used
+        from sentence_transformers import CrossEncoder
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.budget_ms = budget_ms
+        self.model = CrossEncoder(
+            model_name,
+            max_length=MAX_RERANK_LENGTH,
+            device="cpu",
+            tokenizer_args=dict(cache_dir=cache_folder),
+            automodel_args=dict(cache_dir=cache_folder),
+        )
+        self._scores: OrderedDict[str, float] = OrderedDict()
+        self._model_lock = threading.Lock()  # one forward pass at a time
+        self._lock = threading.Lock()
+        print(f"{common.PRNT_EMBED} Reranker using {model_name}", flush=True)
+
+    # Best top_n of the nodes by relevance to the query. Candidates left unscored when
+    # the budget runs out follow the scored ones in their retrieval order.
+    def rerank(
+        self,
+        query: str,
+        nodes: List[NodeWithScore],
+        top_n: int,
+        budget_ms: Optional[float] = None,
+    ) -> List[NodeWithScore]:
+        if len(nodes) <= 1:
+            return nodes[:top_n]
+        started = time.monotonic()
+        budget = (budget_ms or self.budget_ms) / 1000
+        texts = [n.node.get_content(metadata_mode=MetadataMode.NONE) for n in nodes]
+        keys = [make_score_key(self.model_name, query, text) for text in texts]
+        scores = self._get_scores(keys)
+        misses = [i for i, key in enumerate(keys) if key not in scores]
+        skipped = 0
+        for start in range(0, len(misses), self.batch_size):
+            # Always score one batch, then only while time is left
+            if start and time.monotonic() - started >= budget:
+                skipped = len(misses) - start
+                break
+            batch = misses[start : start + self.batch_size]
+            with self._model_lock:
+                batch_scores = self.model.predict(
+                    [(query, texts[i]) for i in batch],
+                    batch_size=self.batch_size,
+                    show_progress_bar=False,
+                )
+            computed = {keys[i]: float(s) for i, s in zip(batch, batch_scores)}
+            self._put_scores(computed)
+            scores.update(computed)
+        if skipped:
+            print(
+                f"{common.PRNT_EMBED} Rerank budget of {budget * 1000:.0f}ms reached, {skipped} candidate(s) left unscored.",
+                flush=True,
+            )
+        scored = sorted(
+            (i for i, key in enumerate(keys) if key in scores),
+            key=lambda i: scores[keys[i]],
+            reverse=True,
+        )
+        unscored = [i for i, key in enumerate(keys) if key not in scores]
+        return [
+            NodeWithScore(
+                node=nodes[i].node,
+                score=scores[keys[i]] if keys[i] in scores else nodes[i].score,
+            )
+            for i in (scored + unscored)[:top_n]
+        ]
+
+    def _get_scores(self, keys: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._scores:
+                    self._scores.move_to_end(key)
+                    found[key] = self._scores[key]
+        return found
+
+    def _put_scores(self, scores: dict):
+        with self._lock:
+            self._scores.update(scores)
+            while len(self._scores) > self.cache_size:
+                self._scores.popitem(last=False)
+
+
+# Return the app's reranker, loading the model on first use
+def get_reranker(app: Any) -> Reranker:
+    with reranker_lock:
+        if app.state.reranker == None:
+            cache_size = int(os.getenv("RERANK_CACHE_SIZE") or DEFAULT_SCORE_CACHE_SIZE)
+            budget_ms = float(os.getenv("RERANK_BUDGET_MS") or DEFAULT_RERANK_BUDGET_MS)
+            app.state.reranker = Reranker(cache_size=cache_size, budget_ms=budget_ms)
+    return app.state.reranker
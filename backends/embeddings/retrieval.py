@@ -0,0 +1,317 @@
+###
+# Retrieval across several collections. Each collection is searched on its own
+# thread with the query embedded once, and the ranked lists are fused into a single
+# top-k before the LLM synthesizes an answer. Collections that miss the deadline are
+# left out instead of holding up the answer. Their search keeps its own thread until
+# it ends, and the collection is skipped by other queries meanwhile.
+# Within a collection, vector search is used unless keyword (BM25) search is asked
+# for, alone or fused with the vector results. Keyword-only search never loads the
+# embedding model.
+# Each collection's result ids are cached, so a repeated question skips embedding
+# and search until the collection changes or the entry expires.
+###
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from core import common
+from .main import define_embedding_model, load_embedding
+from .storage import get_vector_db_client, sync_lexical_index
+
+RRF = "rrf"  # reciprocal rank fusion, only uses each result's rank
+SCORE = "score"  # min-max normalized similarity, best score per chunk wins
+FUSION_MODES = (RRF, SCORE)
+HYBRID = "hybrid"  # keyword and vector results fused with RRF
+VECTOR = "vector"
+LEXICAL = "lexical"
+SEARCH_MODES = (HYBRID, VECTOR, LEXICAL)
+HYBRID_CANDIDATES = 2  # each search returns this many times top_k before fusing
+RRF_K = 60  # damps the advantage of the very top ranks
+DEFAULT_RETRIEVAL_TIMEOUT = 10.0  # seconds to wait for a collection
+MAX_RETRIEVAL_WORKERS = 8  # threads per query
+DEFAULT_RETRIEVAL_CACHE_SIZE = 1024  # cached (collection, query) results
+DEFAULT_RETRIEVAL_CACHE_TTL = 600  # seconds a cached result is used
+
+# Searches that missed their deadline and are still running, by collection
+_stragglers: Dict[str, Future] = {}
+_stragglers_lock = threading.Lock()
+
+
+# Lowercased with collapsed whitespace, so trivially different questions share results
+def normalize_query(query: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", query).lower().split())
+
+
+# Ranked chunk ids and scores of recent searches. Each collection has a version that
+# ingestion and deletion bump, entries from an older version are never returned.
+class RetrievalCache:
+    def __init__(
+        self,
+        max_size: int = DEFAULT_RETRIEVAL_CACHE_SIZE,
+        ttl: float = DEFAULT_RETRIEVAL_CACHE_TTL,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple, tuple] = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._generation = 0  # bumped when every collection changes at once
+        self._lock = threading.Lock()
+
+    # Read before searching and pass to put(), so a change during the search wins
+    def version(self, collection_name: str) -> tuple:
+        with self._lock:
+            return (self._generation, self._versions.get(collection_name, 0))
+
+    def get(
+        self, collection_name: str, query: str, top_k: int, search_mode: str
+    ) -> Optional[List[Tuple[str, float]]]:
+        key = (collection_name, normalize_query(query), top_k, search_mode)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            version, expires, hits = entry
+            current = (self._generation, self._versions.get(collection_name, 0))
+            if version != current or expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return hits
+
+    def put(
+        self,
+        collection_name: str,
+        query: str,
+        top_k: int,
+        search_mode: str,
+        version: tuple,
+        hits: List[Tuple[str, float]],
+    ):
+        key = (collection_name, normalize_query(query), top_k, search_mode)
+        with self._lock:
+            if version != (self._generation, self._versions.get(collection_name, 0)):
+                return
+            self._entries[key] = (version, time.monotonic() + self.ttl, hits)
+            self._entries.move_to_end(key)
+            # Evict least recently used
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    # Call when one collection, or every collection, changes
+    def invalidate(self, collection_name: str = None):
+        with self._lock:
+            if collection_name:
+                self._versions[collection_name] = (
+                    self._versions.get(collection_name, 0) + 1
+                )
+            else:
+                self._generation += 1
+                self._entries.clear()
+
+
+def get_retrieval_cache(app: Any) -> RetrievalCache:
+    return app.state.retrieval_cache
+
+
+# Read chunks back from the vector store, in the order of the (chunk id, score) hits
+def load_nodes(
+    app: Any, collection_name: str, hits: List[Tuple[str, float]]
+) -> List[NodeWithScore]:
+    if not hits:
+        return []
+    collection = get_vector_db_client(app).get_collection(name=collection_name)
+    stored = collection.get(
+        ids=[chunk_id for chunk_id, _ in hits], include=["metadatas", "documents"]
+    )
+    nodes = {
+        chunk_id: metadata_dict_to_node(metadata, text=text)
+        for chunk_id, metadata, text in zip(
+            stored["ids"], stored["metadatas"], stored["documents"]
+        )
+    }
+    return [
+        NodeWithScore(node=nodes[chunk_id], score=score)
+        for chunk_id, score in hits
+        if chunk_id in nodes
+    ]
+
+
+# Vector similarity search
+def retrieve_dense(
+    app: Any, collection_name: str, query_bundle: QueryBundle, top_k: int
+) -> List[NodeWithScore]:
+    vector_index = load_embedding(app, collection_name)
+    if not vector_index:
+        raise Exception(f"Failed to load collection [{collection_name}].")
+    retriever = vector_index.as_retriever(similarity_top_k=top_k)
+    return retriever.retrieve(query_bundle)
+
+
+# BM25 search, the matching chunks are read back from the vector store
+def retrieve_lexical(
+    app: Any, collection_name: str, query: str, top_k: int
+) -> List[NodeWithScore]:
+    hits = sync_lexical_index(app, collection_name).search(
+        collection_name, query, top_k
+    )
+    return load_nodes(app, collection_name, hits)
+
+
+# Search one collection with the given mode
+def retrieve_collection(
+    app: Any,
+    collection_name: str,
+    query_bundle: QueryBundle,
+    top_k: int,
+    search_mode: str = VECTOR,
+) -> List[NodeWithScore]:
+    if search_mode == VECTOR:
+        return retrieve_dense(app, collection_name, query_bundle, top_k)
+    if search_mode == LEXICAL:
+        return retrieve_lexical(app, collection_name, query_bundle.query_str, top_k)
+    candidates = top_k * HYBRID_CANDIDATES
+    results = [
+        retrieve_dense(app, collection_name, query_bundle, candidates),
+        retrieve_lexical(app, collection_name, query_bundle.query_str, candidates),
+    ]
+    # BM25 and cosine scores are not comparable, so fuse by rank
+    return fuse_results(results, top_k=top_k, mode=RRF)
+
+
+# Search one collection, answering from the retrieval cache when possible
+def retrieve_cached(
+    app: Any,
+    collection_name: str,
+    query_bundle: QueryBundle,
+    top_k: int,
+    search_mode: str,
+    cached: Optional[List[Tuple[str, float]]],
+) -> List[NodeWithScore]:
+    if cached is not None:
+        return load_nodes(app, collection_name, cached)
+    cache = get_retrieval_cache(app)
+    version = cache.version(collection_name)
+    nodes = retrieve_collection(app, collection_name, query_bundle, top_k, search_mode)
+    hits = [(result.node.node_id, result.score) for result in nodes]
+    cache.put(
+        collection_name, query_bundle.query_str, top_k, search_mode, version, hits
+    )
+    return nodes
+
+
+# Merge ranked lists into one, scores are replaced by the fused score
+def fuse_results(
+    results: List[List[NodeWithScore]], top_k: int, mode: str = RRF
+) -> List[NodeWithScore]:
+    fused: Dict[str, float] = {}
+    nodes: Dict[str, NodeWithScore] = {}
+    for ranked in results:
+        if mode == SCORE:
+            scores = [result.score or 0.0 for result in ranked]
+            low = min(scores, default=0.0)
+            spread = (max(scores, default=0.0) - low) or 1.0
+        for rank, result in enumerate(ranked):
+            node_id = result.node.node_id
+            nodes.setdefault(node_id, result)
+            if mode == SCORE:
+                score = ((result.score or 0.0) - low) / spread
+                fused[node_id] = max(fused.get(node_id, 0.0), score)
+            else:
+                fused[node_id] = fused.get(node_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    ranked_ids = sorted(fused, key=fused.get, reverse=True)[:top_k]
+    return [NodeWithScore(node=nodes[i].node, score=fused[i]) for i in ranked_ids]
+
+
+# Remember a search that overran until it ends
+def track_straggler(collection_name: str, future: Future):
+    with _stragglers_lock:
+        _stragglers[collection_name] = future
+
+    def forget(_):
+        with _stragglers_lock:
+            if _stragglers.get(collection_name) is future:
+                del _stragglers[collection_name]
+
+    future.add_done_callback(forget)
+
+
+# Search every collection concurrently and return one fused top-k
+def retrieve_collections(
+    app: Any,
+    collection_names: List[str],
+    query: str,
+    top_k: int,
+    search_mode: str = None,
+    fusion_mode: str = None,
+    timeout: float = None,
+) -> List[NodeWithScore]:
+    search_mode = search_mode or VECTOR
+    if search_mode not in SEARCH_MODES:
+        raise Exception(
+            f"Unknown search mode '{search_mode}', use one of {SEARCH_MODES}."
+        )
+    fusion_mode = fusion_mode or RRF
+    if fusion_mode not in FUSION_MODES:
+        raise Exception(
+            f"Unknown fusion mode '{fusion_mode}', use one of {FUSION_MODES}."
+        )
+    timeout = timeout or DEFAULT_RETRIEVAL_TIMEOUT
+    cache = get_retrieval_cache(app)
+    cached = {
+        name: cache.get(name, query, top_k, search_mode)
+        for name in dict.fromkeys(collection_names)
+    }
+    # A collection still busy with an earlier search would only time out again
+    with _stragglers_lock:
+        busy = [name for name in cached if name in _stragglers]
+    for name in busy:
+        del cached[name]
+        print(
+            f"{common.PRNT_EMBED} Skipped collection [{name}], an earlier search is still running.",
+            flush=True,
+        )
+    # Embed the query once for all collections, unless every one is cached
+    query_bundle = QueryBundle(query_str=query)
+    if search_mode != LEXICAL and any(hits is None for hits in cached.values()):
+        embed_model = define_embedding_model(app)
+        query_bundle.embedding = embed_model.get_query_embedding(query)
+    # Threads of this query only, so searches that overrun do not hold up others
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, min(len(cached), MAX_RETRIEVAL_WORKERS)),
+        thread_name_prefix="retrieval",
+    )
+    futures = {
+        executor.submit(
+            retrieve_cached, app, name, query_bundle, top_k, search_mode, hits
+        ): name
+        for name, hits in cached.items()
+    }
+    # Collections run at the same time, so one deadline bounds each of them
+    done, not_done = wait(futures, timeout=timeout)
+    for future in not_done:
+        name = futures[future]
+        if not future.cancel():
+            track_straggler(name, future)
+        print(
+            f"{common.PRNT_EMBED} Skipped collection [{name}], no results within {timeout}s.",
+            flush=True,
+        )
+    executor.shutdown(wait=False, cancel_futures=True)
+    results = []
+    for future in done:
+        try:
+            results.append(future.result())
+        except Exception as err:
+            print(
+                f"{common.PRNT_EMBED} Skipped collection [{futures[future]}]: {err}",
+                flush=True,
+            )
+    if not results:
+        raise Exception("None of the collections could be searched.")
+    if len(futures) == 1:
+        return results[0][:top_k]
+    return fuse_results(results, top_k=top_k, mode=fusion_mode)
@@ -1,41 +1,36 @@
 import os
-import json
+import re
+import glob
+import asyncio
 from datetime import datetime, timezone
-from typing import Any, List
+from typing import Any, List, Optional, Tuple
 from core import classes, common
-from fastapi import APIRouter, Request, Depends, File, BackgroundTasks, UploadFile
+from fastapi import APIRouter, Request, Depends, File, UploadFile
 from . import storage, file_parsers, main
+from .ingest_jobs import get_ingestion_queue, job_to_response
 
 router = APIRouter()
 
+BACKGROUND_DELETE_MIN_CHUNKS = 5000  # bigger deletions run as a background job
+
 ###############
 ### Methods ###
 ###############
 
 
-# Given source(s), delete all associated document chunks, metadata and files
-def delete_sources(
-    app: Any, collection_name: str, sources: List[classes.SourceMetadata]
-):
-    db = storage.get_vector_db_client(app)
-    collection = db.get_collection(name=collection_name)
-    vector_index = main.load_embedding(app, collection_name)
-    # Delete each source chunk and parsed file
-    for source in sources:
-        chunk_ids = source.get("chunkIds")
-        # Delete all chunks
-        storage.delete_chunks(
-            collection=collection,
-            vector_index=vector_index,
-            chunk_ids=chunk_ids,
-        )
-        # Delete associated files
-        storage.delete_source_files(source)
-    # Update collection metadata.sources to remove this source
-    storage.update_collection_sources(
-        collection=collection,
-        sources=sources,
-        mode="delete",
+# Same file contents and document details, with no new chunking options to apply
+def is_unchanged(source: classes.SourceMetadata, input_file: dict, form: dict) -> bool:
+    rechunk = any(
+        form[key] is not None
+        for key in ("chunk_size", "chunk_overlap", "chunk_strategy", "parsing_method")
+    )
+    return (
+        not rechunk
+        and bool(input_file.get("checksum"))
+        and input_file["checksum"] == source.get("checksum")
+        and form["document_name"] == source.get("name")
+        and form["description"] == source.get("description")
+        and form["tags"] == source.get("tags")
     )
 
 
@@ -43,9 +38,8 @@ async def modify_document(
     app: Any,
     form: classes.EmbedDocumentRequest,
     file: UploadFile,
-    background_tasks: BackgroundTasks,
     is_update: bool = False,
-):
+) -> Optional[dict]:
     document_name = form.documentName
     prev_document_id = form.documentId
     source_name = form.documentName
@@ -70,7 +64,6 @@ async def modify_document(
         "document_id": source_id,
         "description": description,
         "tags": tags,
-        "embedder": app.state.embed_model,
         "chunk_size": chunk_size,
         "chunk_overlap": chunk_overlap,
         "chunk_strategy": chunk_strategy,
@@ -98,15 +91,6 @@ async def modify_document(
         )
     if tags == None:
         raise Exception("Invalid value for 'tags' input.")
-    # If updating, Remove specified source(s) from database
-    if is_update:
-        collection = storage.get_collection(app, name=collection_name)
-        sources_to_delete = storage.get_sources_from_ids(
-            collection=collection, source_ids=[prev_document_id]
-        )
-        delete_sources(
-            app=app, collection_name=collection_name, sources=sources_to_delete
-        )
     # Write uploaded file to disk temporarily
     input_file = await file_parsers.copy_file_to_disk(
         app=app,
@@ -116,24 +100,125 @@ async def modify_document(
         file=file,
         id=source_id,
     )
-    path_to_parsed_file = input_file.get("path_to_file")
-    # Read in files and create index nodes
-    nodes = await main.create_index_nodes(
-        app=app,
-        input_file=input_file,
-        form=form_data,
+    if not input_file:
+        raise Exception("Failed to read the source file.")
+    # If updating, the job diffs the new chunks against the stored ones
+    if is_update:
+        prev_sources = storage.get_sources_from_ids(
+            app=app, collection_name=collection_name, source_ids=[prev_document_id]
+        )
+        if prev_sources and is_unchanged(prev_sources[0], input_file, form_data):
+            os.remove(input_file["path_to_file"])
+            return None
+        form_data["is_update"] = True
+    # Parse, chunk and embed in the background. The job owns the copied file now.
+    job = get_ingestion_queue(app).submit(input_file=input_file, form=form_data)
+    return job
+
+
+# Supported files in a server folder and/or matching a glob pattern
+def list_source_files(
+    directory_path: str = "", glob_pattern: str = "", recursive: bool = True
+) -> List[str]:
+    paths = []
+    if directory_path:
+        if not os.path.isdir(directory_path):
+            raise Exception(f"Directory does not exist: {directory_path}")
+        if recursive:
+            pattern = os.path.join(directory_path, "**", "*")
+        else:
+            pattern = os.path.join(directory_path, "*")
+        paths.extend(glob.glob(pattern, recursive=recursive))
+    if glob_pattern:
+        paths.extend(glob.glob(glob_pattern, recursive=True))
+    return sorted(
+        {
+            path
+            for path in paths
+            if os.path.isfile(path)
+            and file_parsers.check_file_support(
+                common.get_file_extension_from_path(path)
+            )
+        }
     )
-    # Create embeddings
-    # @TODO Note that you must NOT perform CPU intensive computations in the background_tasks of the app,
-    # because it runs in the same async event loop that serves the requests and it will stall your app.
-    # Instead submit them to a thread pool or a process pool.
-    background_tasks.add_task(
-        main.create_new_embedding,
-        nodes=nodes,
-        form=form_data,
-        app=app,
+
+
+# Name a document after its file so it passes `common.check_valid_id`
+def document_name_from_path(path: str) -> str:
+    stem = os.path.splitext(os.path.basename(path))[0].lower()
+    name = re.sub(r"[^a-z0-9]+", "-", stem).strip("-")[:63].strip("-")
+    if len(name) < 3:
+        name = f"document-{name}".strip("-")
+    return name
+
+
+# Copy each uploaded, server or web file to disk and queue one ingestion job per file
+async def add_documents(
+    app: Any,
+    form: classes.EmbedDocumentsRequest,
+    files: List[UploadFile],
+) -> Tuple[List[dict], List[str]]:
+    collection_name = form.collectionName
+    tags = common.parse_valid_tags(form.tags)
+    if not collection_name or collection_name == "undefined":
+        raise Exception("Please supply a collection name.")
+    if tags == None:
+        raise Exception("Invalid value for 'tags' input.")
+    # Fail before copying anything if the collection is missing
+    storage.get_vector_db_client(app).get_collection(name=collection_name)
+    # (name, upload, server path, url) of each source
+    sources = [(upload.filename, upload, "", "") for upload in files or []]
+    sources.extend(
+        (path, None, path, "")
+        for path in list_source_files(
+            directory_path=form.directoryPath,
+            glob_pattern=form.globPattern,
+            recursive=form.recursive,
+        )
     )
-    return path_to_parsed_file
+    sources.extend((url, None, "", url) for url in (form.urlPaths or "").split())
+    if not sources:
+        raise Exception(
+            "Please supply file uploads, a directory, a glob pattern or urls."
+        )
+    source_ids = [
+        file_parsers.create_parsed_id(collection_name=collection_name) for _ in sources
+    ]
+    # Copy concurrently so downloads overlap, failures come back empty
+    input_files = await asyncio.gather(
+        *(
+            file_parsers.copy_file_to_disk(
+                app=app,
+                url_path=url_path,
+                file_path=file_path,
+                text_input="",
+                file=upload,
+                id=source_id,
+            )
+            for (_, upload, file_path, url_path), source_id in zip(sources, source_ids)
+        )
+    )
+    items = []
+    skipped = []
+    for (name, _, _, _), source_id, input_file in zip(sources, source_ids, input_files):
+        if not input_file:
+            skipped.append(name)
+            continue
+        form_data = {
+            "collection_name": collection_name,
+            "document_name": document_name_from_path(name),
+            "document_id": source_id,
+            "description": form.description,
+            "tags": tags,
+            "chunk_size": form.chunkSize,
+            "chunk_overlap": form.chunkOverlap,
+            "chunk_strategy": form.chunkStrategy,
+            "parsing_method": form.parsingMethod,
+        }
+        items.append((input_file, form_data))
+    # Jobs run in parallel across the ingestion worker processes
+    jobs = get_ingestion_queue(app).submit_many(items) if items else []
+    return jobs, skipped
 
 
 ##############
@@ -165,13 +250,14 @@ def create_memory_collection(
             "createdAt": datetime.now(timezone.utc).strftime("%B %d %Y - %H:%M:%S"),
             "tags": parsed_tags,
             "description": form.description,
-            "sources": json.dumps([]),
         }
         db_client = storage.get_vector_db_client(app)
         db_client.create_collection(
             name=collection_name,
             metadata=metadata,
         )
+        # Nothing to index yet, chunks are added to the keyword index as they are written
+        storage.get_lexical_index(app).rebuild(collection_name, [])
         msg = f'Successfully created new collection "{collection_name}"'
         print(f"{common.PRNT_API} {msg}")
         return {
@@ -196,17 +282,14 @@ async def create_memory(
     request: Request,
     form: classes.EmbedDocumentRequest = Depends(),
     file: UploadFile = File(None),  # File(...) means required
-    background_tasks: BackgroundTasks = None,  # This prop is auto populated by FastAPI
 ) -> classes.AddDocumentResponse:
-    tmp_input_file_path = ""
     app = request.app
 
     try:
-        tmp_input_file_path = await modify_document(
+        job = await modify_document(
             app=app,
             form=form,
             file=file,
-            background_tasks=background_tasks,
             is_update=False,
         )
     except (Exception, KeyError) as e:
@@ -223,12 +306,8 @@ async def create_memory(
         return {
             "success": True,
             "message": msg,
+            "data": job_to_response(job),
         }
-    finally:
-        # Delete uploaded tmp file
-        if os.path.exists(tmp_input_file_path):
-            os.remove(tmp_input_file_path)
-            print(f"{common.PRNT_API} Removed temp file.")
 
 
 # Re-process and re-embed document
@@ -237,17 +316,14 @@ async def update_memory(
     request: Request,
     form: classes.EmbedDocumentRequest = Depends(),
     file: UploadFile = File(None),  # File(...) means required
-    background_tasks: BackgroundTasks = None,  # This prop is auto populated by FastAPI
 ) -> classes.AddDocumentResponse:
-    tmp_input_file_path = ""
     app = request.app
 
     try:
-        tmp_input_file_path = await modify_document(
+        job = await modify_document(
             app=app,
             form=form,
             file=file,
-            background_tasks=background_tasks,
             is_update=True,
         )
     except (Exception, KeyError) as e:
@@ -259,17 +335,141 @@ async def update_memory(
             "message": msg,
         }
     else:
+        if not job:
+            msg = "The memory is unchanged, nothing to update."
+            print(f"{common.PRNT_API} {msg}", flush=True)
+            return {
+                "success": True,
+                "message": msg,
+                "data": None,
+            }
         msg = "A memory has been added to the update queue. It will be available for use shortly."
         print(f"{common.PRNT_API} {msg}", flush=True)
         return {
             "success": True,
             "message": msg,
+            "data": job_to_response(job),
+        }
+
+
+# Create memories from many files at once: a multipart batch of uploads,
+# every supported file in a server folder, or files matching a glob pattern.
+@router.post("/addDocuments")
+async def create_memories(
+    request: Request,
+    form: classes.EmbedDocumentsRequest = Depends(),
+    files: List[UploadFile] = File(None),
+) -> classes.AddDocumentsResponse:
+    app = request.app
+
+    try:
+        jobs, skipped = await add_documents(app=app, form=form, files=files)
+    except (Exception, KeyError) as e:
+        # Error
+        msg = f"Failed to add memories: {e}"
+        print(f"{common.PRNT_API} {msg}")
+        return {
+            "success": False,
+            "message": msg,
+            "data": [],
+        }
+    else:
+        msg = f"Added {len(jobs)} memories to the queue."
+        if skipped:
+            msg += f" Skipped {len(skipped)} unreadable file(s): {', '.join(skipped)}"
+        print(f"{common.PRNT_API} {msg}", flush=True)
+        return {
+            "success": True,
+            "message": msg,
+            "data": [job_to_response(job) for job in jobs],
+        }
+
+
+# List ingestion jobs, newest first
+@router.get("/jobs")
+def get_ingestion_jobs(
+    request: Request,
+    params: classes.GetIngestionJobsRequest = Depends(),
+) -> classes.IngestionJobsResponse:
+    app = request.app
+
+    try:
+        jobs = get_ingestion_queue(app).store.list(
+            collection_name=params.collectionName, status=params.status
+        )
+        return {
+            "success": True,
+            "message": f"Returned {len(jobs)} job(s).",
+            "data": [job_to_response(job) for job in jobs],
+        }
+    except Exception as e:
+        print(f"{common.PRNT_API} Error: {e}")
+        return {
+            "success": False,
+            "message": str(e),
+            "data": [],
+        }
+
+
+# Status and progress of one ingestion job
+@router.get("/jobs/{job_id}")
+def get_ingestion_job(request: Request, job_id: str) -> classes.IngestionJobResponse:
+    app = request.app
+    job = get_ingestion_queue(app).store.get(job_id)
+
+    if not job:
+        return {
+            "success": False,
+            "message": f"No job found for [{job_id}].",
+            "data": None,
+        }
+    return {
+        "success": True,
+        "message": f"Job [{job_id}] is {job['status']}.",
+        "data": job_to_response(job),
+    }
+
+
+# Stop a queued or running ingestion job, chunks it already wrote are removed
+@router.post("/jobs/{job_id}/cancel")
+def cancel_ingestion_job(request: Request, job_id: str) -> classes.IngestionJobResponse:
+    app = request.app
+    ingestion_queue = get_ingestion_queue(app)
+
+    if not ingestion_queue.cancel(job_id):
+        return {
+            "success": False,
+            "message": f"No queued or running job found for [{job_id}].",
+            "data": None,
+        }
+    return {
+        "success": True,
+        "message": f"Cancelled job [{job_id}].",
+        "data": job_to_response(ingestion_queue.store.get(job_id)),
+    }
+
+
+# Queue a failed or cancelled ingestion job again
+@router.post("/jobs/{job_id}/retry")
+def retry_ingestion_job(request: Request, job_id: str) -> classes.IngestionJobResponse:
+    app = request.app
+    ingestion_queue = get_ingestion_queue(app)
+
+    try:
+        if not ingestion_queue.retry(job_id):
+            raise Exception(f"No failed or cancelled job found for [{job_id}].")
+        return {
+            "success": True,
+            "message": f"Queued job [{job_id}] again.",
+            "data": job_to_response(ingestion_queue.store.get(job_id)),
+        }
+    except Exception as e:
+        print(f"{common.PRNT_API} Error: {e}")
+        return {
+            "success": False,
+            "message": str(e),
+            "data": None,
         }
-    finally:
-        # Delete uploaded tmp file
-        if os.path.exists(tmp_input_file_path):
-            os.remove(tmp_input_file_path)
-            print(f"{common.PRNT_API} Removed temp file.")
 
 
 @router.get("/getAllCollections")
@@ -295,6 +495,37 @@ def get_all_collections(
         }
 
 
+# Return a page of a collection's source documents
+@router.get("/getSources")
+def get_sources(
+    request: Request,
+    params: classes.GetSourcesRequest = Depends(),
+) -> classes.GetSourcesResponse:
+    app = request.app
+
+    try:
+        manifest = storage.get_source_manifest(app)
+        total = manifest.count(params.collectionName)
+        sources = manifest.list(
+            params.collectionName,
+            offset=params.offset or 0,
+            limit=params.limit,
+            include_chunks=params.includeChunks,
+        )
+        return {
+            "success": True,
+            "message": f"Returned {len(sources)} of {total} source(s)",
+            "data": {"total": total, "offset": params.offset, "sources": sources},
+        }
+    except Exception as e:
+        print(f"{common.PRNT_API} Error: {e}")
+        return {
+            "success": False,
+            "message": str(e),
+            "data": {},
+        }
+
+
 # Return a collection by id and all its documents
 @router.post("/getCollection")
 def get_collection(
@@ -385,14 +616,30 @@ def delete_document_sources(
         source_ids = params.document_ids
         num_documents = len(source_ids)
         # Find source data
-        collection = storage.get_collection(app, name=collection_name)
         sources_to_delete = storage.get_sources_from_ids(
-            collection=collection, source_ids=source_ids
+            app=app, collection_name=collection_name, source_ids=source_ids
         )
+        num_chunks = sum(len(s.get("chunkIds") or []) for s in sources_to_delete)
+        background = params.background
+        if background is None:
+            background = num_chunks >= BACKGROUND_DELETE_MIN_CHUNKS
+        # Large deletions run as a job that can be followed and cancelled
+        if background:
+            job = get_ingestion_queue(app).submit_deletion(
+                collection_name=collection_name,
+                source_ids=[s.get("id") for s in sources_to_delete],
+                total_chunks=num_chunks,
+            )
+            return {
+                "success": True,
+                "message": f"Queued removal of {num_documents} source(s): {source_ids}",
+                "data": job_to_response(job),
+            }
         # Remove specified source(s)
-        delete_sources(
+        storage.delete_sources(
             app=app, collection_name=collection_name, sources=sources_to_delete
         )
+        main.invalidate_index(app, collection_name)
 
         return {
             "success": True,
@@ -417,13 +664,17 @@ def delete_collection(
     try:
         collection_id = params.collection_id
         db = storage.get_vector_db_client(app)
-        collection = db.get_collection(collection_id)
-        # Remove all the sources in this collection
-        sources = storage.get_collection_sources(collection)
         # Remove all associated source files
-        delete_sources(app=app, collection_name=collection_id, sources=sources)
-        # Remove the collection
+        sources = storage.get_collection_sources(
+            app, collection_id, include_chunks=False
+        )
+        for source in sources:
+            storage.delete_source_files(source)
+        # Remove the collection, its chunks go with it
         db.delete_collection(name=collection_id)
+        storage.get_source_manifest(app).delete_collection(collection_id)
+        storage.get_lexical_index(app).delete_collection(collection_id)
+        main.invalidate_index(app, collection_id)
         # Remove persisted vector index from disk
         common.delete_vector_store(collection_id, storage.VECTOR_STORAGE_PATH)
         return {
@@ -449,6 +700,9 @@ def wipe_all_memories(
         # Delete all db values
         db = storage.get_vector_db_client(app)
         db.reset()
+        storage.get_source_manifest(app).clear()
+        storage.get_lexical_index(app).clear()
+        main.invalidate_index(app)
         # Delete all parsed files in /memories
         file_parsers.delete_all_files()
         # Remove all vector storage collections and folders
@@ -1,40 +1,110 @@
 import os
 import glob
 import json
-from typing import Any, List
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 from chromadb import Collection, PersistentClient  # HttpClient
 from chromadb.api import ClientAPI
 from chromadb.config import Settings
-from llama_index.core.schema import IndexNode
+from llama_index.core.schema import BaseNode, IndexNode, MetadataMode
+from llama_index.core.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.core import VectorStoreIndex, StorageContext
 from llama_index.core.callbacks import CallbackManager
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from core import common, classes
+from .chunking import chunk_hash
+from .manifest import SourceManifest, migrate_collection_metadata
+from .lexical import LexicalIndex
 
 VECTOR_DB_FOLDER = "chromadb"
 VECTOR_STORAGE_PATH = common.app_path(VECTOR_DB_FOLDER)
+manifest_lock = threading.Lock()
+lexical_lock = threading.Lock()
 
 # Helpers
 
 
 # Return source(s) given id(s) in a collection
 def get_sources_from_ids(
-    collection: Collection, source_ids: str
+    app: Any, collection_name: str, source_ids: List[str]
 ) -> List[classes.SourceMetadata]:
-    all_sources = get_collection_sources(collection)
-    sources = []
-    for s in all_sources:
-        if s.get("id") in source_ids:
-            sources.append(s)
-    return sources
+    return get_source_manifest(app).get(collection_name, source_ids)
 
 
-# Return the list of sources in this collection
-def get_collection_sources(collection: Collection) -> List[classes.SourceMetadata]:
-    sources_json = collection.metadata.get("sources")
-    if sources_json and type(sources_json) == str:
-        return json.loads(sources_json)
-    return sources_json
+# Return the list (or a page) of sources in this collection
+def get_collection_sources(
+    app: Any,
+    collection_name: str,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    include_chunks=True,
+) -> List[classes.SourceMetadata]:
+    return get_source_manifest(app).list(
+        collection_name, offset=offset, limit=limit, include_chunks=include_chunks
+    )
+
+
+# Create the source manifest singleton. Sources that older versions kept in
+# collection metadata are moved into it the first time.
+def get_source_manifest(app) -> SourceManifest:
+    with manifest_lock:
+        if app.state.source_manifest == None:
+            manifest = SourceManifest()
+            for collection in get_vector_db_client(app).list_collections():
+                migrate_collection_metadata(manifest, collection)
+            app.state.source_manifest = manifest
+    return app.state.source_manifest
+
+
+# Create the keyword index singleton
+def get_lexical_index(app) -> LexicalIndex:
+    with lexical_lock:
+        if app.state.lexical_index == None:
+            app.state.lexical_index = LexicalIndex()
+    return app.state.lexical_index
+
+
+# Make sure every chunk of a collection is in the keyword index. Collections made
+# before the index existed are read from the vector store once.
+def sync_lexical_index(app: Any, collection_name: str) -> LexicalIndex:
+    lexical_index = get_lexical_index(app)
+    if lexical_index.is_indexed(collection_name):
+        return lexical_index
+    collection = get_vector_db_client(app).get_collection(name=collection_name)
+
+    def stored_chunks():
+        total = collection.count()
+        for offset in range(0, total, 1000):
+            stored = collection.get(
+                offset=offset, limit=1000, include=["metadatas", "documents"]
+            )
+            for chunk_id, metadata, text in zip(
+                stored["ids"], stored["metadatas"], stored["documents"]
+            ):
+                yield chunk_id, (metadata or {}).get("sourceId") or "", text or ""
+
+    lexical_index.rebuild(collection_name, stored_chunks())
+    print(
+        f"{common.PRNT_EMBED} Built keyword index for [{collection_name}].", flush=True
+    )
+    return lexical_index
+
+
+# Keyword index rows for chunks about to be written
+def to_lexical_rows(nodes: List[BaseNode]) -> List[Tuple[str, str, str]]:
+    # Same text the vector store keeps as the chunk's document
+    return [
+        (
+            node.node_id,
+            node.metadata.get("sourceId") or "",
+            node.get_content(metadata_mode=MetadataMode.NONE),
+        )
+        for node in nodes
+    ]
 
 
 # Create a ChromaDB client singleton
@@ -64,7 +134,10 @@ def get_vector_db_client(app) -> ClientAPI:
 
 # Load a vector index from existing collection and add chunk IndexNode's to it
 def add_chunks_to_collection(
-    collection: Collection, nodes: List[IndexNode], callback_manager: CallbackManager
+    collection: Collection,
+    nodes: List[IndexNode],
+    callback_manager: CallbackManager,
+    embed_model: BaseEmbedding = None,  # defaults to Settings.embed_model
 ):
     # Assign chroma as the vector store to the context
     vector_store = ChromaVectorStore(chroma_collection=collection)
@@ -76,39 +149,28 @@ def add_chunks_to_collection(
         storage_context=storage_context,
         show_progress=True,
         callback_manager=callback_manager,
-        # embed_model=embed_model, # set from Settings
+        embed_model=embed_model,
     )
     # This will force store to disk any added docstore objects (llama-index)
     # index.storage_context.persist(out_path)
     return index
 
 
-# Add/remove or update Collection's metadata.sources list
+# Add/remove or update a collection's sources in the manifest
 def update_collection_sources(
-    collection: Collection,
+    app: Any,
+    collection_name: str,
     sources: List[classes.SourceMetadata],
     mode="add",
 ):
-    # Get current collection's sources
-    prev_sources = get_collection_sources(collection)
-    new_sources = []
-    # Set new sources
+    manifest = get_source_manifest(app)
     if mode == "add":
-        if prev_sources:
-            prev_sources.extend(sources)
-            new_sources = prev_sources
-        else:
-            new_sources = sources
-        print(f"{common.PRNT_API} Added {len(new_sources)} new sources to collection.")
+        # Sources that already exist are replaced
+        manifest.put(collection_name, sources)
+        print(f"{common.PRNT_API} Added {len(sources)} new sources to collection.")
     elif mode == "delete":
-        for i in sources:
-            if i in prev_sources:
-                prev_sources.remove(i)
-        new_sources = prev_sources
-        print(f"{common.PRNT_API} Removed {len(new_sources)} sources from collection.")
-    # Update the collection's metadata
-    collection.metadata["sources"] = json.dumps(new_sources)
-    collection.modify(metadata=collection.metadata)
+        manifest.delete(collection_name, [source.get("id") for source in sources])
+        print(f"{common.PRNT_API} Removed {len(sources)} sources from collection.")
 
 
 # Returns all collection names in the specified db
@@ -131,7 +193,8 @@ def get_all_collections(app: Any, tenant="default") -> List[dict]:
     for name in collection_names:
         # Deserialize some data for front-end
         collection = db.get_collection(name)
-        sources = get_collection_sources(collection)
+        # Chunk ids are left out, /getSources returns them when asked
+        sources = get_collection_sources(app, name, include_chunks=False)
         collection.metadata["sources"] = sources
         collections.append(collection)
     return collections
@@ -142,7 +205,7 @@ def get_collection(app: Any, name: str, tenant="default"):
     db = get_vector_db_client(app)
     collection = db.get_collection(name) or None
     # Deserialize some data for front-end
-    sources = get_collection_sources(collection)
+    sources = get_collection_sources(app, name, include_chunks=False)
     collection.metadata["sources"] = sources
     return collection
 
@@ -177,17 +240,60 @@ def get_source_chunks(app: Any, collection_name: str, source_id: str):
     return chunks
 
 
-# Delete chunk embeddings
-def delete_chunks(
-    collection: Collection,
-    vector_index: VectorStoreIndex,
-    chunk_ids: List[str],
+# Delete every chunk of the given source(s), filtered by `sourceId` in the vector store
+def delete_source_chunks(collection: Collection, source_ids: List[str]):
+    for i in range(0, len(source_ids), 500):
+        collection.delete(where={"sourceId": {"$in": source_ids[i : i + 500]}})
+
+
+# Map the content hash of each stored chunk to its id(s)
+def get_chunk_hashes(
+    collection: Collection, chunk_ids: List[str]
+) -> Dict[str, List[str]]:
+    hashes: Dict[str, List[str]] = {}
+    # Read in batches so large documents are not loaded all at once
+    for i in range(0, len(chunk_ids), 1000):
+        stored = collection.get(
+            ids=chunk_ids[i : i + 1000], include=["metadatas", "documents"]
+        )
+        for chunk_id, metadata, text in zip(
+            stored["ids"], stored["metadatas"], stored["documents"]
+        ):
+            node = metadata_dict_to_node(metadata, text=text)
+            hashes.setdefault(chunk_hash(node), []).append(chunk_id)
+    return hashes
+
+
+# Rewrite the metadata of stored chunks without touching their embeddings
+def update_chunks_metadata(collection: Collection, nodes: List[BaseNode]):
+    for i in range(0, len(nodes), 1000):
+        batch = nodes[i : i + 1000]
+        metadatas = []
+        for node in batch:
+            # Same layout `ChromaVectorStore.add` writes
+            metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=True)
+            metadatas.append({k: "" if v is None else v for k, v in metadata.items()})
+        collection.update(ids=[node.node_id for node in batch], metadatas=metadatas)
+
+
+# Given source(s), delete all associated document chunks, metadata and files
+def delete_sources(
+    app: Any, collection_name: str, sources: List[classes.SourceMetadata]
 ):
-    # Delete the embeddings from collection
-    collection.delete(ids=chunk_ids)
-    # Delete embeddings from llama-index
-    for c_id in chunk_ids:
-        vector_index.delete(c_id)
+    collection = get_vector_db_client(app).get_collection(name=collection_name)
+    source_ids = [source.get("id") for source in sources]
+    delete_source_chunks(collection=collection, source_ids=source_ids)
+    get_lexical_index(app).delete_sources(collection_name, source_ids)
+    # Delete associated files
+    for source in sources:
+        delete_source_files(source)
+    # Remove the source(s) from the collection's manifest
+    update_collection_sources(
+        app=app,
+        collection_name=collection_name,
+        sources=sources,
+        mode="delete",
+    )
 
 
 def delete_source_files(source: classes.SourceMetadata):
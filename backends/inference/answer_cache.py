@@ -0,0 +1,201 @@
+###
+# Cache of finished answers to deterministic completions (temperature 0 or a fixed
+# seed), so repeating a prompt, like an agent's tool call with the same arguments,
+# returns without running the LLM. Recent answers are kept in memory in front of a
+# SQLite store on disk that evicts least recently used answers past a size cap.
+# Optionally a prompt that only differs in the user's input can reuse the answer
+# given to a similar enough input, compared by embedding.
+###
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from core import common
+
+ANSWER_CACHE_PATH = common.app_path("answer_cache")
+ANSWER_CACHE_FILE = "answers.sqlite3"
+DEFAULT_ANSWER_CACHE_MAX_MB = 64
+MEMORY_CACHE_SIZE = 256  # answers also kept in memory
+EVICT_TO_RATIO = 0.9  # evict down to this fraction of the cap to avoid churn
+RANDOM_SEEDS = (None, -1, 0xFFFFFFFF)  # llama.cpp picks a new seed for these
+QUERY_MARK = "\x00query\x00"  # stands in for the user's input in a prompt
+
+answer_cache_lock = threading.Lock()
+
+
+# Only answers that would come out the same again are worth caching
+def is_deterministic(params: dict) -> bool:
+    return params.get("temperature") == 0 or params.get("seed") not in RANDOM_SEEDS
+
+
+def _hash(*parts: str) -> str:
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def _params_key(model_id: str, params: dict) -> str:
+    # Streaming changes how the answer is delivered, not what it is
+    params = {k: v for k, v in params.items() if k != "stream"}
+    return json.dumps([model_id, params], sort_keys=True, default=str)
+
+
+class AnswerCache:
+    def __init__(self, path: str = ANSWER_CACHE_PATH, max_bytes: int = 0):
+        self.max_bytes = max_bytes or DEFAULT_ANSWER_CACHE_MAX_MB * 1024**2
+        os.makedirs(path, exist_ok=True)
+        self._memory: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(path, ANSWER_CACHE_FILE), check_same_thread=False
+        )
+        # scope identifies the prompt apart from the user's input, for similar lookups
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "key TEXT PRIMARY KEY, scope TEXT, text TEXT NOT NULL, vector BLOB, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS answers_scope ON answers(scope)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS answers_last_used ON answers(last_used)"
+        )
+        self._db.commit()
+        row = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()
+        self.used_bytes = row[0]
+
+    # The cached answer to a fully formatted prompt. With a threshold, falls back to the
+    # answer for the most similar query (the user's input) within the same prompt.
+    def get(
+        self,
+        model_id: str,
+        prompt: str,
+        params: dict,
+        query: Optional[str] = None,
+        embed_model: Optional[BaseEmbedding] = None,
+        threshold: Optional[float] = None,
+    ) -> Optional[str]:
+        params_key = _params_key(model_id, params)
+        key = _hash(params_key, prompt)
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+                return text
+            row = self._db.execute(
+                "SELECT text FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                self._touch(key, row[0])
+                return row[0]
+        scope = self._scope(params_key, prompt, query)
+        if not (threshold and embed_model and scope):
+            return None
+        vector = np.asarray(embed_model.get_query_embedding(query), dtype=np.float32)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, text, vector FROM answers WHERE scope = ? AND vector IS NOT NULL",
+                (scope,),
+            ).fetchall()
+            best_key, best_text, best_score = None, None, threshold
+            for row_key, text, blob in rows:
+                cached = np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+                denom = np.linalg.norm(vector) * np.linalg.norm(cached)
+                score = float(vector @ cached / denom) if denom else 0.0
+                if score >= best_score:
+                    best_key, best_text, best_score = row_key, text, score
+            if best_key:
+                self._touch(best_key, best_text)
+                print(
+                    f"{common.PRNT_API} Answered from a similar cached prompt (similarity {best_score:.3f}).",
+                    flush=True,
+                )
+            return best_text
+
+    def put(
+        self,
+        model_id: str,
+        prompt: str,
+        params: dict,
+        text: str,
+        query: Optional[str] = None,
+        embed_model: Optional[BaseEmbedding] = None,
+    ):
+        params_key = _params_key(model_id, params)
+        key = _hash(params_key, prompt)
+        scope = self._scope(params_key, prompt, query)
+        vector = None
+        if embed_model and scope:
+            embedding = embed_model.get_query_embedding(query)
+            vector = np.asarray(embedding, dtype=np.float16).tobytes()
+        size = len(prompt) + len(text) + len(vector or b"")
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers (key, scope, text, vector, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, scope, text, vector, size, time.time()),
+            )
+            self._db.commit()
+            self.used_bytes += size - (row[0] if row else 0)
+            self._remember(key, text)
+            if self.used_bytes > self.max_bytes:
+                self._evict()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # The prompt without the user's input, when the input can be found in it
+    def _scope(self, params_key: str, prompt: str, query: Optional[str]):
+        query = (query or "").strip()
+        if not query or query not in prompt:
+            return None
+        return _hash(params_key, prompt.replace(query, QUERY_MARK))
+
+    def _touch(self, key: str, text: str):
+        self._db.execute(
+            "UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        self._db.commit()
+        self._remember(key, text)
+
+    def _remember(self, key: str, text: str):
+        self._memory[key] = text
+        self._memory.move_to_end(key)
+        while len(self._memory) > MEMORY_CACHE_SIZE:
+            self._memory.popitem(last=False)
+
+    # Drop least recently used answers until under the size cap
+    def _evict(self):
+        target = int(self.max_bytes * EVICT_TO_RATIO)
+        rows = self._db.execute("SELECT key, size FROM answers ORDER BY last_used ASC")
+        evict: List[tuple] = []
+        used = self.used_bytes
+        for key, size in rows:
+            if used <= target:
+                break
+            evict.append((key,))
+            used -= size
+        self._db.executemany("DELETE FROM answers WHERE key = ?", evict)
+        self._db.commit()
+        for (key,) in evict:
+            self._memory.pop(key, None)
+        self.used_bytes = used
+        print(f"{common.PRNT_API} Evicted {len(evict)} cached answers.", flush=True)
+
+
+# Return the app's answer cache, opening it on first use
+def get_answer_cache(app: Any) -> AnswerCache:
+    with answer_cache_lock:
+        if app.state.answer_cache == None:
+            max_mb = float(
+                os.getenv("ANSWER_CACHE_MAX_MB") or DEFAULT_ANSWER_CACHE_MAX_MB
+            )
+            app.state.answer_cache = AnswerCache(max_bytes=int(max_mb * 1024**2))
+    return app.state.answer_cache
@@ -0,0 +1,319 @@
+###
+# Continuous batching for text completions. Several requests decode together in one
+# llama.cpp batch, each as its own sequence in a shared KV cache. New requests join
+# at the next token boundary and finished ones leave without stalling the others.
+# The engine owns a second llama.cpp context on the already loaded weights and
+# drives it from a dedicated thread.
+###
+import queue
+import threading
+from typing import Iterator, List, Optional
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+from core import common
+
+REPEAT_LAST_N = 64  # tokens considered by the repetition penalties
+BATCH_END = object()  # marks the end of a request's token stream
+KV_BYTES_PER_VALUE = 2  # the batched context keeps its KV cache in f16
+DEFAULT_MIROSTAT_TAU = 5.0
+DEFAULT_TFS_Z = 1.0  # tail free sampling off
+
+
+# Whether a request needs llama.cpp's own sampler, `sample_token` only implements
+# temperature, top-k/p, min-p and the repetition penalties
+def needs_serial_sampling(options: dict) -> bool:
+    return bool(
+        options.get("grammar")
+        or options.get("mirostat_mode")
+        or options.get("mirostat_tau") not in (None, DEFAULT_MIROSTAT_TAU)
+        or options.get("tfs_z") not in (None, DEFAULT_TFS_Z)
+    )
+
+
+# Bytes of KV cache a context of `n_ctx` tokens allocates for the model
+def estimate_kv_bytes(model: Llama, n_ctx: int) -> int:
+    metadata = getattr(model, "metadata", None) or {}
+    arch = metadata.get("general.architecture", "llama")
+    n_layer = int(metadata.get(f"{arch}.block_count") or 0)
+    n_embd = int(metadata.get(f"{arch}.embedding_length") or 0)
+    n_head = int(metadata.get(f"{arch}.attention.head_count") or 1)
+    n_head_kv = int(metadata.get(f"{arch}.attention.head_count_kv") or n_head)
+    # Grouped-query attention stores fewer key/value heads than query heads
+    n_embd_kv = n_embd * n_head_kv // n_head
+    return 2 * n_layer * n_ctx * n_embd_kv * KV_BYTES_PER_VALUE
+
+
+class BatchRequest:
+    def __init__(
+        self,
+        tokens: List[int],
+        options: dict,
+        cancel_event: threading.Event,
+    ):
+        self.options = options
+        self.cancel_event = cancel_event
+        self.out: queue.Queue = queue.Queue()
+        self.rng = np.random.default_rng(options.get("seed"))
+        self.seq_id = -1
+        self.n_past = 0  # tokens of this sequence in the KV cache
+        self.pending = list(tokens)  # tokens waiting to be decoded
+        self.generated: List[int] = []
+        self.text_bytes = b""
+        self.text = ""
+        self.n_emitted = 0  # chars of `text` sent to the caller
+
+
+class BatchEngine:
+    def __init__(
+        self,
+        model: Llama,
+        n_parallel: int,
+        n_ctx: int,
+        n_batch: int = 512,
+        n_threads: Optional[int] = None,
+    ):
+        self.model = model
+        self.n_parallel = n_parallel
+        self.n_ctx = n_ctx  # per sequence
+        self.n_batch = max(n_batch, n_parallel)
+        self.n_vocab = model.n_vocab()
+        self.token_eos = model.token_eos()
+        # Every sequence gets a full context window of its own
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx * n_parallel
+        params.n_batch = self.n_batch
+        if hasattr(params, "n_seq_max"):
+            params.n_seq_max = n_parallel
+        if n_threads:
+            params.n_threads = n_threads
+            params.n_threads_batch = n_threads
+        self._ctx = llama_cpp.llama_new_context_with_model(model.model, params)
+        if not self._ctx:
+            raise Exception("Failed to create batched llama.cpp context.")
+        # Memory on top of the weights, counted by the model pool
+        self.kv_bytes = estimate_kv_bytes(model, params.n_ctx)
+        self._batch = llama_cpp.llama_batch_init(self.n_batch, 0, n_parallel)
+        self._free_seq_ids = list(range(n_parallel))
+        self._waiting: List[BatchRequest] = []
+        self._active: List[BatchRequest] = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name="batch-engine", daemon=True
+        )
+        self._thread.start()
+        print(
+            f"{common.PRNT_API} Batch engine decoding up to {n_parallel} sequences.",
+            flush=True,
+        )
+
+    # Queue a completion and yield its text as it is decoded. Safe to call
+    # from any thread, closing the generator early cancels the request.
+    def generate(
+        self,
+        prompt: str,
+        options: dict,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> Iterator[str]:
+        tokens = self.model.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+        max_tokens = options.get("max_tokens") or 0
+        if len(tokens) + max(max_tokens, 1) > self.n_ctx:
+            raise Exception(
+                f"Prompt of {len(tokens)} tokens exceeds the context window of {self.n_ctx}."
+            )
+        request = BatchRequest(tokens, options, cancel_event or threading.Event())
+        with self._cond:
+            if self._stopped:
+                raise Exception("Batch engine is shut down.")
+            self._waiting.append(request)
+            self._cond.notify()
+        try:
+            while True:
+                item = request.out.get()
+                if item is BATCH_END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Let the decode loop drop the sequence at the next token boundary
+            request.cancel_event.set()
+            with self._cond:
+                self._cond.notify()
+
+    def shutdown(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        llama_cpp.llama_batch_free(self._batch)
+        llama_cpp.llama_free(self._ctx)
+        self._ctx = None
+        print(f"{common.PRNT_API} Batch engine shut down.", flush=True)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._waiting and not self._active:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                self._admit()
+            try:
+                self._step()
+            except Exception as err:
+                print(f"{common.PRNT_API} Batch decode failed: {err}", flush=True)
+                for request in list(self._active):
+                    self._finish(request, err)
+        # Wake any callers still waiting on a stream
+        with self._cond:
+            waiting = self._waiting
+            self._waiting = []
+        for request in waiting + list(self._active):
+            self._finish(request, Exception("Batch engine is shut down."))
+
+    # Move queued requests into free sequence slots
+    def _admit(self):
+        for request in list(self._waiting):
+            if request.cancel_event.is_set():
+                self._waiting.remove(request)
+                request.out.put(BATCH_END)
+            elif self._free_seq_ids:
+                self._waiting.remove(request)
+                request.seq_id = self._free_seq_ids.pop(0)
+                self._active.append(request)
+
+    # Decode one batch: the next token of every generating sequence, then as
+    # much pending prompt as fits in the remaining batch capacity.
+    def _step(self):
+        for request in list(self._active):
+            if request.cancel_event.is_set():
+                self._finish(request)
+        if not self._active:
+            return
+        batch = self._batch
+        n_tokens = 0
+        logits_at = {}
+        by_pending = sorted(self._active, key=lambda r: len(r.pending))
+        for request in by_pending:
+            room = self.n_batch - n_tokens
+            if room <= 0:
+                break
+            chunk = request.pending[:room]
+            for i, token in enumerate(chunk):
+                batch.token[n_tokens] = token
+                batch.pos[n_tokens] = request.n_past + i
+                batch.n_seq_id[n_tokens] = 1
+                batch.seq_id[n_tokens][0] = request.seq_id
+                batch.logits[n_tokens] = False
+                n_tokens += 1
+            request.n_past += len(chunk)
+            request.pending = request.pending[len(chunk) :]
+            # Only sample once the whole prompt is in the cache
+            if not request.pending:
+                batch.logits[n_tokens - 1] = True
+                logits_at[request.seq_id] = n_tokens - 1
+        batch.n_tokens = n_tokens
+        result = llama_cpp.llama_decode(self._ctx, batch)
+        if result != 0:
+            raise Exception(f"llama_decode returned {result}")
+
+        for request in list(self._active):
+            index = logits_at.get(request.seq_id)
+            if index is None:
+                continue
+            ptr = llama_cpp.llama_get_logits_ith(self._ctx, index)
+            logits = np.ctypeslib.as_array(ptr, shape=(self.n_vocab,))
+            token = sample_token(logits, request)
+            self._accept(request, token)
+
+    # Record a sampled token, stream new text and retire finished sequences
+    def _accept(self, request: BatchRequest, token: int):
+        if token == self.token_eos:
+            self._finish(request)
+            return
+        request.generated.append(token)
+        request.pending = [token]
+        request.text_bytes += self.model.detokenize([token])
+        try:
+            request.text = request.text_bytes.decode("utf-8")
+        except UnicodeDecodeError:
+            # Wait for the rest of a multi-byte character
+            return
+        stops = [s for s in (request.options.get("stop") or []) if s]
+        for stop in stops:
+            index = request.text.find(stop, request.n_emitted)
+            if index != -1:
+                request.text = request.text[:index]
+                self._finish(request)
+                return
+        max_tokens = request.options.get("max_tokens") or 0
+        if (max_tokens and len(request.generated) >= max_tokens) or (
+            request.n_past + 1 >= self.n_ctx
+        ):
+            self._finish(request)
+            return
+        # Hold back text that could be the start of a stop sequence
+        holdback = max([len(s) for s in stops], default=1) - 1
+        end = len(request.text) - holdback
+        if end > request.n_emitted:
+            request.out.put(request.text[request.n_emitted : end])
+            request.n_emitted = end
+
+    # Flush remaining text, free the sequence's slot and end its stream
+    def _finish(self, request: BatchRequest, error: Exception = None):
+        if request in self._active:
+            self._active.remove(request)
+            llama_cpp.llama_kv_cache_seq_rm(self._ctx, request.seq_id, -1, -1)
+            self._free_seq_ids.append(request.seq_id)
+        if error:
+            request.out.put(error)
+            return
+        if not request.cancel_event.is_set() and len(request.text) > request.n_emitted:
+            request.out.put(request.text[request.n_emitted :])
+            request.n_emitted = len(request.text)
+        request.out.put(BATCH_END)
+
+
+# Pick the next token using the request's sampling options, the model's generate
+# settings like the serial path samples with. Mirostat and tfs are not supported
+# here, requests that need them or grammar use the serial path.
+def sample_token(logits: np.ndarray, request: BatchRequest) -> int:
+    options = request.options
+    logits = logits.astype(np.float32, copy=True)
+    if request.generated:
+        recent, counts = np.unique(
+            request.generated[-REPEAT_LAST_N:], return_counts=True
+        )
+        repeat_penalty = options.get("repeat_penalty") or 1.0
+        values = logits[recent]
+        logits[recent] = np.where(
+            values > 0, values / repeat_penalty, values * repeat_penalty
+        )
+        logits[recent] -= counts * (options.get("frequency_penalty") or 0.0)
+        logits[recent] -= options.get("presence_penalty") or 0.0
+
+    temperature = options.get("temperature") or 0.0
+    if temperature <= 0:
+        return int(np.argmax(logits))
+
+    candidates = np.arange(len(logits))
+    top_k = options.get("top_k") or 0
+    if 0 < top_k < len(logits):
+        candidates = np.argpartition(logits, -top_k)[-top_k:]
+    scores = logits[candidates] / temperature
+    probs = np.exp(scores - np.max(scores))
+    probs /= probs.sum()
+    order = np.argsort(-probs)
+    candidates, probs = candidates[order], probs[order]
+    min_p = options.get("min_p") or 0.0
+    if min_p > 0:
+        keep = probs >= min_p * probs[0]
+        candidates, probs = candidates[keep], probs[keep]
+    top_p = options.get("top_p") or 1.0
+    if top_p < 1.0:
+        cutoff = int(np.searchsorted(np.cumsum(probs), top_p)) + 1
+        candidates, probs = candidates[:cutoff], probs[:cutoff]
+    probs /= probs.sum()
+    return int(request.rng.choice(candidates, p=probs))
@@ -0,0 +1,459 @@
+###
+# Downloads model files from the hub in parallel byte-range segments. Downloads are
+# queued and can be cancelled, pick up where an interrupted attempt stopped, and are
+# checked against the hub's sha256 before being placed in the huggingface cache
+# layout, so the rest of the app finds them like any other cached model.
+# Progress and throughput are published to listeners as server-sent events.
+# Jobs and their events belong to the event loop, so the routes that use the manager
+# are async and nothing here needs a lock.
+###
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import AsyncGenerator, List, Optional
+import httpx
+from nanoid import generate as generate_uuid
+from huggingface_hub import get_hf_file_metadata, hf_hub_url
+from huggingface_hub.file_download import repo_folder_name
+from core import common
+from core.http_client import RETRY_STATUS_CODES, HttpClient
+from inference.model_registry import ModelRegistry
+
+DOWNLOADS_FOLDER = "downloads"  # partial files, inside the models cache dir
+DEFAULT_SEGMENTS = 4  # parallel range requests per file
+DEFAULT_MAX_DOWNLOADS = 1  # files downloaded at the same time
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024  # smaller files use fewer segments
+CHUNK_SIZE = 1024 * 1024  # 1mb
+MAX_SEGMENT_RETRIES = 5
+RETRY_BACKOFF = 1.0  # seconds, doubled after each attempt
+PROGRESS_INTERVAL = 1.0  # seconds between progress events and saved resume state
+MAX_FINISHED_DOWNLOADS = 50  # finished downloads still listed
+PROGRESS_EVENT = "DOWNLOAD_PROGRESS"
+
+
+class DOWNLOAD_STATUS:
+    QUEUED = "queued"
+    RUNNING = "running"
+    VERIFYING = "verifying"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+FINISHED = (DOWNLOAD_STATUS.DONE, DOWNLOAD_STATUS.FAILED, DOWNLOAD_STATUS.CANCELLED)
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class DownloadJob:
+    def __init__(self, repo_id: str, filename: str):
+        self.id = generate_uuid()
+        self.repo_id = repo_id
+        self.filename = filename
+        self.status = DOWNLOAD_STATUS.QUEUED
+        self.total_bytes = 0
+        self.downloaded_bytes = 0
+        self.bytes_per_second = 0.0
+        self.error = None
+        self.file_path = None
+        self.created_at = time.time()
+        self.cancel_event = asyncio.Event()
+        self._changed = asyncio.Event()
+
+    @property
+    def is_finished(self):
+        return self.status in FINISHED
+
+    # Set by the next update, read it before waiting
+    @property
+    def changed(self) -> asyncio.Event:
+        return self._changed
+
+    # Wake every listener waiting for the next update
+    def notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "repoId": self.repo_id,
+            "filename": self.filename,
+            "status": self.status,
+            "totalBytes": self.total_bytes,
+            "downloadedBytes": self.downloaded_bytes,
+            "progress": (
+                self.downloaded_bytes / self.total_bytes if self.total_bytes else 0.0
+            ),
+            "bytesPerSecond": round(self.bytes_per_second),
+            "error": self.error,
+            "filePath": self.file_path,
+            "createdAt": self.created_at,
+        }
+
+
+class DownloadManager:
+    def __init__(
+        self,
+        client: HttpClient,
+        cache_dir: str,
+        registry: ModelRegistry,
+        segments: int = DEFAULT_SEGMENTS,
+        max_downloads: int = DEFAULT_MAX_DOWNLOADS,
+        endpoint: Optional[str] = None,  # the hub, or a local stand-in for it
+    ):
+        self.client = client
+        self.cache_dir = cache_dir
+        self.registry = registry
+        self.segments = max(1, segments)
+        self.max_downloads = max(1, max_downloads)
+        self.endpoint = endpoint
+        self.jobs: OrderedDict[str, DownloadJob] = OrderedDict()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+
+    # Queue a file, or return the download already in progress for it
+    def submit(self, repo_id: str, filename: str) -> DownloadJob:
+        for job in self.jobs.values():
+            if (
+                job.repo_id == repo_id
+                and job.filename == filename
+                and not job.is_finished
+            ):
+                return job
+        job = DownloadJob(repo_id=repo_id, filename=filename)
+        self.jobs[job.id] = job
+        self._forget_finished()
+        self._queue.put_nowait(job)
+        # Workers start with the first download
+        while len(self._workers) < self.max_downloads:
+            self._workers.append(asyncio.create_task(self._work()))
+        return job
+
+    def get(self, job_id: str) -> Optional[DownloadJob]:
+        return self.jobs.get(job_id)
+
+    def list(self) -> List[DownloadJob]:
+        return list(reversed(self.jobs.values()))
+
+    # Stop a queued or running download and discard what was fetched
+    def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if not job or job.is_finished or job.status == DOWNLOAD_STATUS.VERIFYING:
+            return False
+        job.cancel_event.set()
+        if job.status == DOWNLOAD_STATUS.QUEUED:
+            self._finish(job, DOWNLOAD_STATUS.CANCELLED)
+        return True
+
+    # Server-sent events with the download's progress until it finishes
+    async def events(self, job_id: str) -> AsyncGenerator[str, None]:
+        job = self.jobs[job_id]
+        while True:
+            changed = job.changed
+            yield json.dumps({"event": PROGRESS_EVENT, "data": job.to_dict()})
+            if job.is_finished:
+                return
+            await changed.wait()
+
+    # Interrupted downloads keep their partial file and resume next time
+    async def shutdown(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self):
+        while True:
+            job: DownloadJob = await self._queue.get()
+            if job.is_finished:
+                continue
+            try:
+                await self._download(job)
+                self._finish(job, DOWNLOAD_STATUS.DONE)
+            except DownloadCancelled:
+                self._remove_partial(job)
+                self._finish(job, DOWNLOAD_STATUS.CANCELLED)
+            except asyncio.CancelledError:
+                self._finish(job, DOWNLOAD_STATUS.FAILED, "Server shut down.")
+                raise
+            except Exception as err:
+                print(
+                    f"{common.PRNT_API} Download of {job.repo_id}/{job.filename} failed: {err}",
+                    flush=True,
+                )
+                self._finish(job, DOWNLOAD_STATUS.FAILED, str(err))
+
+    async def _download(self, job: DownloadJob):
+        job.status = DOWNLOAD_STATUS.RUNNING
+        job.notify()
+        url = hf_hub_url(
+            repo_id=job.repo_id, filename=job.filename, endpoint=self.endpoint
+        )
+        metadata = await asyncio.to_thread(get_hf_file_metadata, url)
+        if not metadata.size or not metadata.etag or not metadata.commit_hash:
+            raise Exception("The hub did not return the file's size and version.")
+        job.total_bytes = metadata.size
+        part_path = self._part_path(job)
+        state = await asyncio.to_thread(
+            self._load_state, part_path, metadata.etag, metadata.size
+        )
+        if not state:
+            state = self._plan(metadata.etag, metadata.size, self.segments)
+            await asyncio.to_thread(self._allocate, part_path, metadata.size)
+        print(
+            f"{common.PRNT_API} Downloading {job.repo_id}/{job.filename} in {len(state['segments'])} segment(s)...",
+            flush=True,
+        )
+        # Presigned file location, saves a redirect on every range request
+        location = metadata.location or url
+        try:
+            await self._fetch(job, location, part_path, state)
+        except RangeNotSupported:
+            # Start over with the whole file in one request
+            state = self._plan(metadata.etag, metadata.size, 1)
+            await self._fetch(job, location, part_path, state)
+        job.status = DOWNLOAD_STATUS.VERIFYING
+        job.notify()
+        await asyncio.to_thread(self._verify, part_path, metadata.etag, metadata.size)
+        job.file_path = await asyncio.to_thread(
+            self._install, job, part_path, metadata.etag, metadata.commit_hash
+        )
+        # Index where the file landed so listing models never scans the cache
+        await asyncio.to_thread(
+            self.registry.put_file,
+            job.repo_id,
+            job.filename,
+            blob_path=job.file_path,
+            revision=metadata.commit_hash,
+            size=metadata.size,
+        )
+
+    # Fetch every unfinished segment at once while reporting progress
+    async def _fetch(self, job: DownloadJob, url: str, part_path: str, state: dict):
+        job.downloaded_bytes = sum(done for _, _, done in state["segments"])
+        reporter = asyncio.create_task(self._report(job, part_path, state))
+        tasks = [
+            asyncio.create_task(self._fetch_segment(job, url, part_path, segment))
+            for segment in state["segments"]
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            # One failed segment stops the others
+            for task in tasks + [reporter]:
+                task.cancel()
+            await asyncio.gather(*tasks, reporter, return_exceptions=True)
+            await asyncio.to_thread(self._save_state, part_path, state)
+        for task in done:
+            if task.exception():
+                raise task.exception()
+
+    # Download bytes [start, end] of the file, resuming after dropped connections
+    async def _fetch_segment(
+        self, job: DownloadJob, url: str, part_path: str, segment: list
+    ):
+        start, end, _ = segment
+        attempt = 0
+        while start + segment[2] <= end:
+            offset = start + segment[2]
+            headers = {"Range": f"bytes={offset}-{end}"}
+            error = None
+            try:
+                # Error statuses raise before the response is handed over
+                async with self.client.stream("GET", url, headers=headers) as res:
+                    # A server that ignores the range sends the whole file, only
+                    # usable when the whole file was asked for
+                    if res.status_code == 200 and not (
+                        offset == 0 and end == job.total_bytes - 1
+                    ):
+                        raise RangeNotSupported()
+                    file = await asyncio.to_thread(open, part_path, "r+b")
+                    try:
+                        await asyncio.to_thread(file.seek, offset)
+                        async for block in res.aiter_bytes(chunk_size=CHUNK_SIZE):
+                            if job.cancel_event.is_set():
+                                raise DownloadCancelled()
+                            block = block[: end + 1 - (start + segment[2])]
+                            await asyncio.to_thread(file.write, block)
+                            segment[2] += len(block)
+                            job.downloaded_bytes += len(block)
+                    finally:
+                        await asyncio.to_thread(file.close)
+            except httpx.HTTPStatusError as err:
+                # Denied or unsatisfiable ranges will not succeed on a retry
+                if err.response.status_code not in RETRY_STATUS_CODES:
+                    raise
+                error = err
+            except httpx.TransportError as err:
+                error = err
+            if job.cancel_event.is_set():
+                raise DownloadCancelled()
+            # Dropped connections resume from the last byte written
+            if error or start + segment[2] == offset:
+                attempt += 1
+                if attempt > MAX_SEGMENT_RETRIES:
+                    raise Exception(
+                        f"Segment failed after {attempt} attempts: {error or 'no data received'}"
+                    )
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    # Publish throughput and save the resume state every interval
+    async def _report(self, job: DownloadJob, part_path: str, state: dict):
+        last_bytes = job.downloaded_bytes
+        last_time = time.monotonic()
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            now = time.monotonic()
+            speed = (job.downloaded_bytes - last_bytes) / (now - last_time)
+            # Smoothed so the estimate does not jump around
+            job.bytes_per_second = 0.7 * job.bytes_per_second + 0.3 * speed
+            last_bytes, last_time = job.downloaded_bytes, now
+            await asyncio.to_thread(self._save_state, part_path, state)
+            job.notify()
+
+    def _finish(self, job: DownloadJob, status: str, error: str = None):
+        job.status = status
+        job.error = error
+        job.bytes_per_second = 0.0
+        job.notify()
+        print(
+            f"{common.PRNT_API} Download of {job.repo_id}/{job.filename} {status}.",
+            flush=True,
+        )
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished]
+        for job_id in finished[: max(0, len(finished) - MAX_FINISHED_DOWNLOADS)]:
+            del self.jobs[job_id]
+
+    def _part_path(self, job: DownloadJob) -> str:
+        name = repo_folder_name(repo_id=job.repo_id, repo_type="model")
+        return os.path.join(
+            self.cache_dir, DOWNLOADS_FOLDER, f"{name}--{job.filename}.part"
+        )
+
+    def _remove_partial(self, job: DownloadJob):
+        part_path = self._part_path(job)
+        for path in (part_path, f"{part_path}.json"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Split the file into [start, end, bytes done] segments
+    @staticmethod
+    def _plan(etag: str, size: int, segments: int) -> dict:
+        count = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+        step = -(-size // count)
+        return {
+            "etag": etag,
+            "size": size,
+            "segments": [
+                [start, min(start + step, size) - 1, 0]
+                for start in range(0, size, step)
+            ],
+        }
+
+    # Resume state of an earlier attempt at the same version of the file
+    @staticmethod
+    def _load_state(part_path: str, etag: str, size: int) -> Optional[dict]:
+        try:
+            with open(f"{part_path}.json", "r") as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if (
+            state.get("etag") != etag
+            or state.get("size") != size
+            or not os.path.exists(part_path)
+        ):
+            return None
+        return state
+
+    @staticmethod
+    def _save_state(part_path: str, state: dict):
+        tmp_path = f"{part_path}.json.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, f"{part_path}.json")
+
+    @staticmethod
+    def _allocate(part_path: str, size: int):
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        with open(part_path, "wb") as file:
+            file.truncate(size)
+
+    # Large files on the hub are identified by their sha256
+    @staticmethod
+    def _verify(part_path: str, etag: str, size: int):
+        if os.path.getsize(part_path) != size:
+            raise Exception("Downloaded file has the wrong size.")
+        if len(etag) != 64:
+            return
+        digest = hashlib.sha256()
+        with open(part_path, "rb") as file:
+            while block := file.read(CHUNK_SIZE):
+                digest.update(block)
+        if digest.hexdigest() != etag:
+            os.remove(part_path)
+            os.remove(f"{part_path}.json")
+            raise Exception("Checksum mismatch, the download was discarded.")
+
+    # Move the file into the cache as hf_hub_download would and return its blob path
+    def _install(
+        self, job: DownloadJob, part_path: str, etag: str, commit_hash: str
+    ) -> str:
+        repo_path = os.path.join(
+            self.cache_dir, repo_folder_name(repo_id=job.repo_id, repo_type="model")
+        )
+        blob_path = os.path.join(repo_path, "blobs", etag)
+        snapshot_path = os.path.join(repo_path, "snapshots", commit_hash, job.filename)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        os.makedirs(os.path.join(repo_path, "refs"), exist_ok=True)
+        os.replace(part_path, blob_path)
+        os.remove(f"{part_path}.json")
+        with open(os.path.join(repo_path, "refs", "main"), "w") as file:
+            file.write(commit_hash)
+        if os.path.lexists(snapshot_path):
+            os.remove(snapshot_path)
+        try:
+            os.symlink(
+                os.path.relpath(blob_path, os.path.dirname(snapshot_path)),
+                snapshot_path,
+            )
+        except OSError:
+            # Symlinks need extra privileges on Windows, keep the file in the snapshot
+            os.replace(blob_path, snapshot_path)
+            return snapshot_path
+        return blob_path
+
+    # Remove every revision of a repo from the cache, returns the bytes freed.
+    # Only touches files, so safe to call from any thread.
+    def uninstall(self, repo_id: str) -> int:
+        repo_path = os.path.join(
+            self.cache_dir, repo_folder_name(repo_id=repo_id, repo_type="model")
+        )
+        freed = 0
+        for root, _, files in os.walk(repo_path):
+            for name in files:
+                path = os.path.join(root, name)
+                # Snapshot symlinks point at blobs already counted
+                if not os.path.islink(path):
+                    freed += os.path.getsize(path)
+        shutil.rmtree(repo_path, ignore_errors=True)
+        return freed
+
+
+# Return the app's download manager
+def get_download_manager(app) -> DownloadManager:
+    return app.state.download_manager
@@ -0,0 +1,87 @@
+###
+# Runs blocking llama.cpp work on a dedicated thread so the event loop stays free
+# to serve control-plane endpoints (ping, memory, persist) during generation.
+###
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncGenerator, Callable, Iterator, Optional
+from core import common
+
+# Marks the end of a token stream pushed from the worker thread
+STREAM_END = object()
+
+
+class StreamError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+# A single worker thread owns the loaded model. Every completion, stream and
+# (un)load is submitted here so llama.cpp is never touched from two threads.
+# More workers are only safe for work that does not share a llama.cpp context.
+class InferenceExecutor:
+    def __init__(self, name: str = "inference", max_workers: int = 1):
+        self.name = name
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+
+    # Run a blocking call on the worker thread from sync code (e.g. a `def` route)
+    def submit(self, func: Callable, *args, **kwargs) -> Any:
+        future = self._pool.submit(func, *args, **kwargs)
+        return future.result()
+
+    # Run a blocking call on the worker thread and await its result
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, lambda: func(*args, **kwargs))
+
+    # Iterate a synchronous generator on the worker thread and bridge each item
+    # back to the event loop through an asyncio queue. Setting `cancel_event`
+    # (or closing this stream, e.g. when the client disconnects) stops the
+    # generator before its next token.
+    async def stream(
+        self,
+        generator_factory: Callable[[], Iterator[Any]],
+        cancel_event: Optional[threading.Event] = None,
+    ) -> AsyncGenerator[Any, None]:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancel_event = cancel_event or threading.Event()
+
+        def produce():
+            generator = None
+            try:
+                if cancel_event.is_set():
+                    return
+                generator = generator_factory()
+                for item in generator:
+                    if cancel_event.is_set():
+                        print(f"{common.PRNT_API} Generation cancelled.", flush=True)
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+            except Exception as err:
+                loop.call_soon_threadsafe(queue.put_nowait, StreamError(err))
+            finally:
+                # Stops the underlying llama.cpp decode loop
+                if generator is not None:
+                    generator.close()
+                loop.call_soon_threadsafe(queue.put_nowait, STREAM_END)
+
+        loop.run_in_executor(self._pool, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is STREAM_END:
+                    break
+                if isinstance(item, StreamError):
+                    raise item.error
+                yield item
+        finally:
+            # Consumer went away (disconnect, cancel or done), free the worker
+            cancel_event.set()
+
+    def shutdown(self):
+        print(f"{common.PRNT_API} Shutting down {self.name} executor.", flush=True)
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,296 @@
+###
+# Keeps several text models resident at once, keyed by modelId. When loading a new
+# model would exceed the memory budget, the least-recently-used model is ejected.
+# Loading and ejecting take seconds, so they run without holding the pool's lock.
+# Each resident model has its own executor thread that owns its llama.cpp context.
+###
+import os
+import time
+import threading
+from concurrent.futures import Future, wait
+from typing import Callable, Dict, List, Optional
+from llama_index.llms.llama_cpp import LlamaCPP
+from inference.executor import InferenceExecutor
+from inference.batching import BatchEngine
+from inference import text_llama_index
+from core import common
+
+DEFAULT_POOL_MAX_GB = 16
+
+
+class PooledModel:
+    def __init__(
+        self,
+        model_id: str,
+        path_to_model: str,
+        size_bytes: int,
+    ):
+        self.model_id = model_id
+        self.path_to_model = path_to_model
+        self.size_bytes = size_bytes
+        self.llm: Optional[LlamaCPP] = None
+        self.metadata: dict = {}  # same shape as `app.state.loaded_text_model_data`
+        self.last_used = time.time()
+        self.executor = InferenceExecutor(name=f"inference-{model_id}")
+        # Set when the model was loaded with n_parallel > 1
+        self.batch_engine: Optional[BatchEngine] = None
+        self.batch_executor: Optional[InferenceExecutor] = None
+
+
+class ModelPool:
+    def __init__(
+        self,
+        max_bytes: int,
+        # Called with the model id before a model's thread stops, from any thread
+        on_unload: Optional[Callable[[str], None]] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.on_unload = on_unload
+        self._models: Dict[str, PooledModel] = {}
+        self._loading: Dict[str, Future] = {}
+        self._reserved_bytes = 0  # budget held by models still loading
+        # Only guards the bookkeeping, loads and drains happen outside of it
+        self._lock = threading.Lock()
+
+    @property
+    def used_bytes(self) -> int:
+        return sum(m.size_bytes for m in list(self._models.values()))
+
+    def __contains__(self, model_id: str):
+        return model_id in self._models
+
+    # Return a resident model and mark it as most recently used.
+    # Lock free, it is called on the event loop for every request.
+    def get(self, model_id: str) -> Optional[PooledModel]:
+        entry = self._models.get(model_id)
+        if entry:
+            entry.last_used = time.time()
+        return entry
+
+    # The most recently used model, if any
+    def most_recent(self) -> Optional[PooledModel]:
+        return max(list(self._models.values()), key=lambda m: m.last_used, default=None)
+
+    # Load a model into the pool on its own thread, evicting others to make room
+    def load(
+        self,
+        model_id: str,
+        path_to_model: str,
+        mode: str,
+        init_settings,
+        gen_settings,
+        callback_manager=None,
+    ) -> PooledModel:
+        # One load per model at a time, a second request waits for the first to end
+        while True:
+            with self._lock:
+                pending = self._loading.get(model_id)
+                if not pending:
+                    loading = Future()
+                    self._loading[model_id] = loading
+                    break
+            wait([pending])
+        try:
+            entry = self._load(
+                model_id,
+                path_to_model,
+                mode,
+                init_settings,
+                gen_settings,
+                callback_manager,
+            )
+            loading.set_result(entry)
+            return entry
+        except BaseException as err:
+            loading.set_exception(err)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(model_id, None)
+
+    def _load(
+        self,
+        model_id: str,
+        path_to_model: str,
+        mode: str,
+        init_settings,
+        gen_settings,
+        callback_manager,
+    ) -> PooledModel:
+        # The prompt cache grows to its capacity, so it counts from the start
+        size_bytes = os.path.getsize(path_to_model)
+        size_bytes += text_llama_index.prompt_cache_bytes(init_settings)
+        # Claim room in the budget, then wait for the evicted models outside the lock
+        with self._lock:
+            evicted = [self._models.pop(model_id, None)]
+            evicted += self._take_lru(size_bytes)
+            self._reserved_bytes += size_bytes
+        try:
+            for old_entry in filter(None, evicted):
+                self._release(old_entry)
+            entry = PooledModel(
+                model_id=model_id,
+                path_to_model=path_to_model,
+                size_bytes=size_bytes,
+            )
+            try:
+                entry.llm = entry.executor.submit(
+                    text_llama_index.load_text_model,
+                    path_to_model,
+                    mode,
+                    init_settings,
+                    gen_settings,
+                    callback_manager=callback_manager,
+                )
+                n_parallel = init_settings.n_parallel or 1
+                if n_parallel > 1:
+                    entry.batch_engine = entry.executor.submit(
+                        text_llama_index.load_batch_engine,
+                        entry.llm,
+                        init_settings,
+                    )
+                    # One worker per sequence, each only waits on the engine
+                    entry.batch_executor = InferenceExecutor(
+                        name=f"batch-{model_id}", max_workers=n_parallel
+                    )
+            except Exception:
+                entry.executor.shutdown()
+                raise
+            entry.metadata = {
+                "modelId": model_id,
+                "mode": mode,
+                "modelSettings": init_settings,
+                "generateSettings": gen_settings,
+            }
+            # The batched context's KV cache is only known once it exists
+            if entry.batch_engine:
+                entry.size_bytes += entry.batch_engine.kv_bytes
+                with self._lock:
+                    evicted = self._take_lru(entry.batch_engine.kv_bytes)
+                for old_entry in evicted:
+                    self._release(old_entry)
+            with self._lock:
+                self._models[model_id] = entry
+        finally:
+            with self._lock:
+                self._reserved_bytes -= size_bytes
+        print(
+            f"{common.PRNT_API} Model pool using {self.used_bytes} of {self.max_bytes} bytes.",
+            flush=True,
+        )
+        return entry
+
+    # Patch the generation settings of a resident model without reloading it.
+    # Waits for the generation in progress, if any, to finish first. The batch
+    # engine keeps no settings of its own, each batched completion is handed the
+    # ones in `metadata` so they apply from the next request too.
+    def update_settings(
+        self,
+        model_id: str,
+        gen_settings,
+        mode: str = None,
+    ) -> PooledModel:
+        entry = self._models.get(model_id)
+        if not entry:
+            raise Exception(f"Model {model_id} is not loaded.")
+        mode = mode or entry.metadata.get("mode")
+        # Queued on the model's thread so a running generation keeps its settings
+        entry.executor.submit(
+            text_llama_index.update_generate_settings,
+            entry.llm,
+            mode,
+            entry.metadata.get("modelSettings"),
+            gen_settings,
+        )
+        entry.metadata = {
+            **entry.metadata,
+            "mode": mode,
+            "generateSettings": gen_settings,
+        }
+        return entry
+
+    # Eject a model once its in-flight work has finished
+    def unload(self, model_id: str):
+        with self._lock:
+            entry = self._models.pop(model_id, None)
+        if entry:
+            self._release(entry)
+
+    def unload_all(self):
+        for model_id in list(self._models.keys()):
+            self.unload(model_id)
+
+    # Stop a model that is already out of the pool
+    def _release(self, entry: PooledModel):
+        # Requests still queued for it would find its thread gone
+        if self.on_unload:
+            self.on_unload(entry.model_id)
+
+        def release():
+            if entry.batch_engine:
+                entry.batch_engine.shutdown()
+                entry.batch_engine = None
+            text_llama_index.unload_text_model(entry.llm)
+            entry.llm = None
+
+        if entry.batch_executor:
+            entry.batch_executor.shutdown()
+        entry.executor.submit(release)
+        entry.executor.shutdown()
+        print(
+            f"{common.PRNT_API} Ejected model {entry.model_id} from pool.", flush=True
+        )
+
+    # Take least-recently-used models out until `size_bytes` fits in the budget.
+    # A model larger than the whole budget is still allowed to load on its own.
+    # Called with the lock held.
+    def _take_lru(self, size_bytes: int) -> List[PooledModel]:
+        taken: List[PooledModel] = []
+        while (
+            self._models
+            and self.used_bytes + self._reserved_bytes + size_bytes > self.max_bytes
+        ):
+            lru = min(self._models.values(), key=lambda m: m.last_used)
+            print(
+                f"{common.PRNT_API} Evicting least recently used model {lru.model_id}"
+            )
+            taken.append(self._models.pop(lru.model_id))
+        return taken
+
+    def stats(self, active_model_id: str = "") -> dict:
+        models: List[dict] = []
+        resident = list(self._models.values())
+        for entry in sorted(resident, key=lambda m: m.last_used, reverse=True):
+            models.append(
+                {
+                    "modelId": entry.model_id,
+                    "modelPath": entry.path_to_model,
+                    "sizeBytes": entry.size_bytes,
+                    "lastUsed": entry.last_used,
+                    "isActive": entry.model_id == active_model_id,
+                }
+            )
+        return {
+            "maxBytes": self.max_bytes,
+            "usedBytes": self.used_bytes,
+            "models": models,
+        }
+
+
+# Mirror the given pooled model onto the app's "currently loaded model" state
+def set_active_model(app, entry: Optional[PooledModel]):
+    if entry:
+        app.state.llm = entry.llm
+        app.state.model_id = entry.model_id
+        app.state.path_to_model = entry.path_to_model
+        app.state.loaded_text_model_data = entry.metadata
+    else:
+        app.state.llm = None
+        app.state.model_id = ""
+        app.state.path_to_model = ""
+        app.state.loaded_text_model_data = {}
+
+
+# Return the app's model pool
+def get_model_pool(app) -> ModelPool:
+    return app.state.model_pool
@@ -0,0 +1,179 @@
+###
+# Registry of installed text models, repo -> revision -> file -> blob path.
+# Kept in SQLite and updated one file at a time as models are downloaded or deleted,
+# so listing installed models never scans the huggingface cache or rewrites a file.
+###
+import os
+import json
+import sqlite3
+import threading
+from typing import List, Optional
+from core import classes, common
+
+MODEL_REGISTRY_FILE = "installed_models.sqlite3"
+SCHEMA_VERSION = 1  # stored as the database's user_version
+
+
+class ModelRegistry:
+    def __init__(self, path: str = common.APP_SETTINGS_PATH):
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._installed: Optional[List[classes.InstalledTextModelMetadata]] = None
+        self._db = sqlite3.connect(
+            os.path.join(path, MODEL_REGISTRY_FILE), check_same_thread=False
+        )
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS models (
+                repo_id TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                num_times_run INTEGER NOT NULL DEFAULT 0,
+                is_favorited INTEGER NOT NULL DEFAULT 0
+            )""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS files (
+                repo_id TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                revision TEXT NOT NULL DEFAULT '',
+                blob_path TEXT NOT NULL DEFAULT '',
+                size INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (repo_id, filename),
+                FOREIGN KEY (repo_id) REFERENCES models(repo_id) ON DELETE CASCADE
+            )""")
+        self._db.commit()
+
+    @property
+    def is_migrated(self) -> bool:
+        with self._lock:
+            return self._db.execute("PRAGMA user_version").fetchone()[0] > 0
+
+    # Every installed model with its files, in the order they were first installed
+    def list(self) -> List[classes.InstalledTextModelMetadata]:
+        with self._lock:
+            # Rebuilt only after a change
+            if self._installed is None:
+                self._installed = self._read_all()
+            return self._installed
+
+    def get(self, repo_id: str) -> Optional[classes.InstalledTextModelMetadata]:
+        return next((m for m in self.list() if m["repoId"] == repo_id), None)
+
+    def get_file(self, repo_id: str, filename: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT revision, blob_path, size FROM files WHERE repo_id = ? AND filename = ?",
+                (repo_id, filename),
+            ).fetchone()
+        if not row:
+            return None
+        return dict(revision=row[0], blob_path=row[1], size=row[2])
+
+    # Add a model's file, or update where it is stored
+    def put_file(
+        self,
+        repo_id: str,
+        filename: str,
+        blob_path: str = "",
+        revision: str = "",
+        size: int = 0,
+    ):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO models (repo_id, position) VALUES "
+                "(?, (SELECT COALESCE(MAX(position), -1) + 1 FROM models))",
+                (repo_id,),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (repo_id, filename, revision, blob_path, size) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (repo_id, filename, revision, blob_path, size),
+            )
+            self._db.commit()
+            self._installed = None
+
+    # Remove a model and the record of all its files
+    def delete(self, repo_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM models WHERE repo_id = ?", (repo_id,))
+            self._db.commit()
+            self._installed = None
+
+    # Copy the models recorded by older versions in installed_models.json, once
+    def import_installed(self, models: List[classes.InstalledTextModelMetadata]):
+        with self._lock:
+            for position, model in enumerate(models):
+                save_paths = model.get("savePath") or {}
+                if isinstance(save_paths, str):
+                    save_paths = {os.path.basename(save_paths): save_paths}
+                # Older versions recorded a file before downloading it
+                save_paths = {name: path for name, path in save_paths.items() if path}
+                if not save_paths:
+                    continue
+                self._db.execute(
+                    "INSERT OR IGNORE INTO models (repo_id, position, num_times_run, is_favorited) "
+                    "VALUES (?, ?, ?, ?)",
+                    (
+                        model["repoId"],
+                        position,
+                        model.get("numTimesRun") or 0,
+                        int(bool(model.get("isFavorited"))),
+                    ),
+                )
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO files (repo_id, filename, blob_path, size) VALUES (?, ?, ?, ?)",
+                    [
+                        (
+                            model["repoId"],
+                            filename,
+                            path,
+                            os.path.getsize(path) if os.path.isfile(path) else 0,
+                        )
+                        for filename, path in save_paths.items()
+                    ],
+                )
+            self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._db.commit()
+            self._installed = None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _read_all(self) -> List[classes.InstalledTextModelMetadata]:
+        models = {
+            repo_id: {
+                "repoId": repo_id,
+                "savePath": {},
+                "numTimesRun": num_times_run,
+                "isFavorited": bool(is_favorited),
+            }
+            for repo_id, num_times_run, is_favorited in self._db.execute(
+                "SELECT repo_id, num_times_run, is_favorited FROM models ORDER BY position"
+            )
+        }
+        for repo_id, filename, blob_path in self._db.execute(
+            "SELECT repo_id, filename, blob_path FROM files ORDER BY rowid"
+        ):
+            models[repo_id]["savePath"][filename] = blob_path
+        return list(models.values())
+
+
+# Move models recorded in installed_models.json by older versions into the registry
+def migrate_settings_file(registry: ModelRegistry):
+    if registry.is_migrated:
+        return
+    models = []
+    try:
+        with open(common.MODEL_METADATAS_FILEPATH, "r") as file:
+            models = json.load(file).get(common.INSTALLED_TEXT_MODELS) or []
+    except (OSError, ValueError):
+        pass
+    registry.import_installed(models)
+    if models:
+        print(
+            f"{common.PRNT_API} Moved {len(models)} installed model(s) into the registry.",
+            flush=True,
+        )
+
+
+# Return the app's installed model registry
+def get_model_registry(app) -> ModelRegistry:
+    return app.state.model_registry
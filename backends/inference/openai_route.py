@@ -0,0 +1,311 @@
+###
+# OpenAI API compatible endpoints served by the models already loaded in the pool,
+# so existing client SDKs can talk to this server without a second llama.cpp process.
+# https://platform.openai.com/docs/api-reference
+###
+import json
+from typing import Callable, Iterator, List
+from nanoid import generate as generate_uuid
+from fastapi import APIRouter, Request, HTTPException
+from sse_starlette.sse import EventSourceResponse
+from llama_cpp import Llama, llama_chat_format
+from inference.model_pool import get_model_pool
+from inference.scheduler import get_scheduler, stream_when_ready, QueueFullError
+from core import classes, common
+
+STREAM_DONE = "[DONE]"
+
+router = APIRouter()
+
+
+# Sampling args shared by both completion endpoints, in llama-cpp-python's names
+def sampling_kwargs(
+    payload: classes.OpenAICompletionRequest | classes.OpenAIChatCompletionRequest,
+) -> dict:
+    stop = payload.stop
+    if isinstance(stop, str):
+        stop = [stop]
+    return dict(
+        max_tokens=payload.max_tokens,
+        temperature=payload.temperature,
+        top_p=payload.top_p,
+        top_k=payload.top_k,
+        min_p=payload.min_p,
+        stop=stop or [],
+        presence_penalty=payload.presence_penalty,
+        frequency_penalty=payload.frequency_penalty,
+        repeat_penalty=payload.repeat_penalty,
+        seed=payload.seed,
+    )
+
+
+# Number of tokens the model's tokenizer makes of the text
+def count_tokens(llama: Llama, text: str, add_bos: bool = True) -> int:
+    if not text:
+        return 0
+    return len(llama.tokenize(text.encode("utf-8"), add_bos=add_bos, special=True))
+
+
+# The prompt a chat completion decodes, formatted with the model's chat template
+# the same way llama-cpp-python does. Falls back to the joined message contents
+# when the model's chat handler cannot be reproduced.
+def format_chat_prompt(llama: Llama, messages: List[dict]) -> str:
+    formatter = None
+    template = (getattr(llama, "metadata", None) or {}).get("tokenizer.chat_template")
+    if llama.chat_format:
+        try:
+            formatter = llama_chat_format.get_chat_format(llama.chat_format)
+        except (AttributeError, ValueError):
+            formatter = None
+    elif template and hasattr(llama_chat_format, "Jinja2ChatFormatter"):
+        # Models without a named format use the template in their gguf metadata
+        formatter = llama_chat_format.Jinja2ChatFormatter(
+            template=template,
+            eos_token=llama.detokenize([llama.token_eos()]).decode("utf-8"),
+            bos_token=llama.detokenize([llama.token_bos()]).decode("utf-8"),
+        )
+    if formatter:
+        try:
+            return formatter(messages=messages).prompt
+        except Exception:
+            pass
+    return "".join(str(m.get("content") or "") for m in messages)
+
+
+# Run `create(prompt_index)` n times per prompt and number the choices in order.
+# Like OpenAI, a prompt's tokens are counted once however many choices it has.
+def collect_choices(create: Callable[[int], dict], n_prompts: int, n: int) -> dict:
+    result = None
+    prompt_tokens = 0
+    completion_tokens = 0
+    choices: List[dict] = []
+    for prompt_index in range(n_prompts):
+        for i in range(n):
+            res = create(prompt_index)
+            for choice in res["choices"]:
+                choice["index"] = len(choices)
+                choices.append(choice)
+            usage = res.get("usage") or {}
+            if i == 0:
+                prompt_tokens += usage.get("prompt_tokens", 0)
+            completion_tokens += usage.get("completion_tokens", 0)
+            result = result or res
+    result["choices"] = choices
+    result["usage"] = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    return result
+
+
+# Stream the chunks of every choice one after another, then an optional usage chunk
+# that counts each prompt once, as `collect_choices` does
+def stream_choices(
+    create: Callable[[int], Iterator[dict]],
+    llama: Llama,
+    prompts: List[str],
+    n: int,
+    include_usage: bool,
+) -> Iterator[str]:
+    index = 0
+    completion_tokens = 0
+    last_chunk = None
+    for prompt_index in range(len(prompts)):
+        for _ in range(n):
+            chunks = create(prompt_index)
+            text = ""
+            try:
+                for chunk in chunks:
+                    for choice in chunk["choices"]:
+                        choice["index"] = index
+                        text += choice.get("text") or ""
+                        text += (choice.get("delta") or {}).get("content") or ""
+                    last_chunk = chunk
+                    yield json.dumps(chunk)
+            finally:
+                chunks.close()
+            # A chunk can hold several tokens, or part of one, so count the whole text
+            completion_tokens += count_tokens(llama, text, add_bos=False)
+            index += 1
+    if include_usage and last_chunk:
+        prompt_tokens = sum(count_tokens(llama, p) for p in prompts)
+        usage_chunk = {
+            "id": last_chunk["id"],
+            "object": last_chunk["object"],
+            "created": last_chunk["created"],
+            "model": last_chunk["model"],
+            "choices": [],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+        yield json.dumps(usage_chunk)
+    yield STREAM_DONE
+
+
+# Queue the request on its model, then run (or stream) it on the model's thread
+async def serve(
+    request: Request,
+    model: str | None,
+    priority: int,
+    streaming: bool,
+    run: Callable[[Llama], dict],
+    stream: Callable[[Llama], Iterator[str]],
+):
+    app = request.app
+    scheduler = get_scheduler(app)
+    ticket = None
+
+    try:
+        pool = get_model_pool(app)
+        model_entry = pool.get(model) or pool.get(app.state.model_id)
+        if not model_entry or not model_entry.llm:
+            raise Exception("No LLM loaded.")
+        # The llama-cpp-python object inside the LlamaIndex wrapper
+        llama: Llama = model_entry.llm._model
+        executor = model_entry.executor
+        request_id = generate_uuid()
+        ticket = scheduler.admit(
+            model_id=model_entry.model_id,
+            request_id=request_id,
+            priority=priority,
+        )
+
+        if streaming:
+            return EventSourceResponse(
+                stream_when_ready(
+                    scheduler,
+                    ticket,
+                    lambda cancel_event: executor.stream(
+                        lambda: stream(llama), cancel_event
+                    ),
+                    report_position=False,
+                )
+            )
+        try:
+            await scheduler.acquire(ticket)
+            if ticket.is_cancelled:
+                raise Exception(f"Request {request_id} was cancelled.")
+            return await executor.run(run, llama)
+        finally:
+            scheduler.release(ticket)
+    except QueueFullError as err:
+        print(f"{common.PRNT_API} Error: {err}", flush=True)
+        raise HTTPException(
+            status_code=429,
+            detail=str(err),
+            headers={"Retry-After": str(err.retry_after)},
+        )
+    except (KeyError, Exception) as err:
+        if ticket:
+            scheduler.release(ticket)
+        print(f"{common.PRNT_API} Error: {err}", flush=True)
+        raise HTTPException(
+            status_code=400, detail=f"Something went wrong. Reason: {err}"
+        )
+
+
+# Text completion on a raw prompt (or list of prompts)
+@router.post("/completions")
+async def create_completion(
+    request: Request,
+    payload: classes.OpenAICompletionRequest,
+):
+    prompts = payload.prompt if isinstance(payload.prompt, list) else [payload.prompt]
+    n = max(1, payload.n or 1)
+    kwargs = dict(
+        **sampling_kwargs(payload),
+        suffix=payload.suffix,
+        logprobs=payload.logprobs,
+        echo=payload.echo,
+    )
+
+    def run(llama: Llama):
+        return collect_choices(
+            lambda i: llama.create_completion(prompt=prompts[i], **kwargs),
+            n_prompts=len(prompts),
+            n=n,
+        )
+
+    def stream(llama: Llama):
+        return stream_choices(
+            lambda i: llama.create_completion(prompt=prompts[i], stream=True, **kwargs),
+            llama=llama,
+            prompts=prompts,
+            n=n,
+            include_usage=bool(
+                payload.stream_options and payload.stream_options.include_usage
+            ),
+        )
+
+    return await serve(
+        request,
+        model=payload.model,
+        priority=payload.priority,
+        streaming=payload.stream,
+        run=run,
+        stream=stream,
+    )
+
+
+# Chat completion formatted with the model's chat template
+@router.post("/chat/completions")
+async def create_chat_completion(
+    request: Request,
+    payload: classes.OpenAIChatCompletionRequest,
+):
+    n = max(1, payload.n or 1)
+    kwargs = dict(**sampling_kwargs(payload))
+    if payload.response_format:
+        kwargs["response_format"] = payload.response_format
+
+    def run(llama: Llama):
+        return collect_choices(
+            lambda _: llama.create_chat_completion(messages=payload.messages, **kwargs),
+            n_prompts=1,
+            n=n,
+        )
+
+    def stream(llama: Llama):
+        prompt = format_chat_prompt(llama, payload.messages)
+        return stream_choices(
+            lambda _: llama.create_chat_completion(
+                messages=payload.messages, stream=True, **kwargs
+            ),
+            llama=llama,
+            prompts=[prompt],
+            n=n,
+            include_usage=bool(
+                payload.stream_options and payload.stream_options.include_usage
+            ),
+        )
+
+    return await serve(
+        request,
+        model=payload.model,
+        priority=payload.priority,
+        streaming=payload.stream,
+        run=run,
+        stream=stream,
+    )
+
+
+# List the models resident in memory
+@router.get("/models")
+def list_models(request: Request):
+    pool = get_model_pool(request.app)
+    return {
+        "object": "list",
+        "data": [
+            {
+                "id": model["modelId"],
+                "object": "model",
+                "created": int(model["lastUsed"]),
+                "owned_by": "local",
+            }
+            for model in pool.stats()["models"]
+        ],
+    }
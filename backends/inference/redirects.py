@@ -3,6 +3,7 @@ from fastapi import Request, status
 from fastapi.responses import RedirectResponse
 
 # *Note This is not currently being used.
+# The direct routes below are now served in-process by inference/openai_route.py
 
 # These are direct api endpoints to the text inference engine
 direct_routes = [
@@ -1,15 +1,22 @@
 import os
+import asyncio
 from typing import List
+from nanoid import generate as generate_uuid
 from fastapi import APIRouter, Request, HTTPException, Depends
 from sse_starlette.sse import EventSourceResponse
+from llama_index.core.base.llms.types import CompletionResponse
 from inference.classes import RetrievalTypes
 from inference import agent
 from storage import route as storage_route
-from embeddings import main, query
-from inference import text_llama_index
+from embeddings import main, query, rerank, retrieval
+from inference import text_llama_index, answer_cache
+from inference.model_pool import get_model_pool, set_active_model
+from inference.batching import needs_serial_sampling
+from inference.scheduler import get_scheduler, stream_when_ready, QueueFullError
+from inference.downloads import get_download_manager
+from inference.model_registry import get_model_registry
 from core import classes, common
 from huggingface_hub import (
-    hf_hub_download,
     get_hf_file_metadata,
     hf_hub_url,
     ModelFilter,
@@ -21,26 +28,17 @@ router = APIRouter()
 
 # Return a list of all currently installed models and their metadata
 @router.get("/installed")
-def get_installed_models() -> classes.TextModelInstallMetadataResponse:
+def get_installed_models(request: Request) -> classes.TextModelInstallMetadataResponse:
+    app = request.app
+
     try:
-        data = []
-        # Get installed models file
-        metadatas: classes.InstalledTextModel = common.get_settings_file(
-            common.APP_SETTINGS_PATH, common.MODEL_METADATAS_FILEPATH
-        )
-        if not metadatas:
-            metadatas = common.DEFAULT_SETTINGS_DICT
-        if common.INSTALLED_TEXT_MODELS in metadatas:
-            data = metadatas[common.INSTALLED_TEXT_MODELS]
-            return {
-                "success": True,
-                "message": "This is a list of all currently installed models.",
-                "data": data,
-            }
-        else:
-            raise Exception(
-                f"No attribute {common.INSTALLED_TEXT_MODELS} exists in settings file."
-            )
+        # Read from the registry, kept up to date by downloads and deletes
+        data = get_model_registry(app).list()
+        return {
+            "success": True,
+            "message": "This is a list of all currently installed models.",
+            "data": data,
+        }
     except Exception as err:
         return {
             "success": False,
@@ -57,13 +55,17 @@ def get_text_model(request: Request) -> classes.LoadedTextModelResponse | dict:
     try:
         llm = app.state.llm
         model_id = app.state.model_id
+        pool = get_model_pool(app)
 
         if llm:
             metadata = app.state.loaded_text_model_data
             return {
                 "success": True,
                 "message": f"Model {model_id} is currently loaded.",
-                "data": metadata,
+                "data": {
+                    **metadata,
+                    "pool": pool.stats(active_model_id=model_id),
+                },
             }
         else:
             return {
@@ -83,11 +85,11 @@ def get_text_model(request: Request) -> classes.LoadedTextModelResponse | dict:
 @router.post("/unload")
 def unload_text_inference(request: Request):
     app = request.app
-    text_llama_index.unload_text_model(app.state.llm)
-    app.state.loaded_text_model_data = {}
-    app.state.llm = None
-    app.state.path_to_model = ""
-    app.state.model_id = ""
+    pool = get_model_pool(app)
+    # Waits for any running generation to finish before ejecting
+    pool.unload(app.state.model_id)
+    # Fall back to the next most recently used resident model
+    set_active_model(app, pool.most_recent())
 
     return {
         "success": True,
@@ -98,7 +100,7 @@ def unload_text_inference(request: Request):
 
 # Start Text Inference service
 @router.post("/load")
-def load_text_inference(
+async def load_text_inference(
     request: Request,
     data: classes.LoadInferenceRequest,
 ) -> classes.LoadInferenceResponse:
@@ -108,35 +110,38 @@ def load_text_inference(
         model_id = data.modelId
         mode = data.mode
         modelPath = data.modelPath
-        callback_manager = main.create_index_callback_manager()
-        # Record model's save path
-        app.state.model_id = model_id
-        app.state.path_to_model = modelPath
-        # Unload the model if one exists
-        if app.state.llm:
-            print(
-                f"{common.PRNT_API} Ejecting model {model_id} currently loaded from: {modelPath}"
+        model_settings = data.init
+        generate_settings = data.call
+        pool = get_model_pool(app)
+        # Switch instantly if this model is already resident with the same init
+        # settings, generation settings are patched in place.
+        entry = pool.get(model_id)
+        is_resident = (
+            entry
+            and entry.path_to_model == modelPath
+            and entry.metadata.get("modelSettings") == model_settings
+        )
+        if is_resident:
+            entry = await asyncio.to_thread(
+                pool.update_settings, model_id, generate_settings, mode=mode
             )
-            unload_text_inference()
-        # Load the specified Ai model
-        if app.state.llm is None:
-            model_settings = data.init
-            generate_settings = data.call
-            app.state.llm = text_llama_index.load_text_model(
-                modelPath,
-                mode,
-                model_settings,
-                generate_settings,
-                callback_manager=callback_manager,
+            print(f"{common.PRNT_API} Model {model_id} is already resident.")
+        else:
+            # Load the specified Ai model, may evict least recently used models
+            entry = await asyncio.to_thread(
+                pool.load,
+                model_id=model_id,
+                path_to_model=modelPath,
+                mode=mode,
+                init_settings=model_settings,
+                gen_settings=generate_settings,
+                callback_manager=main.create_index_callback_manager(),
             )
-            # Record the currently loaded model
-            app.state.loaded_text_model_data = {
-                "modelId": model_id,
-                "mode": mode,
-                "modelSettings": model_settings,
-                "generateSettings": generate_settings,
-            }
             print(f"{common.PRNT_API} Model {model_id} loaded from: {modelPath}")
+        # Batched models can run several completions at once
+        get_scheduler(app).set_concurrency(model_id, model_settings.n_parallel or 1)
+        # Record the currently loaded model
+        set_active_model(app, entry)
         return {
             "message": f"AI model [{model_id}] loaded.",
             "success": True,
@@ -150,6 +155,52 @@ def load_text_inference(
         }
 
 
+# Change the settings of a loaded model. Generation settings apply to the next
+# request without a reload, the model only reloads when its init settings change.
+@router.post("/settings")
+async def update_text_settings(
+    request: Request,
+    data: classes.UpdateTextSettingsRequest,
+) -> classes.UpdateTextSettingsResponse:
+    app = request.app
+    model_id = data.modelId or app.state.model_id
+
+    try:
+        pool = get_model_pool(app)
+        entry = pool.get(model_id)
+        if not entry:
+            raise Exception("Model is not loaded.")
+        init_settings = data.init or entry.metadata.get("modelSettings")
+        reload = init_settings != entry.metadata.get("modelSettings")
+        if reload:
+            entry = await asyncio.to_thread(
+                pool.load,
+                model_id=model_id,
+                path_to_model=entry.path_to_model,
+                mode=entry.metadata.get("mode"),
+                init_settings=init_settings,
+                gen_settings=data.call,
+                callback_manager=main.create_index_callback_manager(),
+            )
+            get_scheduler(app).set_concurrency(model_id, init_settings.n_parallel or 1)
+        else:
+            entry = await asyncio.to_thread(pool.update_settings, model_id, data.call)
+        # Keep the app's view of the active model in sync
+        if model_id == app.state.model_id:
+            set_active_model(app, entry)
+        return {
+            "message": f"Updated settings of AI model [{model_id}].",
+            "success": True,
+            "data": {"reloaded": reload},
+        }
+    except (Exception, KeyError) as error:
+        return {
+            "message": f"Unable to update settings of AI model [{model_id}]. {error}",
+            "success": False,
+            "data": {"reloaded": False},
+        }
+
+
 # Open OS file explorer on host machine
 @router.get("/modelExplore")
 def explore_text_model_dir() -> classes.FileExploreResponse:
@@ -223,63 +274,25 @@ def get_model_metadata(payload):
     }
 
 
-# Download a text model from huggingface hub
-# https://huggingface.co/docs/huggingface_hub/v0.21.4/en/package_reference/file_download#huggingface_hub.hf_hub_download
+# Queue a text model download from huggingface hub, returns right away.
+# Follow its progress at /download/{id}/events.
 @router.post("/download")
-def download_text_model(payload: classes.DownloadTextModelRequest):
+async def download_text_model(
+    request: Request, payload: classes.DownloadTextModelRequest
+) -> classes.DownloadTextModelResponse:
+    app = request.app
+
     try:
         repo_id = payload.repo_id
         filename = payload.filename
-        cache_dir = common.app_path(common.TEXT_MODELS_CACHE_DIR)
-        resume_download = False
-        # repo_type = "model" # optional, specify type of data, defaults to model
-        # local_dir = "" # optional, downloaded file will be placed under this directory
-
-        # Save initial path and details to json file
-        common.save_text_model(
-            {
-                "repoId": repo_id,
-                "savePath": {filename: ""},
-            }
-        )
-
-        # Download model.
-        # Returned path is symlink which isnt loadable; for our purposes we use get_cached_blob_path().
-        hf_hub_download(
-            repo_id=repo_id,
-            filename=filename,
-            cache_dir=cache_dir,
-            resume_download=resume_download,
-            # local_dir=cache_dir,
-            # local_dir_use_symlinks=False,
-            # repo_type=repo_type,
-        )
-
-        # Get actual file path
-        [model_cache_info, repo_revisions] = common.scan_cached_repo(
-            cache_dir=cache_dir, repo_id=repo_id
-        )
-        # Get from dl path
-        # file_path = common.app_path(download_path)
-
-        # Get from huggingface hub managed cache dir
-        file_path = common.get_cached_blob_path(
-            repo_revisions=repo_revisions, filename=filename
-        )
-        if not isinstance(file_path, str):
-            raise Exception("Path is not string.")
-
-        # Save finalized details to disk
-        common.save_text_model(
-            {
-                "repoId": repo_id,
-                "savePath": {filename: file_path},
-            }
-        )
 
+        # Fetched in parallel segments, resumes an earlier interrupted download.
+        # Registered as installed once the file is in place.
+        job = get_download_manager(app).submit(repo_id=repo_id, filename=filename)
         return {
             "success": True,
-            "message": f"Saved model file to {file_path}.",
+            "message": f"Queued download of {filename}.",
+            "data": job.to_dict(),
         }
     except (KeyError, Exception, EnvironmentError, OSError, ValueError) as err:
         print(f"Error: {err}", flush=True)
@@ -288,38 +301,68 @@ def download_text_model(payload: classes.DownloadTextModelRequest):
         )
 
 
+# List queued, running and recently finished model downloads
+@router.get("/downloads")
+async def get_model_downloads(request: Request) -> classes.DownloadTextModelsResponse:
+    app = request.app
+    jobs = get_download_manager(app).list()
+    return {
+        "success": True,
+        "message": f"Returned {len(jobs)} download(s).",
+        "data": [job.to_dict() for job in jobs],
+    }
+
+
+# Stream a download's progress and throughput until it finishes
+@router.get("/download/{download_id}/events")
+async def get_model_download_events(request: Request, download_id: str):
+    app = request.app
+    manager = get_download_manager(app)
+    if not manager.get(download_id):
+        raise HTTPException(
+            status_code=404, detail=f"No download found for [{download_id}]."
+        )
+    return EventSourceResponse(manager.events(download_id))
+
+
+# Stop a queued or running download and remove its partial file
+@router.post("/download/{download_id}/cancel")
+async def cancel_model_download(request: Request, download_id: str):
+    app = request.app
+
+    if not get_download_manager(app).cancel(download_id):
+        return {
+            "success": False,
+            "message": f"No active download found for [{download_id}].",
+            "data": None,
+        }
+    return {
+        "success": True,
+        "message": f"Cancelled download [{download_id}].",
+        "data": None,
+    }
+
+
 # Remove text model weights file and installation record.
 # Current limitation is that this deletes all quant files for a repo.
 @router.post("/delete")
-def delete_text_model(payload: classes.DeleteTextModelRequest):
+def delete_text_model(request: Request, payload: classes.DeleteTextModelRequest):
+    app = request.app
     filename = payload.filename
     repo_id = payload.repoId
 
     try:
-        cache_dir = common.app_path(common.TEXT_MODELS_CACHE_DIR)
+        registry = get_model_registry(app)
+        if not registry.get_file(repo_id=repo_id, filename=filename):
+            raise Exception(f"No installed file {filename} found for {repo_id}.")
 
-        # Checks file and throws if not found
-        common.check_cached_file_exists(
-            cache_dir=cache_dir, repo_id=repo_id, filename=filename
-        )
-
-        # Find model hash
-        [model_cache_info, repo_revisions] = common.scan_cached_repo(
-            cache_dir=cache_dir, repo_id=repo_id
-        )
-        repo_commit_hash = []
-        for r in repo_revisions:
-            repo_commit_hash.append(r.commit_hash)
-
-        # Delete weights from cache, https://huggingface.co/docs/huggingface_hub/en/guides/manage-cache
-        delete_strategy = model_cache_info.delete_revisions(*repo_commit_hash)
-        delete_strategy.execute()
-        freed_size = delete_strategy.expected_freed_size_str
+        # Delete weights from cache, the repo's folder holds all its revisions
+        freed_bytes = get_download_manager(app).uninstall(repo_id=repo_id)
+        freed_size = f"{freed_bytes / 1024**3:.1f}G"
         print(f"Freed {freed_size} space.", flush=True)
 
-        # Delete install record from json file
-        if freed_size != "0.0":
-            common.delete_text_model_revisions(repo_id=repo_id)
+        # Delete install record
+        registry.delete(repo_id=repo_id)
 
         return {
             "success": True,
@@ -332,6 +375,25 @@ def delete_text_model(payload: classes.DeleteTextModelRequest):
         )
 
 
+# Stop a queued or in-progress generation
+@router.post("/cancel/{request_id}")
+async def cancel_text_inference(request: Request, request_id: str):
+    app = request.app
+    scheduler = get_scheduler(app)
+
+    if not scheduler.cancel(request_id):
+        return {
+            "success": False,
+            "message": f"No active request found for [{request_id}].",
+            "data": None,
+        }
+    return {
+        "success": True,
+        "message": f"Cancelled request [{request_id}].",
+        "data": None,
+    }
+
+
 # Use Llama Index to run queries on vector database embeddings or run normal chat inference.
 @router.post("/inference")
 async def text_inference(
@@ -345,6 +407,8 @@ async def text_inference(
     TOOL_NAME = "{tool_name_str}"
     TOOL_DESCRIPTION = "{tool_description_str}"
     ASSIGNED_TOOLS = "{assigned_tools_str}"
+    scheduler = get_scheduler(app)
+    ticket = None
 
     try:
         assigned_tool_names = payload.tools
@@ -381,14 +445,18 @@ async def text_inference(
             frequency_penalty=payload.frequency_penalty,
         )
 
-        if not app.state.path_to_model:
-            msg = "No path to model provided."
+        # Route to the resident model named in the request, else the active model
+        pool = get_model_pool(app)
+        model_entry = pool.get(payload.model) or pool.get(app.state.model_id)
+        if not model_entry:
+            msg = "No LLM loaded."
             print(f"Error: {msg}", flush=True)
             raise Exception(msg)
-        if not app.state.llm:
-            msg = "No LLM loaded."
+        if not model_entry.path_to_model:
+            msg = "No path to model provided."
             print(f"Error: {msg}", flush=True)
             raise Exception(msg)
+        llm = model_entry.llm
 
         # Handle Agent prompt (low temperature works best)
         is_agent = (
@@ -459,87 +527,204 @@ async def text_inference(
             and collection_names is not None
             and len(collection_names) > 0
         )
+        executor = model_entry.executor
+        # Completions sample with the model's settings from load and /settings on
+        # either path, LlamaCPP ignores per call kwargs and the batch engine is
+        # handed the same settings so both give the same answers.
+        sampling = text_llama_index.get_model_sampling(model_entry.metadata)
+        # Completions decode together with other requests when the model was loaded
+        # with n_parallel > 1. Grammar, mirostat and tail free sampling need
+        # llama.cpp's own sampler so run serially.
+        batch_engine = None
+        completion_executor = executor
+        if model_entry.batch_engine and not needs_serial_sampling(sampling):
+            batch_engine = model_entry.batch_engine
+            completion_executor = model_entry.batch_executor
+
+        # Parse out the json result using either regex or another llm call
+        def parse_agent_response(response):
+            output_response = agent.parse_output(
+                output=response.text,
+                tool_def=assigned_tool,
+            )
+            response.raw = output_response.get("raw")
+            response.text = output_response.get("text")
+            return response
+
+        # Deterministic instruct and agent completions can be answered from earlier ones
+        cache_answer = (
+            payload.cache_response
+            and mode == classes.CHAT_MODES.INSTRUCT.value
+            and not is_RAG
+            and (is_agent or not streaming)
+            and answer_cache.is_deterministic(sampling)
+        )
+        if cache_answer:
+            cache_lookup = dict(
+                model_id=model_entry.model_id,
+                prompt=text_llama_index.completion_to_prompt(
+                    query_prompt, system_message or "", message_format
+                ),
+                params={**sampling, "n_ctx": n_ctx},
+                query=prompt,
+            )
+
+            # Embedding the query for similar lookups blocks
+            def find_answer():
+                if payload.cache_similarity:
+                    cache_lookup["embed_model"] = main.define_embedding_model(app)
+                return answer_cache.get_answer_cache(app).get(
+                    threshold=payload.cache_similarity, **cache_lookup
+                )
+
+            cached_text = await asyncio.to_thread(find_answer)
+            if cached_text is not None:
+                response = CompletionResponse(text=cached_text)
+                return parse_agent_response(response) if is_agent else response
+
+        # Wait for a turn on the model, rejects when the queue is full
+        request_id = payload.requestId or generate_uuid()
+        ticket = scheduler.admit(
+            model_id=model_entry.model_id,
+            request_id=request_id,
+            priority=payload.priority,
+        )
+
+        # Stream once this request reaches the front of the queue
+        def scheduled_stream(stream_factory):
+            return EventSourceResponse(
+                stream_when_ready(scheduler, ticket, stream_factory)
+            )
+
+        # Run a blocking call once this request reaches the front of the queue
+        async def scheduled_run(func, *args, runner=executor, **kwargs):
+            try:
+                await scheduler.acquire(ticket)
+                if ticket.is_cancelled:
+                    raise Exception(f"Request {request_id} was cancelled.")
+                return await runner.run(func, *args, **kwargs)
+            finally:
+                scheduler.release(ticket)
+
         if is_RAG:
-            # Only take the first collection for now
-            collection_name = collection_names[0]
             # Set LLM settings
             retrieval_options = dict(
                 similarity_top_k=payload.similarity_top_k,
                 response_mode=payload.response_mode,
+                rerank_budget_ms=payload.rerank_budget_ms,
             )
+            top_k = payload.similarity_top_k or 1
             # Update LLM generation options
             # app.state.llm.generate_kwargs.update(options)
 
-            # Load embedding model for context retrieval
-            main.define_embedding_model(app)
+            # Embedding, retrieval and synthesis all block, so run them on the executor
+            def query_collection():
+                # Over-fetch when a cross-encoder picks the final top-k
+                reranker = rerank.get_reranker(app) if payload.rerank else None
+                # Search every collection at once and merge into one top-k
+                nodes = retrieval.retrieve_collections(
+                    app,
+                    collection_names=collection_names,
+                    query=query_prompt,
+                    top_k=rerank.rerank_candidates(top_k) if reranker else top_k,
+                    search_mode=payload.search_mode,
+                    fusion_mode=payload.fusion_mode,
+                    timeout=payload.retrieval_timeout,
+                )
 
-            # Load the vector index. @TODO Load multiple collections
-            vector_index = main.load_embedding(app, collection_name)
+                # Call LLM query engine
+                return query.query_embedding(
+                    llm=llm,
+                    query=query_prompt,
+                    prompt_template=rag_prompt_template,
+                    nodes=nodes,
+                    options=retrieval_options,
+                    streaming=streaming,
+                    reranker=reranker,
+                )
 
-            # Call LLM query engine
-            res = query.query_embedding(
-                llm=app.state.llm,
-                query=query_prompt,
-                prompt_template=rag_prompt_template,
-                index=vector_index,
-                options=retrieval_options,
-                streaming=streaming,
-            )
             # Return streaming response
             if streaming:
-                token_generator = res.response_gen
-                response = text_llama_index.token_streamer(token_generator)
-                return EventSourceResponse(response)
+
+                async def rag_stream(cancel_event):
+                    res = await executor.run(query_collection)
+                    token_generator = res.response_gen
+                    async for item in executor.stream(
+                        lambda: text_llama_index.token_streamer(token_generator),
+                        cancel_event,
+                    ):
+                        yield item
+
+                return scheduled_stream(rag_stream)
             # Return non-stream response
             else:
-                return res
+                return await scheduled_run(query_collection)
         # Raw model - Call LLM in raw completion mode (uses training data)
         elif mode == classes.CHAT_MODES.INSTRUCT.value:
             options["n_ctx"] = n_ctx
             # Return streaming response
             if streaming and not is_agent:
-                return EventSourceResponse(
-                    text_llama_index.text_stream_completion(
-                        prompt=query_prompt,
-                        system_message=system_message,
-                        message_format=message_format,
-                        app=app,
-                        options=options,
+                return scheduled_stream(
+                    lambda cancel_event: completion_executor.stream(
+                        lambda: text_llama_index.text_stream_completion(
+                            prompt=query_prompt,
+                            system_message=system_message,
+                            message_format=message_format,
+                            llm=llm,
+                            options=sampling,
+                            engine=batch_engine,
+                        ),
+                        cancel_event,
                     )
                 )
             # Return non-stream response
             else:
-                response = text_llama_index.text_completion(
+                response = await scheduled_run(
+                    text_llama_index.text_completion,
+                    runner=completion_executor,
                     prompt=query_prompt,
                     system_message=system_message,
                     message_format=message_format,
-                    app=app,
-                    options=options,
+                    llm=llm,
+                    options=sampling,
+                    engine=batch_engine,
                 )
-                if is_agent:
-                    # Parse out the json result using either regex or another llm call
-                    output_response = agent.parse_output(
-                        output=response.text,
-                        tool_def=assigned_tool,
+                if cache_answer:
+                    await asyncio.to_thread(
+                        answer_cache.get_answer_cache(app).put,
+                        text=response.text,
+                        **cache_lookup,
                     )
-                    response.raw = output_response.get("raw")
-                    response.text = output_response.get("text")
+                if is_agent:
+                    return parse_agent_response(response)
                 return response
         # @TODO Stream LLM in chat mode
         # @TODO Agent flow here
         elif mode == classes.CHAT_MODES.CHAT.value:
             options["n_ctx"] = n_ctx
             # Returns a streaming response
-            return EventSourceResponse(
-                text_llama_index.text_chat(
-                    messages, system_message, message_format, app, options
+            return scheduled_stream(
+                lambda cancel_event: executor.stream(
+                    lambda: text_llama_index.text_chat(
+                        messages, system_message, message_format, llm, options
+                    ),
+                    cancel_event,
                 )
             )
         elif mode is None:
             raise Exception("Check 'mode' is provided.")
         else:
             raise Exception("No 'mode' or 'collection_names' provided.")
+    except QueueFullError as err:
+        print(f"Error: {err}", flush=True)
+        raise HTTPException(
+            status_code=429,
+            detail=str(err),
+            headers={"Retry-After": str(err.retry_after)},
+        )
     except (KeyError, Exception) as err:
+        if ticket:
+            scheduler.release(ticket)
         print(f"Error: {err}", flush=True)
         raise HTTPException(
             status_code=400, detail=f"Something went wrong. Reason: {err}"
@@ -0,0 +1,252 @@
+###
+# Admission control for text inference. Each loaded model gets a priority FIFO
+# with a bounded depth and a limited number of concurrent generations.
+# Tickets are only touched on the event loop, routes that use the scheduler are async,
+# so no locking is needed.
+###
+import math
+import time
+import json
+import heapq
+import asyncio
+import threading
+from itertools import count
+from typing import AsyncGenerator, Callable, Dict, List
+from core import common
+
+DEFAULT_MAX_CONCURRENCY = 1  # llama.cpp contexts are not safe to share
+DEFAULT_MAX_QUEUE_DEPTH = 16
+DEFAULT_JOB_SECONDS = 10.0  # initial guess used for Retry-After estimates
+QUEUE_EVENT = "QUEUED"
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+        super().__init__(f"Inference queue is full. Retry after {retry_after}s.")
+
+
+class Ticket:
+    def __init__(self, model_id: str, priority: int, seq: int, request_id: str):
+        self.model_id = model_id
+        self.priority = priority
+        self.seq = seq
+        self.request_id = request_id
+        self.started_at = 0.0
+        self.is_running = False
+        self.is_released = False
+        self.changed = asyncio.Event()
+        # Read by the inference thread between tokens
+        self.cancel_event = threading.Event()
+
+    @property
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    # Higher priority first, then first-in first-out
+    def __lt__(self, other: "Ticket"):
+        return (-self.priority, self.seq) < (-other.priority, other.seq)
+
+
+class ModelQueue:
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.waiting: List[Ticket] = []
+        self.running = 0
+
+
+class InferenceScheduler:
+    def __init__(
+        self,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_queue_depth: int = DEFAULT_MAX_QUEUE_DEPTH,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.avg_job_seconds = DEFAULT_JOB_SECONDS
+        self._queues: Dict[str, ModelQueue] = {}
+        self._tickets: Dict[str, Ticket] = {}
+        self._seq = count()
+
+    def _get_queue(self, model_id: str) -> ModelQueue:
+        queue = self._queues.get(model_id)
+        if not queue:
+            queue = ModelQueue(self.max_concurrency)
+            self._queues[model_id] = queue
+        return queue
+
+    # Change how many generations may run at once on a model
+    def set_concurrency(self, model_id: str, max_concurrency: int):
+        queue = self._get_queue(model_id)
+        queue.max_concurrency = max(1, max_concurrency)
+        self._dispatch(queue)
+
+    # Estimated seconds until a new request would start
+    def retry_after(self, model_id: str) -> int:
+        queue = self._get_queue(model_id)
+        backlog = len(queue.waiting) + queue.running
+        seconds = self.avg_job_seconds * backlog / queue.max_concurrency
+        return max(1, math.ceil(seconds))
+
+    # Add a request to the model's queue or raise if it is full
+    def admit(self, model_id: str, request_id: str, priority: int = 0) -> Ticket:
+        queue = self._get_queue(model_id)
+        if len(queue.waiting) >= self.max_queue_depth:
+            raise QueueFullError(self.retry_after(model_id))
+        if request_id in self._tickets:
+            raise Exception(f"Request {request_id} is already queued.")
+        ticket = Ticket(
+            model_id=model_id,
+            priority=priority,
+            seq=next(self._seq),
+            request_id=request_id,
+        )
+        self._tickets[request_id] = ticket
+        heapq.heappush(queue.waiting, ticket)
+        self._dispatch(queue)
+        return ticket
+
+    # Number of requests ahead of this ticket, 0 once it is running
+    def position(self, ticket: Ticket) -> int:
+        if ticket.is_running:
+            return 0
+        queue = self._get_queue(ticket.model_id)
+        return sum(1 for t in queue.waiting if t < ticket) + 1
+
+    # Yield the ticket's queue position each time it changes, until it may run
+    async def wait(self, ticket: Ticket) -> AsyncGenerator[int, None]:
+        last_position = None
+        while True:
+            position = self.position(ticket)
+            if position != last_position:
+                last_position = position
+                yield position
+            if ticket.is_running or ticket.is_cancelled:
+                return
+            ticket.changed.clear()
+            await ticket.changed.wait()
+
+    async def acquire(self, ticket: Ticket):
+        async for _ in self.wait(ticket):
+            pass
+
+    # Free the ticket's slot (or drop it from the queue) and start the next request
+    def release(self, ticket: Ticket):
+        if ticket.is_released:
+            return
+        ticket.is_released = True
+        self._tickets.pop(ticket.request_id, None)
+        queue = self._get_queue(ticket.model_id)
+        if ticket.is_running:
+            queue.running -= 1
+            elapsed = time.monotonic() - ticket.started_at
+            # Exponential moving average of job durations
+            self.avg_job_seconds = 0.8 * self.avg_job_seconds + 0.2 * elapsed
+        elif ticket in queue.waiting:
+            queue.waiting.remove(ticket)
+            heapq.heapify(queue.waiting)
+        self._dispatch(queue)
+
+    # Stop a queued or running request. Returns False if the id is unknown.
+    def cancel(self, request_id: str) -> bool:
+        ticket = self._tickets.get(request_id)
+        if not ticket:
+            return False
+        ticket.cancel_event.set()
+        if not ticket.is_running:
+            self.release(ticket)
+        ticket.changed.set()
+        return True
+
+    # Turn away every request still queued for a model that is being unloaded.
+    # Running requests are left to finish, the model's thread drains them first.
+    def reject_model(self, model_id: str):
+        queue = self._queues.get(model_id)
+        if not queue:
+            return
+        for ticket in queue.waiting:
+            ticket.cancel_event.set()
+            ticket.is_released = True
+            self._tickets.pop(ticket.request_id, None)
+            ticket.changed.set()
+        if queue.waiting:
+            print(
+                f"{common.PRNT_API} Rejected {len(queue.waiting)} queued request(s) for {model_id}.",
+                flush=True,
+            )
+        queue.waiting = []
+
+    # Same as `reject_model` for the model pool's threads, returns once it has run
+    def reject_model_threadsafe(self, loop: asyncio.AbstractEventLoop, model_id: str):
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop or loop.is_closed():
+            self.reject_model(model_id)
+            return
+        done = threading.Event()
+
+        def reject():
+            try:
+                self.reject_model(model_id)
+            finally:
+                done.set()
+
+        loop.call_soon_threadsafe(reject)
+        done.wait()
+
+    def _dispatch(self, queue: ModelQueue):
+        while queue.waiting and queue.running < queue.max_concurrency:
+            ticket = heapq.heappop(queue.waiting)
+            ticket.is_running = True
+            ticket.started_at = time.monotonic()
+            queue.running += 1
+            ticket.changed.set()
+        # Let every waiter re-report its position
+        for t in queue.waiting:
+            t.changed.set()
+
+    # Describe the queues for diagnostics
+    def stats(self) -> dict:
+        return {
+            model_id: {
+                "running": q.running,
+                "waiting": len(q.waiting),
+                "maxConcurrency": q.max_concurrency,
+            }
+            for model_id, q in self._queues.items()
+        }
+
+
+# Emit the queue position as SSE events, then stream the generation once admitted
+async def stream_when_ready(
+    scheduler: InferenceScheduler,
+    ticket: Ticket,
+    stream_factory: Callable[[threading.Event], AsyncGenerator[str, None]],
+    report_position: bool = True,  # off for clients that only expect tokens
+) -> AsyncGenerator[str, None]:
+    try:
+        async for position in scheduler.wait(ticket):
+            if not report_position:
+                continue
+            payload = {
+                "event": QUEUE_EVENT,
+                "data": position,
+                "requestId": ticket.request_id,
+            }
+            yield json.dumps(payload)
+        if ticket.is_cancelled:
+            return
+        print(f"{common.PRNT_API} Started request {ticket.request_id}", flush=True)
+        async for item in stream_factory(ticket.cancel_event):
+            yield item
+    finally:
+        # Runs when the client disconnects too, sse-starlette cancels this generator
+        ticket.cancel_event.set()
+        scheduler.release(ticket)
+
+
+# Return the app's inference scheduler
+def get_scheduler(app) -> InferenceScheduler:
+    return app.state.inference_scheduler
@@ -4,10 +4,19 @@
 ###
 import os
 import json
-from typing import List, Optional, Sequence
+import hashlib
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+from llama_cpp import Llama, LlamaState
+from llama_cpp.llama_cache import BaseLlamaCache, LlamaDiskCache
 from llama_index.llms.llama_cpp import LlamaCPP
-from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    CompletionResponse,
+    MessageRole,
+)
 from llama_index.core.callbacks import CallbackManager
+from inference.batching import BatchEngine
 from core import common, classes
 
 # These generic helper funcs wont add End_of_seq tokens etc but construct the Prompt/Message
@@ -16,6 +25,7 @@ from core import common, classes
 CONTEXT_INPUT = "{context_str}"  # used by tools and RAG
 QUERY_INPUT = "{query_str}"  # the user's prompt
 # More templates found here: https://github.com/run-llama/llama_index/blob/main/llama_index/prompts/default_prompts.py
+PROMPT_CACHE_PATH = common.app_path("prompt_cache")
 DEFAULT_SYSTEM_MESSAGE = """You are an AI assistant that answers questions in a friendly manner. Here are some rules you always follow:
 - Generate human readable output, avoid creating output with gibberish text.
 - Generate only the requested output, don't include any other language before or after the requested output.
@@ -104,6 +114,98 @@ def messages_to_prompt(
     return "".join(string_messages)
 
 
+# Llama.cpp state snapshots keyed by the tokens that produced them. A lookup returns
+# the snapshot sharing the longest token prefix with the new prompt, so repeated
+# system messages and tool definitions are not re-evaluated on every request.
+# Least recently used snapshots spill from RAM to the (optional) disk tier.
+class PromptStateCache(BaseLlamaCache):
+    def __init__(
+        self,
+        capacity_bytes: int,
+        disk_path: Optional[str] = None,
+    ):
+        super().__init__(capacity_bytes)
+        self.cache_state: OrderedDict[Tuple[int, ...], LlamaState] = OrderedDict()
+        self.disk: Optional[LlamaDiskCache] = None
+        if disk_path:
+            self.disk = LlamaDiskCache(
+                cache_dir=disk_path, capacity_bytes=capacity_bytes
+            )
+
+    @property
+    def cache_size(self):
+        return sum([state.llama_state_size for state in self.cache_state.values()])
+
+    def _find_longest_prefix_key(
+        self, key: Tuple[int, ...]
+    ) -> Optional[Tuple[int, ...]]:
+        min_len = 0
+        min_key = None
+        for k in self.cache_state.keys():
+            prefix_len = Llama.longest_token_prefix(k, key)
+            if prefix_len > min_len:
+                min_len = prefix_len
+                min_key = k
+        return min_key
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        key = tuple(key)
+        _key = self._find_longest_prefix_key(key)
+        if _key is not None:
+            self.cache_state.move_to_end(_key)
+            return self.cache_state[_key]
+        # Promote from disk, the disk tier removes its copy on read
+        if self.disk is not None and key in self.disk:
+            value = self.disk[key]
+            self[value.input_ids.tolist()] = value
+            return value
+        raise KeyError("Key not found")
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        key = tuple(key)
+        if self._find_longest_prefix_key(key) is not None:
+            return True
+        return self.disk is not None and key in self.disk
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState):
+        key = tuple(key)
+        if key in self.cache_state:
+            del self.cache_state[key]
+        self.cache_state[key] = value
+        while self.cache_size > self.capacity_bytes and len(self.cache_state) > 0:
+            evicted_key, evicted = self.cache_state.popitem(last=False)
+            if self.disk is not None:
+                self.disk[evicted_key] = evicted
+
+
+# Memory the prompt cache's RAM tier may grow to, both cache types keep one
+def prompt_cache_bytes(init_settings: classes.LoadTextInferenceInit) -> int:
+    if not init_settings.cache:
+        return 0
+    return init_settings.cache_size or classes.DEFAULT_PROMPT_CACHE_SIZE
+
+
+# Attach a prompt state cache to the llama.cpp model inside the wrapper
+def set_prompt_cache(
+    llm: LlamaCPP,
+    path_to_model: str,
+    init_settings: classes.LoadTextInferenceInit,
+):
+    capacity = prompt_cache_bytes(init_settings)
+    if not capacity:
+        return
+    disk_path = None
+    if init_settings.cache_type == "disk":
+        # Snapshots are only valid for the model that produced them
+        model_hash = hashlib.sha1(path_to_model.encode("utf-8")).hexdigest()
+        disk_path = os.path.join(PROMPT_CACHE_PATH, model_hash)
+    llm._model.set_cache(PromptStateCache(capacity_bytes=capacity, disk_path=disk_path))
+    print(
+        f"{common.PRNT_API} Prompt cache enabled ({init_settings.cache_type}, {capacity} bytes)",
+        flush=True,
+    )
+
+
 # Methods
 
 
@@ -144,27 +246,23 @@ def load_text_retrieval_model(
     )
 
 
-# High level llama-cpp-python object wrapped in LlamaIndex class
-# https://docs.llamaindex.ai/en/stable/examples/llm/llama_2_llama_cpp/?h=llamacpp
-def load_text_model(
-    path_to_model: str,
-    mode: str,
-    init_settings: classes.LoadTextInferenceInit,  # init settings
-    gen_settings: classes.LoadTextInferenceCall,  # generation settings
-    callback_manager: CallbackManager = None,  # Optional, debugging
-):
+# Context window from the init settings, falling back to the default
+def get_context_window(init_settings: classes.LoadTextInferenceInit) -> int:
     n_ctx = init_settings.n_ctx or classes.DEFAULT_CONTEXT_WINDOW
     if n_ctx <= 0:
         n_ctx = classes.DEFAULT_CONTEXT_WINDOW
-    seed = init_settings.seed
-    temperature = gen_settings.temperature
-    m_tokens = gen_settings.max_tokens
-    max_tokens = common.calc_max_tokens(m_tokens, n_ctx, mode)
-    n_threads = init_settings.n_threads  # None means auto calc
-    if n_threads == -1:
-        n_threads = None
+    return n_ctx
 
-    generate_kwargs = {
+
+# Args passed to llama.cpp's __call__() on every generation
+def get_generate_kwargs(
+    mode: str,
+    init_settings: classes.LoadTextInferenceInit,
+    gen_settings: classes.LoadTextInferenceCall,
+) -> dict:
+    n_ctx = get_context_window(init_settings)
+    max_tokens = common.calc_max_tokens(gen_settings.max_tokens, n_ctx, mode)
+    return {
         "stream": gen_settings.stream,
         "stop": gen_settings.stop,  # !Never use an empty string like [""]
         "echo": gen_settings.echo,
@@ -177,12 +275,53 @@ def load_text_model(
         "repeat_penalty": gen_settings.repeat_penalty,
         "presence_penalty": gen_settings.presence_penalty,
         "frequency_penalty": gen_settings.frequency_penalty,
-        "temperature": temperature,
-        "seed": seed,
+        "temperature": gen_settings.temperature,
+        "seed": init_settings.seed,
         "grammar": gen_settings.grammar,
         "max_tokens": max_tokens,
     }
 
+
+# The settings a loaded model samples with, from its pool entry's `metadata`.
+# LlamaCPP ignores per call kwargs, these are set on load and by /settings.
+def get_model_sampling(metadata: dict) -> dict:
+    return get_generate_kwargs(
+        metadata["mode"], metadata["modelSettings"], metadata["generateSettings"]
+    )
+
+
+# Swap the generation settings of a loaded model in place, no reload needed.
+# Generations already running keep the settings they started with.
+def update_generate_settings(
+    llm: LlamaCPP,
+    mode: str,
+    init_settings: classes.LoadTextInferenceInit,
+    gen_settings: classes.LoadTextInferenceCall,
+):
+    generate_kwargs = get_generate_kwargs(mode, init_settings, gen_settings)
+    llm.generate_kwargs = generate_kwargs
+    llm.max_new_tokens = generate_kwargs["max_tokens"]
+    llm.temperature = gen_settings.temperature
+
+
+# High level llama-cpp-python object wrapped in LlamaIndex class
+# https://docs.llamaindex.ai/en/stable/examples/llm/llama_2_llama_cpp/?h=llamacpp
+def load_text_model(
+    path_to_model: str,
+    mode: str,
+    init_settings: classes.LoadTextInferenceInit,  # init settings
+    gen_settings: classes.LoadTextInferenceCall,  # generation settings
+    callback_manager: CallbackManager = None,  # Optional, debugging
+):
+    n_ctx = get_context_window(init_settings)
+    seed = init_settings.seed
+    temperature = gen_settings.temperature
+    generate_kwargs = get_generate_kwargs(mode, init_settings, gen_settings)
+    max_tokens = generate_kwargs["max_tokens"]
+    n_threads = init_settings.n_threads  # None means auto calc
+    if n_threads == -1:
+        n_threads = None
+
     model_kwargs = {
         "n_gpu_layers": init_settings.n_gpu_layers,
         "use_mmap": init_settings.use_mmap,
@@ -193,12 +332,13 @@ def load_text_model(
         "n_batch": init_settings.n_batch,
         "n_threads": n_threads,
         "offload_kqv": init_settings.offload_kqv,
+        "logits_all": init_settings.logits_all,
         # "chat_format": "llama-2",  # @TODO Load from model_configs.chat_format
         "torch_dtype": "auto",  # if using CUDA (reduces memory usage)
         # "load_in_8bit": True,
     }
 
-    # @TODO Can we update these without needing to unload model?
+    # Generation settings can be changed later with update_generate_settings()
     # From: https://docs.llamaindex.ai/en/stable/examples/llm/llama_2_llama_cpp.html
     llm = LlamaCPP(
         # Provide a url to download a model from
@@ -221,9 +361,27 @@ def load_text_model(
         callback_manager=callback_manager,
         verbose=True,
     )
+    set_prompt_cache(llm, path_to_model, init_settings)
     return llm
 
 
+# Batched decoding engine sharing the weights of an already loaded model
+def load_batch_engine(
+    llm: LlamaCPP,
+    init_settings: classes.LoadTextInferenceInit,
+):
+    n_threads = init_settings.n_threads
+    if n_threads == -1:
+        n_threads = None
+    return BatchEngine(
+        model=llm._model,
+        n_parallel=init_settings.n_parallel,
+        n_ctx=llm.context_window,
+        n_batch=init_settings.n_batch,
+        n_threads=n_threads,
+    )
+
+
 # Remove from memory
 def unload_text_model(llm):
     # Python garbage collector should cleanup if no ref to obj exists
@@ -243,6 +401,9 @@ def token_streamer(token_generator):
         msg = f"Error streaming tokens: {e}"
         # print(msg)
         raise Exception(msg)
+    finally:
+        # Stop decoding if the consumer stopped early
+        token_generator.close()
 
 
 # Perform a streamed (synchronous) text completion on a prompt with trained data only
@@ -250,11 +411,11 @@ def text_stream_completion(
     prompt: str,
     system_message: str,
     message_format: str,
-    app,
+    llm: LlamaCPP,
     options,
+    engine: BatchEngine = None,  # decode alongside other requests
 ):
     sys_message = system_message or ""
-    llm: LlamaCPP = app.state.llm
     if llm == None:
         raise Exception("No Ai loaded.")
 
@@ -264,11 +425,19 @@ def text_stream_completion(
     print(f"{common.PRNT_API} Text Stream Completion: {message}", flush=True)
 
     # Stream response
-    token_generator = llm.stream_complete(message, formatted=True, kwargs=options)
-    for token in token_generator:
-        # print(token.delta, end="", flush=True)
-        payload = {"event": "GENERATING_TOKENS", "data": f"{token.delta}"}
-        yield json.dumps(payload)
+    if engine:
+        token_generator = engine.generate(message, options)
+    else:
+        token_generator = llm.stream_complete(message, formatted=True, kwargs=options)
+    try:
+        for token in token_generator:
+            delta = token if engine else token.delta
+            # print(delta, end="", flush=True)
+            payload = {"event": "GENERATING_TOKENS", "data": f"{delta}"}
+            yield json.dumps(payload)
+    finally:
+        # Stop decoding if the consumer stopped early
+        token_generator.close()
 
 
 # Perform a non-streamed (synchronous) text completion on a prompt with trained data only
@@ -276,11 +445,11 @@ def text_completion(
     prompt: str,
     system_message: str,
     message_format: str,
-    app,
+    llm: LlamaCPP,
     options,
+    engine: BatchEngine = None,  # decode alongside other requests
 ):
     sys_message = system_message or ""
-    llm: LlamaCPP = app.state.llm
     if llm == None:
         raise Exception("No Ai loaded.")
 
@@ -290,6 +459,8 @@ def text_completion(
     print(f"{common.PRNT_API} Text Non Stream Completion: {message}", flush=True)
 
     # Get response
+    if engine:
+        return CompletionResponse(text="".join(engine.generate(message, options)))
     res = llm.complete(message, formatted=True, kwargs=options)
     return res
 
@@ -299,10 +470,9 @@ def text_chat(
     messages: Sequence[str],
     system_message: str,
     message_format: str,
-    app,
+    llm: LlamaCPP,
     options,
 ):
-    llm: LlamaCPP = app.state.llm
     if llm == None:
         raise Exception("No Ai loaded.")
 
@@ -315,7 +485,11 @@ def text_chat(
 
     # Stream response
     token_generator = llm.stream_chat(formatted_messages, kwargs=options)
-    for token in token_generator:
-        # print(token.delta, end="", flush=True)
-        payload = {"event": "GENERATING_TOKENS", "data": f"{token.delta}"}
-        yield json.dumps(payload)
+    try:
+        for token in token_generator:
+            # print(token.delta, end="", flush=True)
+            payload = {"event": "GENERATING_TOKENS", "data": f"{token.delta}"}
+            yield json.dumps(payload)
+    finally:
+        # Stop decoding if the consumer stopped early
+        token_generator.close()
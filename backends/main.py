@@ -1,10 +1,11 @@
 import os
 import signal
+import asyncio
+import multiprocessing
 import sys
 import threading
 import uvicorn
 import webbrowser
-import httpx
 import socket
 import pyqrcode
 import tkinter as tk
@@ -19,11 +20,30 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from contextlib import asynccontextmanager
+from functools import partial
 from embeddings import storage as vector_storage
+from embeddings.embed_service import shutdown_embedding_service
+from embeddings.ingest_jobs import IngestionQueue, DEFAULT_INGEST_WORKERS
+from embeddings.main import IndexCache, DEFAULT_INDEX_CACHE_SIZE
+from embeddings.retrieval import (
+    RetrievalCache,
+    DEFAULT_RETRIEVAL_CACHE_SIZE,
+    DEFAULT_RETRIEVAL_CACHE_TTL,
+)
 from core import common, classes
+from core.http_client import HttpClient
+from inference.model_pool import ModelPool, DEFAULT_POOL_MAX_GB
+from inference.scheduler import InferenceScheduler
+from inference.downloads import (
+    DownloadManager,
+    DEFAULT_SEGMENTS,
+    DEFAULT_MAX_DOWNLOADS,
+)
+from inference.model_registry import ModelRegistry, migrate_settings_file
 from services.route import router as services
 from embeddings.route import router as embeddings
 from inference.route import router as text_inference
+from inference.openai_route import router as openai_compat
 from storage.route import router as storage
 
 
@@ -81,23 +101,78 @@ load_dotenv(env_path)
 @asynccontextmanager
 async def lifespan(application: FastAPI):
     print(f"{common.PRNT_API} Lifespan startup", flush=True)
-    # https://www.python-httpx.org/quickstart/
-    app.requests_client = httpx.Client()
+    # Pooled, keep-alive connections shared by url downloads and web loaders
+    # https://www.python-httpx.org/async/
+    app.requests_client = HttpClient()
     # Initialize global data here
     application.state.PORT_HOMEBREW_API = SERVER_PORT
     application.state.db_client = None
+    application.state.source_manifest = None  # created with the first collection access
+    application.state.lexical_index = None  # created with the first keyword search or write
     application.state.llm = None  # Set each time user loads a model
     application.state.path_to_model = ""  # Set each time user loads a model
     application.state.model_id = ""
     application.state.embed_model = None
+    application.state.reranker = None  # loaded with the first reranked query
+    application.state.answer_cache = None  # opened with the first cached completion
     app.state.loaded_text_model_data = {}
     app.state.is_prod = is_prod
     app.state.is_dev = is_dev
     app.state.is_debug = is_debug
+    # Admission queue that serializes requests for each loaded model
+    app.state.inference_scheduler = InferenceScheduler()
+    # Resident text models, each with a dedicated thread that runs its generations.
+    # Requests queued for a model are turned away when it is unloaded.
+    pool_max_gb = float(os.getenv("MODEL_POOL_MAX_GB", DEFAULT_POOL_MAX_GB))
+    app.state.model_pool = ModelPool(
+        max_bytes=int(pool_max_gb * 1024**3),
+        on_unload=partial(
+            app.state.inference_scheduler.reject_model_threadsafe,
+            asyncio.get_running_loop(),
+        ),
+    )
+    # Background document ingestion, resumes jobs interrupted by a restart
+    ingest_workers = int(os.getenv("INGEST_WORKERS") or DEFAULT_INGEST_WORKERS)
+    app.state.ingestion_queue = IngestionQueue(app, max_workers=ingest_workers)
+    # Vector indexes of recently queried collections
+    index_cache_size = int(os.getenv("INDEX_CACHE_SIZE") or DEFAULT_INDEX_CACHE_SIZE)
+    app.state.index_cache = IndexCache(max_size=index_cache_size)
+    # Installed text models, indexed by repo and file
+    app.state.model_registry = ModelRegistry()
+    migrate_settings_file(app.state.model_registry)
+    # Queued model downloads, fetched in parallel segments
+    app.state.download_manager = DownloadManager(
+        client=app.requests_client,
+        cache_dir=common.app_path(common.TEXT_MODELS_CACHE_DIR),
+        registry=app.state.model_registry,
+        segments=int(os.getenv("DOWNLOAD_SEGMENTS") or DEFAULT_SEGMENTS),
+        max_downloads=int(os.getenv("MAX_DOWNLOADS") or DEFAULT_MAX_DOWNLOADS),
+        endpoint=os.getenv("HF_ENDPOINT") or None,  # defaults to huggingface.co
+    )
+    # Results of recent RAG searches, dropped when their collection changes
+    app.state.retrieval_cache = RetrievalCache(
+        max_size=int(
+            os.getenv("RETRIEVAL_CACHE_SIZE") or DEFAULT_RETRIEVAL_CACHE_SIZE
+        ),
+        ttl=float(os.getenv("RETRIEVAL_CACHE_TTL") or DEFAULT_RETRIEVAL_CACHE_TTL),
+    )
 
     yield
     # Do shutdown cleanup here...
     print(f"{common.PRNT_API} Lifespan shutdown")
+    app.state.model_pool.unload_all()
+    app.state.ingestion_queue.shutdown()
+    if app.state.source_manifest:
+        app.state.source_manifest.close()
+    if app.state.lexical_index:
+        app.state.lexical_index.close()
+    if app.state.answer_cache:
+        app.state.answer_cache.close()
+    shutdown_embedding_service(app.state.embed_model)
+    # Unfinished downloads keep their partial file and resume when requested again
+    await app.state.download_manager.shutdown()
+    app.state.model_registry.close()
+    await app.requests_client.aclose()
 
 
 app = FastAPI(title="Obrew🍺Server", version=api_version, lifespan=lifespan)
@@ -253,6 +328,7 @@ endpoint_router.include_router(storage, prefix="/v1/persist", tags=["storage"])
 endpoint_router.include_router(
     text_inference, prefix="/v1/text", tags=["text inference"]
 )
+endpoint_router.include_router(openai_compat, prefix="/v1", tags=["openai"])
 app.include_router(endpoint_router)
 
 
@@ -319,6 +395,8 @@ def connect() -> classes.ConnectResponse:
 
 
 if __name__ == "__main__":
+    # Required for the ingestion process pool in frozen (packaged) builds
+    multiprocessing.freeze_support()
     try:
         # Show a window
         if not is_headless:
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Request
 from core import classes
-from embeddings.main import CHUNKING_STRATEGIES
+from embeddings.chunking import CHUNKING_STRATEGIES
 from llama_index.core.response_synthesizers import ResponseMode
 
 router = APIRouter()
@@ -33,6 +33,18 @@ def get_services_api(request: Request) -> classes.ServicesApiResponse:
                 "urlPath": "/v1/text/load",
                 "method": "POST",
             },
+            # Change settings of the loaded model, reloads only for init settings
+            {
+                "name": "settings",
+                "urlPath": "/v1/text/settings",
+                "method": "POST",
+            },
+            # Stop a queued or in-progress generation
+            {
+                "name": "cancel",
+                "urlPath": "/v1/text/cancel/{request_id}",
+                "method": "POST",
+            },
             # Eject the currently loaded Ai model from memory
             {
                 "name": "unload",
@@ -69,12 +81,30 @@ def get_services_api(request: Request) -> classes.ServicesApiResponse:
                 "urlPath": "/v1/text/getModelMetadata",
                 "method": "GET",
             },
-            # Download model from Huggingface
+            # Queue a model download from Huggingface
             {
                 "name": "download",
                 "urlPath": "/v1/text/download",
                 "method": "POST",
             },
+            # List queued, running and recently finished downloads
+            {
+                "name": "downloads",
+                "urlPath": "/v1/text/downloads",
+                "method": "GET",
+            },
+            # Stream a download's progress and throughput
+            {
+                "name": "downloadEvents",
+                "urlPath": "/v1/text/download/{id}/events",
+                "method": "GET",
+            },
+            # Stop a queued or running download
+            {
+                "name": "cancelDownload",
+                "urlPath": "/v1/text/download/{id}/cancel",
+                "method": "POST",
+            },
             # Delete model from cache
             {
                 "name": "delete",
@@ -111,6 +141,24 @@ def get_services_api(request: Request) -> classes.ServicesApiResponse:
                 "urlPath": "/v1/text/copilot",
                 "method": "POST",
             },
+            # OpenAI compatible completion on the loaded model
+            {
+                "name": "completions",
+                "urlPath": "/v1/completions",
+                "method": "POST",
+            },
+            # OpenAI compatible chat completion on the loaded model
+            {
+                "name": "chatCompletions",
+                "urlPath": "/v1/chat/completions",
+                "method": "POST",
+            },
+            # OpenAI compatible list of resident models
+            {
+                "name": "models",
+                "urlPath": "/v1/models",
+                "method": "GET",
+            },
         ],
     }
     data.append(text_inference_api)
@@ -211,6 +259,16 @@ def get_services_api(request: Request) -> classes.ServicesApiResponse:
                 "urlPath": "/v1/memory/addDocument",
                 "method": "POST",
             },
+            {
+                "name": "addDocuments",
+                "urlPath": "/v1/memory/addDocuments",
+                "method": "POST",
+            },
+            {
+                "name": "getSources",
+                "urlPath": "/v1/memory/getSources",
+                "method": "GET",
+            },
             {
                 "name": "getChunks",
                 "urlPath": "/v1/memory/getChunks",
@@ -236,6 +294,27 @@ def get_services_api(request: Request) -> classes.ServicesApiResponse:
                 "urlPath": "/v1/memory/wipe",
                 "method": "GET",
             },
+            # Background ingestion jobs created by addDocument/updateDocument
+            {
+                "name": "getJobs",
+                "urlPath": "/v1/memory/jobs",
+                "method": "GET",
+            },
+            {
+                "name": "getJob",
+                "urlPath": "/v1/memory/jobs/{id}",
+                "method": "GET",
+            },
+            {
+                "name": "cancelJob",
+                "urlPath": "/v1/memory/jobs/{id}/cancel",
+                "method": "POST",
+            },
+            {
+                "name": "retryJob",
+                "urlPath": "/v1/memory/jobs/{id}/retry",
+                "method": "POST",
+            },
         ],
     }
     data.append(memory_api)
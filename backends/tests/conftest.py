@@ -0,0 +1,7 @@
+###
+# Tests run from the backends folder, which the app itself runs from
+###
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
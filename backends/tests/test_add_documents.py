@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("multipart")
+pytest.importorskip("llama_index.embeddings.huggingface")
+
+from core import common
+from embeddings.route import document_name_from_path, list_source_files
+
+
+def test_folder_and_glob_list_supported_files_once(tmp_path):
+    (tmp_path / "nested").mkdir()
+    for name in ("a.txt", "b.md", "program.exe", "nested/c.txt"):
+        (tmp_path / name).write_text("text")
+    assert list_source_files(directory_path=str(tmp_path)) == [
+        str(tmp_path / "a.txt"),
+        str(tmp_path / "b.md"),
+        str(tmp_path / "nested" / "c.txt"),
+    ]
+    assert list_source_files(
+        directory_path=str(tmp_path),
+        glob_pattern=str(tmp_path / "*.txt"),
+        recursive=False,
+    ) == [str(tmp_path / "a.txt"), str(tmp_path / "b.md")]
+
+
+def test_missing_folder_is_an_error(tmp_path):
+    with pytest.raises(Exception):
+        list_source_files(directory_path=str(tmp_path / "missing"))
+
+
+@pytest.mark.parametrize(
+    "path, name",
+    [
+        ("/files/My Report (v2).PDF", "my-report-v2"),
+        ("a.txt", "document-a"),
+        (f"{'x' * 80}.txt", "x" * 63),
+    ],
+)
+def test_documents_are_named_after_their_file(path, name):
+    assert document_name_from_path(path) == name
+    assert common.check_valid_id(name)
@@ -0,0 +1,76 @@
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.llms.llama_cpp")
+
+from core import classes
+from inference import answer_cache, text_llama_index
+from inference.answer_cache import AnswerCache
+
+MODEL_ID = "test-model"
+PROMPT = "[INST] What is 2 + 2? [/INST]"
+
+
+def model_metadata(**generate_settings) -> dict:
+    return {
+        "modelId": MODEL_ID,
+        "mode": classes.CHAT_MODES.INSTRUCT.value,
+        "modelSettings": classes.LoadTextInferenceInit(),
+        "generateSettings": classes.LoadTextInferenceCall(**generate_settings),
+    }
+
+
+def test_is_deterministic():
+    assert answer_cache.is_deterministic({"temperature": 0, "seed": None})
+    assert answer_cache.is_deterministic({"temperature": 0.8, "seed": 42})
+    assert not answer_cache.is_deterministic({"temperature": 0.8, "seed": -1})
+
+
+def test_answer_is_returned_for_the_same_prompt_and_params(tmp_path):
+    cache = AnswerCache(path=str(tmp_path))
+    params = {"temperature": 0, "stream": False}
+    cache.put(model_id=MODEL_ID, prompt=PROMPT, params=params, text="4")
+    # Streaming does not change the answer
+    assert cache.get(MODEL_ID, PROMPT, {**params, "stream": True}) == "4"
+    assert cache.get(MODEL_ID, PROMPT, {**params, "temperature": 0.5}) is None
+    assert cache.get("other-model", PROMPT, params) is None
+    cache.close()
+
+
+def test_answer_survives_reopening(tmp_path):
+    cache = AnswerCache(path=str(tmp_path))
+    cache.put(model_id=MODEL_ID, prompt=PROMPT, params={}, text="4")
+    cache.close()
+    cache = AnswerCache(path=str(tmp_path))
+    assert cache.get(MODEL_ID, PROMPT, {}) == "4"
+    assert cache.used_bytes > 0
+    cache.close()
+
+
+def test_least_recently_used_answers_are_evicted(tmp_path):
+    cache = AnswerCache(path=str(tmp_path), max_bytes=200)
+    for i in range(10):
+        cache.put(model_id=MODEL_ID, prompt=f"prompt {i}", params={}, text="x" * 40)
+    assert cache.used_bytes <= 200
+    assert cache.get(MODEL_ID, "prompt 0", {}) is None
+    assert cache.get(MODEL_ID, "prompt 9", {}) == "x" * 40
+    cache.close()
+
+
+# The serial path samples with the model's settings, so changing them through
+# /settings must not return an answer generated with the old ones
+def test_settings_change_misses_the_cache(tmp_path):
+    cache = AnswerCache(path=str(tmp_path))
+    metadata = model_metadata(temperature=0)
+    cache.put(
+        model_id=MODEL_ID,
+        prompt=PROMPT,
+        params=text_llama_index.get_model_sampling(metadata),
+        text="4",
+    )
+    assert cache.get(MODEL_ID, PROMPT, text_llama_index.get_model_sampling(metadata))
+    # What ModelPool.update_settings does to a resident model's metadata
+    metadata = {**metadata, "generateSettings": classes.LoadTextInferenceCall(top_k=1)}
+    sampling = text_llama_index.get_model_sampling(metadata)
+    assert cache.get(MODEL_ID, PROMPT, sampling) is None
+    cache.close()
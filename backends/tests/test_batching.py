@@ -0,0 +1,82 @@
+import threading
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+pytest.importorskip("llama_cpp")
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.llms.llama_cpp")
+
+from core import classes
+from inference import text_llama_index
+from inference.batching import (
+    BatchRequest,
+    estimate_kv_bytes,
+    needs_serial_sampling,
+    sample_token,
+)
+
+
+def model_sampling(**generate_settings) -> dict:
+    return text_llama_index.get_model_sampling(
+        {
+            "mode": classes.CHAT_MODES.INSTRUCT.value,
+            "modelSettings": classes.LoadTextInferenceInit(),
+            "generateSettings": classes.LoadTextInferenceCall(**generate_settings),
+        }
+    )
+
+
+def make_request(options: dict, generated=None) -> BatchRequest:
+    request = BatchRequest([1, 2, 3], options, threading.Event())
+    request.generated = list(generated or [])
+    return request
+
+
+# Both paths sample with the model's settings, so the defaults can be batched
+def test_default_model_settings_can_be_batched():
+    assert not needs_serial_sampling(model_sampling())
+    assert needs_serial_sampling(model_sampling(grammar={"type": "object"}))
+    assert needs_serial_sampling(model_sampling(mirostat_tau=3.0))
+    assert needs_serial_sampling(model_sampling(tfs_z=0.9))
+
+
+def test_zero_temperature_is_greedy():
+    logits = np.array([0.1, 2.0, 0.5], dtype=np.float32)
+    request = make_request(model_sampling(temperature=0))
+    assert sample_token(logits, request) == 1
+
+
+def test_repeat_penalty_discourages_generated_tokens():
+    logits = np.array([1.0, 0.9], dtype=np.float32)
+    options = model_sampling(temperature=0, repeat_penalty=1.5)
+    assert sample_token(logits, make_request(options)) == 0
+    assert sample_token(logits, make_request(options, generated=[0])) == 1
+
+
+def test_top_k_of_one_keeps_the_best_token():
+    logits = np.array([0.1, 0.3, 0.2, 0.0], dtype=np.float32)
+    request = make_request(model_sampling(temperature=1.0, top_k=1))
+    assert all(sample_token(logits, request) == 1 for _ in range(20))
+
+
+def test_the_model_seed_makes_sampling_repeatable():
+    logits = np.zeros(100, dtype=np.float32)
+    options = model_sampling(temperature=1.0, top_k=0, top_p=1.0, min_p=0.0)
+    first, second = make_request(options), make_request(options)
+    assert [sample_token(logits, first) for _ in range(10)] == [
+        sample_token(logits, second) for _ in range(10)
+    ]
+
+
+def test_kv_bytes_count_grouped_query_heads():
+    model = SimpleNamespace(
+        metadata={
+            "general.architecture": "llama",
+            "llama.block_count": "32",
+            "llama.embedding_length": "4096",
+            "llama.attention.head_count": "32",
+            "llama.attention.head_count_kv": "8",
+        }
+    )
+    assert estimate_kv_bytes(model, 4096) == 2 * 32 * 4096 * 1024 * 2
@@ -0,0 +1,105 @@
+import asyncio
+import hashlib
+from types import SimpleNamespace
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("huggingface_hub")
+
+from core import http_client
+from core.http_client import HttpClient
+from inference import downloads
+from inference.downloads import DOWNLOAD_STATUS, DownloadManager
+from inference.model_registry import ModelRegistry
+
+REPO_ID = "org/model"
+FILENAME = "model.gguf"
+DATA = bytes(range(256)) * 64  # 16kb
+
+
+# Serves DATA like the hub's file storage, optionally ignoring range requests or
+# answering with an error status
+class FileServer:
+    def __init__(self, ranges: bool = True, status: int = None):
+        self.ranges = ranges
+        self.status = status
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request.headers.get("Range"))
+        if self.status:
+            return httpx.Response(self.status)
+        if not self.ranges:
+            return httpx.Response(200, content=DATA)
+        first, last = request.headers["Range"][len("bytes=") :].split("-")
+        return httpx.Response(206, content=DATA[int(first) : int(last) + 1])
+
+
+@pytest.fixture(autouse=True)
+def hub(monkeypatch):
+    metadata = SimpleNamespace(
+        size=len(DATA),
+        etag=hashlib.sha256(DATA).hexdigest(),
+        commit_hash="abc123",
+        location="https://files.test/model.gguf",
+    )
+    monkeypatch.setattr(downloads, "get_hf_file_metadata", lambda url: metadata)
+    monkeypatch.setattr(downloads, "MIN_SEGMENT_SIZE", 1024)
+    monkeypatch.setattr(downloads, "RETRY_BACKOFF", 0.0)
+    monkeypatch.setattr(http_client, "RETRY_BACKOFF", 0.0)
+
+
+def download(tmp_path, server: FileServer, segments: int = 4):
+    async def run():
+        client = HttpClient()
+        client.client = httpx.AsyncClient(transport=httpx.MockTransport(server))
+        registry = ModelRegistry(path=str(tmp_path))
+        manager = DownloadManager(
+            client, str(tmp_path / "cache"), registry, segments=segments
+        )
+        job = manager.submit(REPO_ID, FILENAME)
+        while not job.is_finished:
+            await job.changed.wait()
+        await manager.shutdown()
+        await client.aclose()
+        return job, registry
+
+    return asyncio.run(run())
+
+
+def test_file_is_fetched_in_segments_and_registered(tmp_path):
+    server = FileServer()
+    job, registry = download(tmp_path, server)
+    assert job.status == DOWNLOAD_STATUS.DONE, job.error
+    assert len(server.requests) == 4
+    with open(job.file_path, "rb") as file:
+        assert file.read() == DATA
+    assert registry.get_file(REPO_ID, FILENAME)["blob_path"] == job.file_path
+
+
+def test_server_without_ranges_falls_back_to_one_request(tmp_path):
+    server = FileServer(ranges=False)
+    job, _ = download(tmp_path, server)
+    assert job.status == DOWNLOAD_STATUS.DONE, job.error
+    assert server.requests[-1] == f"bytes=0-{len(DATA) - 1}"
+    with open(job.file_path, "rb") as file:
+        assert file.read() == DATA
+
+
+@pytest.mark.parametrize("status", [403, 416])
+def test_refused_request_fails_without_retrying(tmp_path, status):
+    server = FileServer(status=status)
+    job, registry = download(tmp_path, server, segments=1)
+    assert job.status == DOWNLOAD_STATUS.FAILED
+    assert str(status) in job.error
+    assert len(server.requests) == 1
+    assert registry.get_file(REPO_ID, FILENAME) is None
+
+
+def test_busy_server_is_retried(tmp_path):
+    server = FileServer(status=503)
+    job, _ = download(tmp_path, server, segments=1)
+    assert job.status == DOWNLOAD_STATUS.FAILED
+    # The client's own retries for every attempt at the segment
+    retries = http_client.DEFAULT_RETRIES + 1
+    assert len(server.requests) == retries * (downloads.MAX_SEGMENT_RETRIES + 1)
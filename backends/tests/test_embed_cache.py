@@ -0,0 +1,36 @@
+import time
+import pytest
+
+pytest.importorskip("numpy")
+
+from embeddings.embed_cache import EmbeddingCache, make_key
+
+
+def test_keys_depend_on_text_model_and_prompt():
+    key = make_key("Some text", "model", "query")
+    assert make_key("  Some text\n", "model", "query") == key
+    assert make_key("Some text", "other-model", "query") != key
+    assert make_key("Some text", "model", "document") != key
+
+
+def test_vectors_survive_a_restart(tmp_path):
+    cache = EmbeddingCache(path=str(tmp_path))
+    cache.put_many({"a": [0.5, -1.0, 2.0]})
+    cache.close()
+    cache = EmbeddingCache(path=str(tmp_path))
+    assert cache.get_many(["a", "missing"]) == {"a": [0.5, -1.0, 2.0]}
+    assert cache.used_bytes == 3 * 2  # float16
+    cache.close()
+
+
+def test_least_recently_used_vectors_are_evicted(tmp_path):
+    vector = [0.0] * 50  # 100 bytes stored
+    cache = EmbeddingCache(path=str(tmp_path), max_bytes=300)
+    cache.put_many({"a": vector, "b": vector, "c": vector})
+    time.sleep(0.01)
+    cache.get_many(["a"])  # now b and c are the least recently used
+    cache.put_many({"d": vector})
+    # Evicted down to 90% of the cap
+    assert set(cache.get_many(["a", "b", "c", "d"])) == {"a", "d"}
+    assert cache.used_bytes == 200
+    cache.close()
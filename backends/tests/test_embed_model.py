@@ -0,0 +1,58 @@
+import time
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.embeddings.huggingface")
+
+from llama_index.core import MockEmbedding, Settings
+from embeddings import main
+
+
+def test_concurrent_callers_share_one_embed_model(monkeypatch):
+    services = []
+
+    def start_service(model_name, cache_folder):
+        time.sleep(0.05)  # give other callers the chance to race
+        services.append(model_name)
+        return SimpleNamespace(model_name=model_name)
+
+    monkeypatch.setattr(main, "EmbeddingService", start_service)
+    monkeypatch.setattr(main, "EmbeddingCache", lambda max_bytes: None)
+    monkeypatch.setattr(
+        main, "ServiceEmbedding", lambda service, cache: MockEmbedding(embed_dim=8)
+    )
+    monkeypatch.setattr(Settings, "_embed_model", Settings._embed_model)
+    app = SimpleNamespace(state=SimpleNamespace(embed_model=None))
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        models = list(pool.map(lambda _: main.define_embedding_model(app), range(8)))
+    assert len(services) == 1
+    assert all(model is app.state.embed_model for model in models)
+
+
+def test_index_cache_keeps_recently_queried_collections():
+    cache = main.IndexCache(max_size=2)
+    indexes = {name: object() for name in ("a", "b", "c")}
+    cache.put("a", indexes["a"])
+    cache.put("b", indexes["b"])
+    cache.get("a")  # now b is the least recently used
+    cache.put("c", indexes["c"])
+    assert cache.get("b") is None
+    assert cache.get("a") is indexes["a"] and cache.get("c") is indexes["c"]
+
+
+def test_changing_a_collection_drops_its_cached_index_and_results():
+    invalidated = []
+    app = SimpleNamespace(
+        state=SimpleNamespace(
+            index_cache=main.IndexCache(),
+            retrieval_cache=SimpleNamespace(invalidate=invalidated.append),
+        )
+    )
+    app.state.index_cache.put("a", object())
+    app.state.index_cache.put("b", object())
+    main.invalidate_index(app, "a")
+    assert main.get_index_cache(app).get("a") is None
+    assert main.get_index_cache(app).get("b") is not None
+    assert invalidated == ["a"]
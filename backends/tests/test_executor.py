@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import pytest
+from inference.executor import InferenceExecutor
+
+
+@pytest.fixture
+def executor():
+    executor = InferenceExecutor(name="test")
+    yield executor
+    executor.shutdown()
+
+
+def test_calls_run_on_the_worker_thread(executor):
+    assert executor.submit(threading.current_thread).name.startswith("test")
+    worker = asyncio.run(executor.run(threading.current_thread))
+    assert worker is not threading.current_thread()
+
+
+def test_stream_bridges_items_and_errors(executor):
+    def tokens():
+        yield "a"
+        yield "b"
+        raise ValueError("decode failed")
+
+    async def collect():
+        items = []
+        with pytest.raises(ValueError):
+            async for item in executor.stream(tokens):
+                items.append(item)
+        return items
+
+    assert asyncio.run(collect()) == ["a", "b"]
+
+
+def test_closing_the_stream_stops_the_generator(executor):
+    closed = threading.Event()
+
+    def tokens():
+        try:
+            while True:
+                yield "token"
+        finally:
+            closed.set()
+
+    async def take_one():
+        cancel_event = threading.Event()
+        stream = executor.stream(tokens, cancel_event)
+        item = await stream.__anext__()
+        await stream.aclose()
+        return item, cancel_event
+
+    item, cancel_event = asyncio.run(take_one())
+    assert item == "token" and cancel_event.is_set()
+    assert closed.wait(5)
@@ -0,0 +1,85 @@
+import asyncio
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+from core import http_client
+from core.http_client import HttpClient
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(http_client, "RETRY_BACKOFF", 0.0)
+
+
+def fetch(handler, url: str = "https://site.test/page", **kwargs):
+    async def run():
+        client = HttpClient(**kwargs)
+        client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            async with client.stream("GET", url) as res:
+                return await res.aread()
+        finally:
+            await client.aclose()
+
+    return asyncio.run(run())
+
+
+def test_busy_server_is_retried_until_it_answers():
+    statuses = [503, 429, 200]
+
+    def handler(request):
+        return httpx.Response(statuses.pop(0), text="page")
+
+    assert fetch(handler) == b"page"
+    assert statuses == []
+
+
+def test_errors_raise_once_retries_run_out():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(503)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        fetch(handler, retries=2)
+    assert len(requests) == 3
+
+
+def test_client_errors_are_not_retried():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(404)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        fetch(handler)
+    assert len(requests) == 1
+
+
+def test_requests_to_one_host_are_bounded():
+    active = []
+    peak = []
+
+    async def handler(request):
+        active.append(request)
+        peak.append(len(active))
+        await asyncio.sleep(0.01)
+        active.remove(request)
+        return httpx.Response(200)
+
+    async def run():
+        client = HttpClient(max_per_host=2)
+        client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+        async def get(i):
+            async with client.stream("GET", f"https://site.test/{i}") as res:
+                await res.aread()
+
+        await asyncio.gather(*(get(i) for i in range(6)))
+        await client.aclose()
+
+    asyncio.run(run())
+    assert max(peak) == 2
@@ -0,0 +1,254 @@
+import os
+import time
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.embeddings.huggingface")
+
+from embeddings import ingest_jobs
+from embeddings.ingest_jobs import IngestionQueue, JobStore
+
+FORM = {
+    "collection_name": "docs",
+    "document_id": "doc-1",
+    "document_name": "notes",
+    "description": "",
+    "tags": "",
+    "chunk_size": 300,
+    "chunk_overlap": 0,
+    "chunk_strategy": "",
+    "parsing_method": "",
+}
+
+
+def wait_for_status(queue: IngestionQueue, job_id: str, status: str) -> dict:
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        job = queue.store.get(job_id)
+        if job["status"] == status:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} is {job['status']}, not {status}")
+
+
+@pytest.fixture
+def source_file(tmp_path) -> dict:
+    path = tmp_path / "notes.txt"
+    path.write_text("Some notes.")
+    return {"document_id": "doc-1", "file_name": "notes.txt", "path_to_file": str(path)}
+
+
+@pytest.fixture
+def parse_results(monkeypatch) -> list:
+    # Each parse takes the next result, an exception fails the job
+    results = []
+
+    def parse_and_chunk(input_file, form):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(ingest_jobs, "parse_and_chunk", parse_and_chunk)
+    return results
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    collection = SimpleNamespace(name=FORM["collection_name"])
+    db = SimpleNamespace(get_collection=lambda name: collection)
+    monkeypatch.setattr(ingest_jobs, "define_embedding_model", lambda app: None)
+    monkeypatch.setattr(ingest_jobs, "get_vector_db_client", lambda app: db)
+    monkeypatch.setattr(ingest_jobs, "invalidate_index", lambda app, name: None)
+    monkeypatch.setattr(
+        ingest_jobs, "update_collection_sources", lambda **kwargs: None
+    )
+    queue = IngestionQueue(
+        app=SimpleNamespace(), max_workers=1, path=str(tmp_path / "jobs")
+    )
+    # Parse in a thread, the process pool would re-import the whole app
+    queue._pool.shutdown()
+    queue._pool = ThreadPoolExecutor(max_workers=1)
+    yield queue
+    queue.shutdown()
+
+
+def test_failed_job_completes_when_retried(queue, source_file, parse_results):
+    source_record = {"id": FORM["document_id"], "chunkIds": []}
+    parse_results.extend([Exception("parser crashed"), [(source_record, [])]])
+    job = queue.submit(input_file=source_file, form=FORM)
+    failed = wait_for_status(queue, job["id"], ingest_jobs.FAILED)
+    assert failed["error"] == "parser crashed"
+    # The source file is kept for the retry
+    assert os.path.exists(source_file["path_to_file"])
+    assert queue.retry(job["id"])
+    done = wait_for_status(queue, job["id"], ingest_jobs.DONE)
+    assert done["attempts"] == 2
+    assert done["progress"] == 100
+    assert not os.path.exists(source_file["path_to_file"])
+
+
+def test_pruning_removes_the_source_file_of_failed_jobs(
+    queue, source_file, parse_results
+):
+    parse_results.append(Exception("parser crashed"))
+    job = queue.submit(input_file=source_file, form=FORM)
+    wait_for_status(queue, job["id"], ingest_jobs.FAILED)
+    assert queue.prune(max_age_days=1) == 0
+    time.sleep(0.01)
+    assert queue.prune(max_age_days=1e-9) == 1
+    assert queue.store.get(job["id"]) is None
+    assert not os.path.exists(source_file["path_to_file"])
+
+
+def test_store_claims_oldest_queued_job_first(tmp_path):
+    store = JobStore(str(tmp_path))
+    first = store.create({}, {**FORM, "document_id": "first"})
+    second = store.create({}, {**FORM, "document_id": "second"})
+    assert store.claim_next()["id"] == first["id"]
+    assert store.get(first["id"])["status"] == ingest_jobs.RUNNING
+    assert store.claim_next()["id"] == second["id"]
+    assert store.claim_next() is None
+    store.close()
+
+
+def test_store_requeues_jobs_left_running(tmp_path):
+    store = JobStore(str(tmp_path))
+    job = store.create({}, FORM)
+    store.claim_next()
+    store.update(job["id"], progress=50, embedded_chunks=10)
+    store.close()
+    store = JobStore(str(tmp_path))
+    assert store.requeue_interrupted() == 1
+    job = store.get(job["id"])
+    assert job["status"] == ingest_jobs.QUEUED
+    assert job["progress"] == 0
+    assert job["attempts"] == 1
+    store.close()
+
+
+@pytest.fixture
+def stored_collection(queue, monkeypatch):
+    import chromadb
+    from llama_index.core import MockEmbedding
+
+    client = chromadb.EphemeralClient()
+    collection = client.get_or_create_collection(FORM["collection_name"])
+    db = SimpleNamespace(get_collection=lambda name: collection)
+    lexical = SimpleNamespace(
+        add=lambda name, rows: None, delete_chunks=lambda name, ids: None
+    )
+    monkeypatch.setattr(ingest_jobs, "get_vector_db_client", lambda app: db)
+    monkeypatch.setattr(ingest_jobs, "get_lexical_index", lambda app: lexical)
+    monkeypatch.setattr(
+        ingest_jobs, "define_embedding_model", lambda app: MockEmbedding(embed_dim=8)
+    )
+    yield collection
+    client.delete_collection(FORM["collection_name"])
+
+
+def test_update_only_embeds_changed_chunks(
+    queue, stored_collection, source_file, parse_results, monkeypatch
+):
+    from llama_index.core import Document
+    from llama_index.core.schema import TextNode
+    from embeddings.chunking import chunks_from_documents
+
+    def chunked(*texts):
+        record = {
+            "id": FORM["document_id"],
+            "filePath": source_file["path_to_file"],
+            "chunkIds": [],
+        }
+        ids, nodes = chunks_from_documents(
+            documents=[Document(text="", id_=FORM["document_id"])],
+            parsed_nodes=[TextNode(text=text) for text in texts],
+            source_record=record,
+        )
+        record["chunkIds"] = ids
+        return [(record, nodes)]
+
+    first = chunked("alpha", "beta")
+    parse_results.append(first)
+    job = queue.submit(input_file=source_file, form=FORM)
+    wait_for_status(queue, job["id"], ingest_jobs.DONE)
+    alpha_id, beta_id = first[0][0]["chunkIds"]
+    monkeypatch.setattr(
+        ingest_jobs, "get_sources_from_ids", lambda app, name, ids: [first[0][0]]
+    )
+    second = chunked("alpha", "gamma")
+    parse_results.append(second)
+    job = queue.submit(input_file=source_file, form={**FORM, "is_update": True})
+    wait_for_status(queue, job["id"], ingest_jobs.DONE)
+    chunk_ids = second[0][0]["chunkIds"]
+    # The unchanged chunk keeps its id and embedding, the removed one is deleted
+    assert chunk_ids[0] == alpha_id
+    assert set(stored_collection.get()["ids"]) == set(chunk_ids)
+    assert beta_id not in chunk_ids
+
+
+def test_pdf_is_embedded_a_window_of_pages_at_a_time(
+    queue, stored_collection, tmp_path, monkeypatch
+):
+    from llama_index.core.schema import IndexNode
+
+    path = tmp_path / "book.pdf"
+    path.write_bytes(b"%PDF")
+    windows = []
+
+    def create_pdf_source_record(input_file, form):
+        return {"id": form["document_id"], "totalPages": 5, "chunkIds": []}
+
+    def chunk_pdf_window(input_file, form, start, end):
+        windows.append((start, end))
+        return [
+            IndexNode(text=f"page {page}", index_id="doc-1", metadata={"page": page})
+            for page in range(start + 1, end + 1)
+        ]
+
+    monkeypatch.setattr(ingest_jobs, "PDF_PAGE_WINDOW", 2)
+    monkeypatch.setattr(
+        ingest_jobs, "create_pdf_source_record", create_pdf_source_record
+    )
+    monkeypatch.setattr(ingest_jobs, "chunk_pdf_window", chunk_pdf_window)
+    input_file = {"document_id": "doc-1", "path_to_file": str(path)}
+    job = queue.submit(input_file=input_file, form=FORM)
+    done = wait_for_status(queue, job["id"], ingest_jobs.DONE)
+    assert windows == [(0, 2), (2, 4), (4, 5)]
+    assert done["embedded_chunks"] == done["total_chunks"] == 5
+    stored = stored_collection.get(include=["metadatas"])
+    # Chunks are numbered across windows
+    orders = {m["page"]: m["order"] for m in stored["metadatas"]}
+    assert orders == {1: 0, 2: 1, 3: 2, 4: 3, 5: 4}
+
+
+def test_chunks_are_deleted_by_source_id(stored_collection):
+    from embeddings.storage import delete_source_chunks
+
+    stored_collection.add(
+        ids=["a1", "a2", "b1", "c1"],
+        embeddings=[[0.0] * 8] * 4,
+        metadatas=[{"sourceId": s} for s in ("a", "a", "b", "c")],
+    )
+    delete_source_chunks(stored_collection, ["a", "c"])
+    assert stored_collection.get()["ids"] == ["b1"]
+
+
+def test_deletion_job_removes_sources_in_batches(queue, monkeypatch):
+    batches = []
+
+    def get_sources_from_ids(app, name, ids):
+        return [{"id": id, "chunkIds": [f"{id}-1", f"{id}-2"]} for id in ids]
+
+    def delete_sources(app, collection_name, sources):
+        batches.append([s["id"] for s in sources])
+
+    monkeypatch.setattr(ingest_jobs, "DELETE_BATCH_SIZE", 2)
+    monkeypatch.setattr(ingest_jobs, "get_sources_from_ids", get_sources_from_ids)
+    monkeypatch.setattr(ingest_jobs, "delete_sources", delete_sources)
+    job = queue.submit_deletion(FORM["collection_name"], ["a", "b", "c"], 6)
+    done = wait_for_status(queue, job["id"], ingest_jobs.DONE)
+    assert batches == [["a", "b"], ["c"]]
+    assert done["embedded_chunks"] == 6
@@ -0,0 +1,71 @@
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.core")
+
+from embeddings.lexical import LexicalIndex, to_match_query
+
+ROWS = [
+    ("chunk-1", "source-a", "Error ERR-404 means the page was not found."),
+    ("chunk-2", "source-a", "Restart the router to clear the error."),
+    ("chunk-3", "source-b", "Part number X-1138 ships in spring."),
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = LexicalIndex(path=str(tmp_path))
+    yield index
+    index.close()
+
+
+def test_match_query_quotes_each_term():
+    assert to_match_query('ERR-404 "quoted"?') == '"ERR-404" OR "quoted"'
+    assert to_match_query(" ,. ") == ""
+
+
+def test_search_ranks_exact_identifiers(index):
+    index.rebuild("docs", ROWS)
+    hits = index.search("docs", "X-1138", top_k=5)
+    assert [chunk_id for chunk_id, _ in hits] == ["chunk-3"]
+    hits = index.search("docs", "error", top_k=5)
+    assert {chunk_id for chunk_id, _ in hits} == {"chunk-1", "chunk-2"}
+    assert all(score > 0 for _, score in hits)
+
+
+def test_collections_are_searched_apart(index):
+    index.rebuild("docs", ROWS)
+    index.add("notes", [("note-1", "source-c", "Error in the notes.")])
+    assert [c for c, _ in index.search("notes", "error", top_k=5)] == ["note-1"]
+    assert "note-1" not in [c for c, _ in index.search("docs", "error", top_k=5)]
+    assert index.search("missing", "error", top_k=5) == []
+
+
+def test_rebuild_marks_a_collection_complete(index):
+    index.add("docs", ROWS[:1])
+    assert not index.is_indexed("docs")
+    index.rebuild("docs", ROWS)
+    assert index.is_indexed("docs")
+    assert len(index.search("docs", "error", top_k=5)) == 2
+
+
+def test_chunks_are_removed_by_id_source_or_collection(index):
+    index.rebuild("docs", ROWS)
+    index.delete_chunks("docs", ["chunk-1"])
+    assert [c for c, _ in index.search("docs", "error", top_k=5)] == ["chunk-2"]
+    index.delete_sources("docs", ["source-a"])
+    assert index.search("docs", "error", top_k=5) == []
+    assert index.search("docs", "X-1138", top_k=5)
+    index.delete_collection("docs")
+    assert not index.is_indexed("docs")
+    assert index.search("docs", "X-1138", top_k=5) == []
+    # Deleting from a collection without tables does nothing
+    index.delete_chunks("docs", ["chunk-3"])
+
+
+def test_clear_drops_every_collection(index):
+    index.rebuild("docs", ROWS)
+    index.add("notes", [("note-1", "source-c", "Error in the notes.")])
+    index.clear()
+    assert not index.is_indexed("docs")
+    assert index.search("notes", "error", top_k=5) == []
@@ -0,0 +1,56 @@
+import json
+from types import SimpleNamespace
+import pytest
+from embeddings.manifest import SourceManifest, migrate_collection_metadata
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    manifest = SourceManifest(path=str(tmp_path))
+    yield manifest
+    manifest.close()
+
+
+def source(source_id: str, chunk_ids: list, **record) -> dict:
+    return dict(id=source_id, name=source_id, chunkIds=chunk_ids, **record)
+
+
+def test_sources_keep_their_order_and_chunks(manifest):
+    manifest.put("docs", [source("b", ["b1", "b2"]), source("a", ["a1"])])
+    manifest.put("other", [source("a", ["x1"])])
+    assert [s["id"] for s in manifest.list("docs")] == ["b", "a"]
+    assert manifest.get("docs", ["a", "b"])[1]["chunkIds"] == ["a1"]
+    assert manifest.list("docs", offset=1, limit=1)[0]["id"] == "a"
+    assert "chunkIds" not in manifest.list("docs", include_chunks=False)[0]
+    assert manifest.count("docs") == 2 and manifest.count("other") == 1
+
+
+def test_updating_a_source_replaces_its_chunks_in_place(manifest):
+    manifest.put("docs", [source("a", ["a1", "a2"]), source("b", ["b1"])])
+    manifest.put("docs", [source("a", ["a3"], description="new")])
+    updated = manifest.list("docs")
+    assert [s["id"] for s in updated] == ["a", "b"]
+    assert updated[0]["chunkIds"] == ["a3"]
+    assert updated[0]["description"] == "new"
+
+
+def test_deleting_sources_removes_their_chunks(manifest):
+    manifest.put("docs", [source("a", ["a1"]), source("b", ["b1"])])
+    manifest.delete("docs", ["a"])
+    assert manifest.get("docs", ["a"]) == []
+    manifest.put("docs", [source("a", [])])
+    assert manifest.get("docs", ["a"])[0]["chunkIds"] == []
+    manifest.delete_collection("docs")
+    assert manifest.count("docs") == 0
+
+
+def test_sources_kept_in_collection_metadata_are_moved(manifest):
+    sources = [source("a", ["a1"])]
+    collection = SimpleNamespace(
+        name="docs",
+        metadata={"sources": json.dumps(sources)},
+        modify=lambda metadata: None,
+    )
+    migrate_collection_metadata(manifest, collection)
+    assert manifest.list("docs") == sources
+    assert collection.metadata["sources"] == "[]"
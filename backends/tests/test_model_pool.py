@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("llama_cpp")
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.llms.llama_cpp")
+
+from core import classes
+from inference import text_llama_index
+from inference.model_pool import ModelPool
+
+MODE = classes.CHAT_MODES.INSTRUCT.value
+
+
+@pytest.fixture(autouse=True)
+def fake_models(monkeypatch) -> list:
+    unloaded = []
+
+    def load_text_model(path_to_model, mode, init, gen, callback_manager=None):
+        llm = SimpleNamespace(path=path_to_model)
+        text_llama_index.update_generate_settings(llm, mode, init, gen)
+        return llm
+
+    def load_batch_engine(llm, init_settings):
+        return SimpleNamespace(kv_bytes=100, shutdown=lambda: None)
+
+    monkeypatch.setattr(text_llama_index, "load_text_model", load_text_model)
+    monkeypatch.setattr(text_llama_index, "load_batch_engine", load_batch_engine)
+    monkeypatch.setattr(text_llama_index, "unload_text_model", unloaded.append)
+    return unloaded
+
+
+@pytest.fixture
+def model_file(tmp_path):
+    def write(name: str, size: int) -> str:
+        path = tmp_path / name
+        path.write_bytes(b"\0" * size)
+        return str(path)
+
+    return write
+
+
+def load(pool: ModelPool, model_id: str, path: str, **init_settings):
+    return pool.load(
+        model_id=model_id,
+        path_to_model=path,
+        mode=MODE,
+        init_settings=classes.LoadTextInferenceInit(**init_settings),
+        gen_settings=classes.LoadTextInferenceCall(),
+    )
+
+
+def test_least_recently_used_model_is_evicted(model_file, fake_models):
+    unloaded_ids = []
+    pool = ModelPool(max_bytes=1000, on_unload=unloaded_ids.append)
+    load(pool, "a", model_file("a", 400))
+    load(pool, "b", model_file("b", 400))
+    pool.get("a")  # now b is the least recently used
+    load(pool, "c", model_file("c", 400))
+    assert "a" in pool and "c" in pool and "b" not in pool
+    assert unloaded_ids == ["b"]
+    assert pool.used_bytes == 800
+    assert [m["modelId"] for m in pool.stats("c")["models"]] == ["c", "a"]
+    pool.unload_all()
+    assert pool.used_bytes == 0
+    assert len(fake_models) == 3
+
+
+def test_batched_model_counts_its_kv_cache(model_file):
+    pool = ModelPool(max_bytes=1000)
+    entry = load(pool, "a", model_file("a", 400), n_parallel=4)
+    assert entry.batch_engine and entry.batch_executor
+    assert entry.size_bytes == 500
+    pool.unload_all()
+
+
+def test_prompt_cache_counts_towards_the_budget(model_file):
+    pool = ModelPool(max_bytes=1000)
+    entry = load(pool, "a", model_file("a", 400), cache=True, cache_size=300)
+    assert entry.size_bytes == 700
+    load(pool, "b", model_file("b", 400))
+    assert "a" not in pool
+    pool.unload_all()
+
+
+# Batched completions sample with the settings in the entry's metadata
+def test_settings_update_reaches_serial_and_batched_paths(model_file):
+    pool = ModelPool(max_bytes=1000)
+    entry = load(pool, "a", model_file("a", 400), n_parallel=2)
+    settings = classes.LoadTextInferenceCall(temperature=0.0, top_k=1)
+    entry = pool.update_settings("a", settings)
+    assert entry.llm.generate_kwargs["temperature"] == 0.0
+    assert entry.llm.generate_kwargs["top_k"] == 1
+    sampling = text_llama_index.get_model_sampling(entry.metadata)
+    assert sampling == entry.llm.generate_kwargs
+    pool.unload_all()
+
+
+def test_updating_a_model_that_is_not_loaded_fails():
+    pool = ModelPool(max_bytes=1000)
+    with pytest.raises(Exception):
+        pool.update_settings("missing", classes.LoadTextInferenceCall())
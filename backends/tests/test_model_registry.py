@@ -0,0 +1,60 @@
+import json
+import pytest
+from core import common
+from inference.model_registry import ModelRegistry, migrate_settings_file
+
+
+@pytest.fixture
+def registry(tmp_path):
+    registry = ModelRegistry(path=str(tmp_path))
+    yield registry
+    registry.close()
+
+
+def test_files_are_listed_under_their_model(registry):
+    registry.put_file("org/b", "b.gguf", blob_path="/blobs/b", size=10)
+    registry.put_file("org/a", "a-q4.gguf", blob_path="/blobs/a4")
+    registry.put_file("org/a", "a-q8.gguf", blob_path="/blobs/a8")
+    assert [m["repoId"] for m in registry.list()] == ["org/b", "org/a"]
+    assert registry.get("org/a")["savePath"] == {
+        "a-q4.gguf": "/blobs/a4",
+        "a-q8.gguf": "/blobs/a8",
+    }
+    assert registry.get_file("org/b", "b.gguf")["size"] == 10
+    # Installing again only updates where the file is
+    registry.put_file("org/b", "b.gguf", blob_path="/blobs/b2")
+    assert registry.get("org/b")["savePath"] == {"b.gguf": "/blobs/b2"}
+
+
+def test_deleting_a_model_forgets_its_files(registry):
+    registry.put_file("org/a", "a.gguf", blob_path="/blobs/a")
+    registry.delete("org/a")
+    assert registry.get("org/a") is None
+    assert registry.get_file("org/a", "a.gguf") is None
+
+
+def test_installed_models_file_is_imported_once(registry, tmp_path, monkeypatch):
+    model_file = tmp_path / "a.gguf"
+    model_file.write_bytes(b"\0" * 8)
+    settings_file = tmp_path / "installed_models.json"
+    installed = [
+        dict(repoId="org/a", savePath={"a.gguf": str(model_file)}, numTimesRun=3),
+        # Recorded before its download finished
+        dict(repoId="org/b", savePath={"b.gguf": ""}),
+    ]
+    settings_file.write_text(json.dumps({common.INSTALLED_TEXT_MODELS: installed}))
+    monkeypatch.setattr(common, "MODEL_METADATAS_FILEPATH", str(settings_file))
+    migrate_settings_file(registry)
+    assert registry.is_migrated
+    assert registry.list() == [
+        dict(
+            repoId="org/a",
+            savePath={"a.gguf": str(model_file)},
+            numTimesRun=3,
+            isFavorited=False,
+        )
+    ]
+    assert registry.get_file("org/a", "a.gguf")["size"] == 8
+    registry.delete("org/a")
+    migrate_settings_file(registry)
+    assert registry.list() == []
@@ -0,0 +1,167 @@
+import json
+import inspect
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("llama_cpp")
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.llms.llama_cpp")
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from llama_cpp import Llama
+from core import classes
+from inference import openai_route, text_llama_index
+from inference.model_pool import ModelPool
+from inference.scheduler import InferenceScheduler
+
+MODEL_ID = "stub"
+
+
+# Stands in for llama-cpp-python's Llama, a token per word. Arguments are checked
+# against the real methods so the route only passes what the pinned version takes.
+class StubLlama:
+    chat_format = None
+    metadata = {}
+
+    def __init__(self):
+        self.calls = 0
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        return [0] * (len(text.split()) + int(add_bos))
+
+    def create_completion(self, prompt: str, stream: bool = False, **kwargs):
+        inspect.signature(Llama.create_completion).bind(
+            self, prompt, stream=stream, **kwargs
+        )
+        return self._respond(prompt, stream, "text_completion", "text")
+
+    def create_chat_completion(self, messages, stream: bool = False, **kwargs):
+        inspect.signature(Llama.create_chat_completion).bind(
+            self, messages, stream=stream, **kwargs
+        )
+        prompt = "".join(m["content"] for m in messages)
+        return self._respond(prompt, stream, "chat.completion", "message")
+
+    def _respond(self, prompt: str, stream: bool, kind: str, field: str):
+        self.calls += 1
+        words = ["one", "two", "three", "four"][: self.calls]
+        text = " ".join(words)
+        if stream:
+
+            def chunks():
+                for i, word in enumerate(words):
+                    delta = word if i == 0 else f" {word}"
+                    if field == "message":
+                        choice = {"index": 0, "delta": {"content": delta}}
+                    else:
+                        choice = {"index": 0, "text": delta}
+                    yield dict(
+                        id="x",
+                        object=f"{kind}.chunk",
+                        created=0,
+                        model=MODEL_ID,
+                        choices=[choice],
+                    )
+
+            return chunks()
+        if field == "message":
+            choice = {"index": 0, "message": {"role": "assistant", "content": text}}
+        else:
+            choice = {"index": 0, "text": text}
+        prompt_tokens = len(self.tokenize(prompt.encode("utf-8")))
+        return dict(
+            id="x",
+            object=kind,
+            created=0,
+            model=MODEL_ID,
+            choices=[choice],
+            usage={
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(words),
+                "total_tokens": prompt_tokens + len(words),
+            },
+        )
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    llama = StubLlama()
+    monkeypatch.setattr(
+        text_llama_index,
+        "load_text_model",
+        lambda *args, **kwargs: SimpleNamespace(_model=llama),
+    )
+    model_file = tmp_path / "model.gguf"
+    model_file.write_bytes(b"\0")
+    pool = ModelPool(max_bytes=1000)
+    pool.load(
+        model_id=MODEL_ID,
+        path_to_model=str(model_file),
+        mode=classes.CHAT_MODES.INSTRUCT.value,
+        init_settings=classes.LoadTextInferenceInit(),
+        gen_settings=classes.LoadTextInferenceCall(),
+    )
+    app = FastAPI()
+    app.include_router(openai_route.router, prefix="/v1")
+    app.state.model_pool = pool
+    app.state.model_id = MODEL_ID
+    app.state.inference_scheduler = InferenceScheduler()
+    with TestClient(app) as client:
+        yield client
+    pool.unload_all()
+
+
+def test_chat_completion_counts_the_prompt_once_for_all_choices(client):
+    res = client.post(
+        "/v1/chat/completions",
+        json={"messages": [{"role": "user", "content": "hi there"}], "n": 3},
+    )
+    assert res.status_code == 200
+    body = res.json()
+    assert [c["index"] for c in body["choices"]] == [0, 1, 2]
+    assert body["choices"][2]["message"]["content"] == "one two three"
+    assert body["usage"] == {
+        "prompt_tokens": 3,
+        "completion_tokens": 6,
+        "total_tokens": 9,
+    }
+
+
+def test_completion_counts_each_prompt_once(client):
+    res = client.post(
+        "/v1/completions", json={"prompt": ["a b", "c d e"], "n": 2, "logprobs": 2}
+    )
+    assert res.status_code == 200
+    body = res.json()
+    assert len(body["choices"]) == 4
+    assert body["usage"]["prompt_tokens"] == 3 + 4
+    assert body["usage"]["completion_tokens"] == 1 + 2 + 3 + 4
+
+
+def test_streamed_usage_counts_the_prompt_once(client):
+    res = client.post(
+        "/v1/chat/completions",
+        json={
+            "messages": [{"role": "user", "content": "hi there"}],
+            "n": 2,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        },
+    )
+    assert res.status_code == 200
+    events = [
+        line[len("data:") :].strip()
+        for line in res.text.splitlines()
+        if line.startswith("data:")
+    ]
+    assert events[-1] == openai_route.STREAM_DONE
+    usage = json.loads(events[-2])["usage"]
+    assert usage == {"prompt_tokens": 3, "completion_tokens": 3, "total_tokens": 6}
+    indexes = {c["index"] for e in events[:-2] for c in json.loads(e)["choices"]}
+    assert indexes == {0, 1}
+
+
+def test_models_lists_resident_models(client):
+    res = client.get("/v1/models")
+    assert [model["id"] for model in res.json()["data"]] == [MODEL_ID]
@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("llama_cpp")
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.llms.llama_cpp")
+
+from core import classes
+from inference import text_llama_index
+from inference.text_llama_index import PromptStateCache
+
+
+def state(size: int) -> SimpleNamespace:
+    return SimpleNamespace(llama_state_size=size)
+
+
+def test_lookup_returns_the_longest_shared_prefix():
+    cache = PromptStateCache(capacity_bytes=1000)
+    short, longer = state(10), state(10)
+    cache[(1, 2)] = short
+    cache[(1, 2, 3, 4)] = longer
+    assert (1, 2, 3, 9) in cache
+    assert cache[(1, 2, 3, 9)] is longer
+    assert (7, 8) not in cache
+    with pytest.raises(KeyError):
+        cache[(7, 8)]
+
+
+def test_least_recently_used_states_leave_the_ram_tier():
+    cache = PromptStateCache(capacity_bytes=25)
+    cache[(1,)] = state(10)
+    cache[(2,)] = state(10)
+    cache[(1,)]  # now (2,) is the least recently used
+    cache[(3,)] = state(10)
+    assert list(cache.cache_state.keys()) == [(1,), (3,)]
+    assert cache.cache_size == 20
+
+
+def test_only_an_enabled_cache_counts_towards_memory():
+    assert text_llama_index.prompt_cache_bytes(classes.LoadTextInferenceInit()) == 0
+    settings = classes.LoadTextInferenceInit(cache=True, cache_size=1234)
+    assert text_llama_index.prompt_cache_bytes(settings) == 1234
@@ -0,0 +1,64 @@
+import pytest
+
+sentence_transformers = pytest.importorskip("sentence_transformers")
+pytest.importorskip("llama_index.core")
+
+from llama_index.core.schema import NodeWithScore, TextNode
+from embeddings.rerank import Reranker, rerank_candidates
+
+
+# Scores a chunk by how many of the query's words it contains
+class WordOverlapEncoder:
+    def __init__(self, model_name: str, **kwargs):
+        self.pairs = []
+
+    def predict(self, pairs, batch_size: int, show_progress_bar: bool):
+        self.pairs.extend(pairs)
+        return [
+            float(len(set(query.split()) & set(text.split()))) for query, text in pairs
+        ]
+
+
+@pytest.fixture
+def reranker(monkeypatch):
+    monkeypatch.setattr(
+        sentence_transformers, "CrossEncoder", WordOverlapEncoder, raising=False
+    )
+    return Reranker(batch_size=2)
+
+
+def nodes(*texts) -> list:
+    return [
+        NodeWithScore(node=TextNode(id_=text, text=text), score=0.5) for text in texts
+    ]
+
+
+def test_candidates_are_over_fetched():
+    assert rerank_candidates(3) == 20
+    assert rerank_candidates(10) == 40
+
+
+def test_most_relevant_chunks_come_first(reranker):
+    ranked = reranker.rerank(
+        "red apple pie", nodes("green pear", "red apple pie", "apple tart"), top_n=2
+    )
+    assert [n.node.node_id for n in ranked] == ["red apple pie", "apple tart"]
+    assert ranked[0].score == 3.0
+
+
+def test_scores_are_cached_per_query_and_chunk(reranker):
+    candidates = nodes("red apple", "green pear")
+    reranker.rerank("apple", candidates, top_n=2)
+    reranker.rerank("apple", candidates, top_n=2)
+    assert len(reranker.model.pairs) == 2
+    reranker.rerank("pear", candidates, top_n=2)
+    assert len(reranker.model.pairs) == 4
+
+
+def test_unscored_candidates_keep_their_order_when_the_budget_runs_out(reranker):
+    candidates = nodes("a", "b", "c apple", "d apple apple")
+    ranked = reranker.rerank("apple", candidates, top_n=4, budget_ms=0.001)
+    # One batch is always scored, the rest follow in retrieval order
+    assert len(reranker.model.pairs) == 2
+    assert [n.node.node_id for n in ranked] == ["a", "b", "c apple", "d apple apple"]
+    assert [n.score for n in ranked[2:]] == [0.5, 0.5]
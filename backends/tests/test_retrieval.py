@@ -0,0 +1,102 @@
+import time
+import threading
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.embeddings.huggingface")
+
+from llama_index.core.schema import NodeWithScore, TextNode
+from embeddings import retrieval
+from embeddings.retrieval import RetrievalCache, fuse_results, normalize_query
+
+
+def ranked(*ids_and_scores) -> list:
+    return [
+        NodeWithScore(node=TextNode(id_=node_id, text=node_id), score=score)
+        for node_id, score in ids_and_scores
+    ]
+
+
+def ids(nodes: list) -> list:
+    return [result.node.node_id for result in nodes]
+
+
+def test_queries_are_normalized():
+    assert normalize_query("  What IS\tRAG? ") == "what is rag?"
+
+
+def test_cache_returns_hits_until_the_collection_changes():
+    cache = RetrievalCache(max_size=10, ttl=60)
+    version = cache.version("docs")
+    cache.put("docs", "What is RAG?", 3, "vector", version, [("a", 0.9)])
+    assert cache.get("docs", "what is  rag?", 3, "vector") == [("a", 0.9)]
+    assert cache.get("docs", "what is rag?", 5, "vector") is None
+    cache.invalidate("docs")
+    assert cache.get("docs", "what is rag?", 3, "vector") is None
+    # A search that started before the change is not cached
+    cache.put("docs", "What is RAG?", 3, "vector", version, [("a", 0.9)])
+    assert cache.get("docs", "what is rag?", 3, "vector") is None
+
+
+def test_cache_entries_expire():
+    cache = RetrievalCache(max_size=10, ttl=0)
+    cache.put("docs", "q", 3, "vector", cache.version("docs"), [("a", 0.9)])
+    time.sleep(0.001)
+    assert cache.get("docs", "q", 3, "vector") is None
+
+
+def test_rrf_rewards_chunks_ranked_high_in_several_lists():
+    fused = fuse_results(
+        [ranked(("a", 0.9), ("b", 0.8)), ranked(("b", 12.0), ("c", 3.0))], top_k=2
+    )
+    assert ids(fused) == ["b", "a"]
+
+
+def test_score_fusion_normalizes_each_list():
+    fused = fuse_results(
+        [ranked(("a", 0.9), ("b", 0.1)), ranked(("c", 30.0), ("d", 10.0))],
+        top_k=4,
+        mode=retrieval.SCORE,
+    )
+    assert set(ids(fused[:2])) == {"a", "c"}
+
+
+@pytest.fixture
+def slow_search(monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    def retrieve_cached(app, name, query_bundle, top_k, search_mode, hits):
+        calls.append(name)
+        if name == "slow":
+            release.wait(5)
+        return ranked((f"{name}-chunk", 1.0))
+
+    monkeypatch.setattr(retrieval, "retrieve_cached", retrieve_cached)
+    yield SimpleNamespace(release=release, calls=calls)
+    release.set()
+
+
+def test_timed_out_collection_is_skipped_until_its_search_ends(slow_search):
+    app = SimpleNamespace(state=SimpleNamespace(retrieval_cache=RetrievalCache()))
+
+    def search():
+        return retrieval.retrieve_collections(
+            app,
+            ["fast", "slow"],
+            "query",
+            top_k=5,
+            search_mode=retrieval.LEXICAL,
+            timeout=0.2,
+        )
+
+    assert ids(search()) == ["fast-chunk"]
+    # The overrunning search is not started a second time
+    started = time.monotonic()
+    assert ids(search()) == ["fast-chunk"]
+    assert time.monotonic() - started < 0.2
+    assert slow_search.calls.count("slow") == 1
+    slow_search.release.set()
+    time.sleep(0.05)
+    assert set(ids(search())) == {"fast-chunk", "slow-chunk"}
@@ -0,0 +1,140 @@
+import time
+import asyncio
+import threading
+import pytest
+from inference.executor import InferenceExecutor
+from inference.scheduler import InferenceScheduler, QueueFullError, stream_when_ready
+
+MODEL_ID = "model"
+
+
+def test_higher_priority_runs_first_then_first_in_first_out():
+    scheduler = InferenceScheduler(max_concurrency=1)
+    running = scheduler.admit(MODEL_ID, "running")
+    low = scheduler.admit(MODEL_ID, "low")
+    high = scheduler.admit(MODEL_ID, "high", priority=1)
+    later = scheduler.admit(MODEL_ID, "later")
+    assert running.is_running
+    assert [scheduler.position(t) for t in (high, low, later)] == [1, 2, 3]
+    scheduler.release(running)
+    assert high.is_running and not low.is_running
+    scheduler.release(high)
+    assert low.is_running and scheduler.position(later) == 1
+
+
+def test_full_queue_turns_requests_away_with_a_wait_estimate():
+    scheduler = InferenceScheduler(max_concurrency=1, max_queue_depth=2)
+    for request_id in ("a", "b", "c"):
+        scheduler.admit(MODEL_ID, request_id)
+    with pytest.raises(QueueFullError) as err:
+        scheduler.admit(MODEL_ID, "d")
+    assert err.value.retry_after >= 1
+    # Other models have queues of their own
+    assert scheduler.admit("other", "d").is_running
+
+
+def test_cancelled_request_leaves_the_queue():
+    scheduler = InferenceScheduler(max_concurrency=1)
+    running = scheduler.admit(MODEL_ID, "running")
+    queued = scheduler.admit(MODEL_ID, "queued")
+    assert scheduler.cancel("queued")
+    assert queued.is_cancelled
+    assert scheduler.stats()[MODEL_ID]["waiting"] == 0
+    assert not scheduler.cancel("queued")
+    # A running request is only signalled, its slot frees once it stops
+    assert scheduler.cancel("running")
+    assert running.cancel_event.is_set() and running.is_running
+    scheduler.release(running)
+    assert scheduler.stats()[MODEL_ID]["running"] == 0
+
+
+def test_raising_concurrency_starts_waiting_requests():
+    scheduler = InferenceScheduler(max_concurrency=1)
+    tickets = [scheduler.admit(MODEL_ID, str(i)) for i in range(3)]
+    scheduler.set_concurrency(MODEL_ID, 3)
+    assert all(t.is_running for t in tickets)
+
+
+def test_stream_reports_positions_until_it_runs():
+    async def run():
+        scheduler = InferenceScheduler(max_concurrency=1)
+        first = scheduler.admit(MODEL_ID, "first")
+        second = scheduler.admit(MODEL_ID, "second")
+
+        async def tokens(cancel_event):
+            yield "token"
+
+        events = []
+
+        async def consume():
+            async for item in stream_when_ready(scheduler, second, tokens):
+                events.append(item)
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0)
+        scheduler.release(first)
+        await task
+        return events, scheduler
+
+    events, scheduler = asyncio.run(run())
+    assert '"data": 1' in events[0] and '"data": 0' in events[1]
+    assert events[-1] == "token"
+    assert scheduler.stats()[MODEL_ID] == {
+        "running": 0,
+        "waiting": 0,
+        "maxConcurrency": 1,
+    }
+
+
+def test_unloading_a_model_rejects_its_queued_requests():
+    scheduler = InferenceScheduler(max_concurrency=1)
+    running = scheduler.admit(MODEL_ID, "running")
+    queued = scheduler.admit(MODEL_ID, "queued")
+    scheduler.reject_model(MODEL_ID)
+    assert queued.is_cancelled and not running.is_cancelled
+    assert scheduler.stats()[MODEL_ID]["waiting"] == 0
+
+
+def test_disconnect_or_cancel_stops_the_generation():
+    executor = InferenceExecutor(name="test")
+    stopped = threading.Event()
+
+    def tokens():
+        try:
+            while True:
+                time.sleep(0.001)
+                yield "token"
+        finally:
+            stopped.set()
+
+    async def run():
+        scheduler = InferenceScheduler(max_concurrency=1)
+        first = scheduler.admit(MODEL_ID, "first")
+        queued = scheduler.admit(MODEL_ID, "queued")
+        stream = stream_when_ready(
+            scheduler,
+            first,
+            lambda cancel_event: executor.stream(tokens, cancel_event),
+            report_position=False,
+        )
+        assert await stream.__anext__() == "token"
+        # The client went away
+        await stream.aclose()
+        assert first.is_cancelled and queued.is_running
+        # Cancelled by id while generating
+        items = []
+        async for item in stream_when_ready(
+            scheduler,
+            queued,
+            lambda cancel_event: executor.stream(tokens, cancel_event),
+            report_position=False,
+        ):
+            items.append(item)
+            if len(items) == 3:
+                assert scheduler.cancel("queued")
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    executor.shutdown()
+    assert stopped.wait(5)
+    assert scheduler.stats()[MODEL_ID]["running"] == 0